@@ -0,0 +1,4 @@
+"""
+Performance benchmarks for RePlay.
+All benchmarks run on a local Spark session and use synthetic data.
+"""
@@ -0,0 +1,126 @@
+"""
+Synthetic data for benchmarks.
+
+User activity and item popularity follow power law,
+so the logs have heavy users and popular items as real data do.
+"""
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+YEAR_SECONDS = 365 * 24 * 3600
+
+DATA_SIZES: Dict[str, Dict[str, int]] = {
+    "small": {"num_users": 1000, "num_items": 300, "num_interactions": 20000},
+    "medium": {
+        "num_users": 10000,
+        "num_items": 2000,
+        "num_interactions": 200000,
+    },
+    "large": {
+        "num_users": 100000,
+        "num_items": 20000,
+        "num_interactions": 2000000,
+    },
+}
+
+
+def power_law_weights(size: int, alpha: float = 1.0) -> np.ndarray:
+    """
+    Probabilities proportional to ``1 / rank ** alpha``
+
+    >>> power_law_weights(3).round(2)
+    array([0.55, 0.27, 0.18])
+
+    :param size: number of weights
+    :param alpha: power law exponent
+    :return: weights summing up to one
+    """
+    weights = 1 / np.arange(1, size + 1) ** alpha
+    return weights / weights.sum()
+
+
+# pylint: disable=too-many-arguments
+def generate_log(
+    num_users: int,
+    num_items: int,
+    num_interactions: int,
+    seed: int = 42,
+    user_alpha: float = 0.5,
+    item_alpha: float = 1.0,
+) -> pd.DataFrame:
+    """
+    Generate interactions log with power-law distributed
+    user activity and item popularity.
+    Duplicate user-item pairs are dropped,
+    so the log can be a bit smaller than ``num_interactions``.
+
+    >>> log = generate_log(10, 5, 30)
+    >>> log.columns.tolist()
+    ['user_idx', 'item_idx', 'relevance', 'timestamp']
+    >>> log.duplicated(["user_idx", "item_idx"]).any()
+    False
+
+    :param num_users: number of users
+    :param num_items: number of items
+    :param num_interactions: number of log records
+    :param seed: random seed
+    :param user_alpha: power law exponent of user activity
+    :param item_alpha: power law exponent of item popularity
+    :return: pandas DataFrame ``[user_idx, item_idx, relevance, timestamp]``
+    """
+    rng = np.random.default_rng(seed)
+    users = rng.permutation(num_users)[
+        rng.choice(
+            num_users,
+            num_interactions,
+            p=power_law_weights(num_users, user_alpha),
+        )
+    ]
+    items = rng.permutation(num_items)[
+        rng.choice(
+            num_items,
+            num_interactions,
+            p=power_law_weights(num_items, item_alpha),
+        )
+    ]
+    start = pd.Timestamp("2021-01-01")
+    log = pd.DataFrame(
+        {
+            "user_idx": users,
+            "item_idx": items,
+            "relevance": rng.integers(1, 6, num_interactions).astype(float),
+            "timestamp": start
+            + pd.to_timedelta(
+                rng.integers(0, YEAR_SECONDS, num_interactions), unit="s"
+            ),
+        }
+    )
+    return log.drop_duplicates(["user_idx", "item_idx"]).astype(
+        {"user_idx": "int32", "item_idx": "int32"}
+    )
+
+
+def generate_features(
+    num_ids: int, num_features: int = 5, column: str = "user_idx", seed=42
+) -> pd.DataFrame:
+    """
+    Generate dense numerical features.
+
+    >>> generate_features(3, 2).columns.tolist()
+    ['user_idx', 'feature_0', 'feature_1']
+
+    :param num_ids: number of users or items
+    :param num_features: number of feature columns
+    :param column: id column name
+    :param seed: random seed
+    :return: pandas DataFrame ``[column, feature_0, ...]``
+    """
+    rng = np.random.default_rng(seed)
+    features = pd.DataFrame(
+        rng.normal(size=(num_ids, num_features)),
+        columns=[f"feature_{i}" for i in range(num_features)],
+    )
+    features.insert(0, column, np.arange(num_ids, dtype="int32"))
+    return features
@@ -0,0 +1,116 @@
+"""
+Benchmark results history.
+
+Results are stored in a json file as a list of runs,
+each run is marked with git commit, so measurements
+can be compared between commits.
+"""
+import json
+import os
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+STAGE_COLUMNS = ["scenario", "stage"]
+
+
+def get_commit() -> str:
+    """
+    :return: hash of current git commit with ``-dirty`` suffix
+        if working tree has changes or ``unknown`` outside of git repository
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if status else commit
+
+
+def load_history(path: str) -> List[Dict]:
+    """
+    :param path: json file with history
+    :return: list of runs, empty if file does not exist
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as history_file:
+        return json.load(history_file)
+
+
+def save_results(
+    results: pd.DataFrame,
+    path: str,
+    commit: Optional[str] = None,
+    **params,
+) -> Dict:
+    """
+    Append run results to history.
+
+    :param results: measurements, one row per stage
+    :param path: json file with history
+    :param commit: run label, current git commit by default
+    :param params: run parameters such as data size
+    :return: saved run
+    """
+    run = {
+        "commit": commit or get_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "params": params,
+        "results": results.to_dict(orient="records"),
+    }
+    history = load_history(path)
+    history.append(run)
+    with open(path, "w") as history_file:
+        json.dump(history, history_file, indent=2)
+    return run
+
+
+def get_run(history: List[Dict], commit: str) -> pd.DataFrame:
+    """
+    Take the last run for commit.
+
+    :param history: list of runs
+    :param commit: commit hash or its prefix
+    :return: measurements indexed by scenario and stage
+    """
+    runs = [run for run in history if run["commit"].startswith(commit)]
+    if not runs:
+        raise ValueError(f"No benchmark results for commit {commit}")
+    return pd.DataFrame(runs[-1]["results"]).set_index(STAGE_COLUMNS)
+
+
+def compare(
+    path: str, base: str, head: str, metric: str = "wall_time"
+) -> pd.DataFrame:
+    """
+    Compare measurements of two commits.
+
+    :param path: json file with history
+    :param base: base commit
+    :param head: compared commit
+    :param metric: one of ``wall_time``, ``jobs``,
+        ``shuffle_bytes``, ``peak_rss_mb``
+    :return: values for both commits and relative change
+    """
+    history = load_history(path)
+    result = pd.DataFrame(
+        {
+            base: get_run(history, base)[metric],
+            head: get_run(history, head)[metric],
+        }
+    )
+    result["change"] = result[head] / result[base] - 1
+    return result
@@ -0,0 +1,170 @@
+"""
+Resource usage of a benchmark stage.
+
+Spark jobs started inside a stage are marked with a job group,
+so job count and shuffle size are taken only for this stage.
+Shuffle size is read from Spark REST API and is ``None``
+if Spark UI is disabled.
+"""
+import json
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, Optional, Set
+from urllib.request import urlopen
+
+import psutil
+from pyspark import SparkContext
+
+from replay.session_handler import State
+
+RSS_INTERVAL = 0.05
+REST_TIMEOUT = 10
+FINAL_STAGE_STATUSES = {"COMPLETE", "SKIPPED", "FAILED"}
+
+
+def process_tree_rss() -> int:
+    """
+    Resident memory of the current process and its children,
+    local Spark driver JVM is a child of python process.
+
+    :return: memory in bytes
+    """
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+class PeakMemory:
+    """Samples driver RSS in a background thread and keeps the maximum"""
+
+    def __init__(self, interval: float = RSS_INTERVAL):
+        """
+        :param interval: sampling interval in seconds
+        """
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, process_tree_rss())
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def _get_stages(spark_context: SparkContext) -> Dict[int, Dict]:
+    url = (
+        f"{spark_context.uiWebUrl}/api/v1/applications/"
+        f"{spark_context.applicationId}/stages"
+    )
+    with urlopen(url, timeout=REST_TIMEOUT) as response:
+        return {
+            stage["stageId"]: stage for stage in json.loads(response.read())
+        }
+
+
+def get_shuffle_bytes(
+    spark_context: SparkContext, stage_ids: Set[int]
+) -> Optional[int]:
+    """
+    Sum of shuffle write bytes of stages.
+    Stage statistics are updated by Spark listener asynchronously,
+    so REST API is polled until all stages are finished.
+
+    :param spark_context: active SparkContext
+    :param stage_ids: stages to take into account
+    :return: shuffle size in bytes
+        or ``None`` if Spark UI is not available
+    """
+    if spark_context.uiWebUrl is None:
+        return None
+    stages = {}
+    deadline = time.monotonic() + REST_TIMEOUT
+    while True:
+        try:
+            stages = _get_stages(spark_context)
+        except OSError:
+            return None
+        finished = all(
+            stages.get(stage_id, {}).get("status") in FINAL_STAGE_STATUSES
+            for stage_id in stage_ids
+        )
+        if finished or time.monotonic() > deadline:
+            break
+        time.sleep(0.1)
+    return sum(
+        stages[stage_id].get("shuffleWriteBytes", 0)
+        for stage_id in stage_ids
+        if stage_id in stages
+    )
+
+
+def _job_stages(spark_context: SparkContext, job_ids: Iterable[int]):
+    tracker = spark_context.statusTracker()
+    stage_ids = set()
+    for job_id in job_ids:
+        info = tracker.getJobInfo(job_id)
+        if info is not None:
+            stage_ids.update(info.stageIds)
+    return stage_ids
+
+
+class Measurement:
+    """
+    Context manager measuring wall time, Spark jobs, shuffle bytes
+    and peak driver RSS of the code inside it.
+
+    >>> with Measurement("count") as measurement:
+    ...     _ = State().session.range(10).count()
+    >>> sorted(measurement.result)
+    ['jobs', 'peak_rss_mb', 'shuffle_bytes', 'wall_time']
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: stage name, used as Spark job group description
+        """
+        self.name = name
+        self.group_id = f"benchmark-{uuid.uuid4().hex}"
+        self.result: Dict[str, Optional[float]] = {}
+        self._memory = PeakMemory()
+        self._start = 0.0
+
+    def __enter__(self):
+        State().session.sparkContext.setJobGroup(self.group_id, self.name)
+        self._memory.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        wall_time = time.perf_counter() - self._start
+        self._memory.__exit__(*args)
+        spark_context = State().session.sparkContext
+        spark_context.setLocalProperty("spark.jobGroup.id", None)
+        spark_context.setLocalProperty("spark.job.description", None)
+        job_ids = spark_context.statusTracker().getJobIdsForGroup(
+            self.group_id
+        )
+        self.result = {
+            "wall_time": wall_time,
+            "jobs": len(job_ids),
+            "shuffle_bytes": get_shuffle_bytes(
+                spark_context, _job_stages(spark_context, job_ids)
+            ),
+            "peak_rss_mb": self._memory.peak / 2 ** 20,
+        }
@@ -0,0 +1,416 @@
+"""
+Timed benchmark scenarios.
+
+Every scenario gets prepared data and a ``Benchmark`` instance
+and wraps measured code into ``benchmark.stage(name)``.
+Lazy results are materialized inside a stage, otherwise
+Spark jobs are postponed and measured in the next stage.
+"""
+import collections
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from implicit.als import AlternatingLeastSquares
+from pyspark.ml.stat import Summarizer
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as sf
+
+from benchmarks.data import DATA_SIZES, generate_features, generate_log
+from benchmarks.measure import Measurement
+from replay.cache import CacheManager
+from replay.experiment import Experiment
+from replay.metrics import (
+    HitRate,
+    MAP,
+    MRR,
+    NDCG,
+    Precision,
+    Recall,
+    RocAuc,
+    Coverage,
+    Surprisal,
+    Unexpectedness,
+)
+from replay.metrics.base_metric import get_enriched_recommendations
+from replay.models import (
+    ADMMSLIM,
+    ALSWrap,
+    AssociationRulesItemRec,
+    ClusterRec,
+    DDPG,
+    ImplicitWrap,
+    KNN,
+    LightFMWrap,
+    MultVAE,
+    NeuroMF,
+    PopRec,
+    RandomRec,
+    SLIM,
+    UCB,
+    UserPopRec,
+    Wilson,
+    Word2VecRec,
+)
+from replay.models.base_rec import (
+    BaseRecommender,
+    HybridRecommender,
+    UserRecommender,
+)
+from replay.scenarios import TwoStagesScenario
+from replay.splitters import (
+    ColdUserRandomSplitter,
+    DateSplitter,
+    NewUsersSplitter,
+    RandomSplitter,
+    UserSplitter,
+    k_folds,
+)
+from replay.utils import (
+    arrays_cosine_similarity,
+    arrays_cosine_similarity_pandas,
+    arrays_dot,
+    arrays_dot_pandas,
+    average_arrays,
+    convert2spark,
+    cosine_similarity,
+    list_to_vector_udf,
+    vector_dot,
+)
+
+K = 10
+VECTOR_SIZE = 64
+
+BenchmarkData = collections.namedtuple(
+    "BenchmarkData",
+    "log train test binary_train user_features item_features",
+)
+
+MODELS: Dict[str, Callable[[], BaseRecommender]] = {
+    "ADMMSLIM": lambda: ADMMSLIM(seed=42),
+    "ALSWrap": lambda: ALSWrap(seed=42),
+    "AssociationRulesItemRec": AssociationRulesItemRec,
+    "ClusterRec": ClusterRec,
+    "DDPG": DDPG,
+    "ImplicitWrap": lambda: ImplicitWrap(
+        AlternatingLeastSquares(random_state=42)
+    ),
+    "KNN": KNN,
+    "LightFMWrap": lambda: LightFMWrap(random_state=42),
+    "MultVAE": lambda: MultVAE(epochs=1),
+    "NeuroMF": lambda: NeuroMF(epochs=1),
+    "PopRec": PopRec,
+    "RandomRec": lambda: RandomRec(seed=42),
+    "SLIM": lambda: SLIM(seed=42),
+    "UCB": UCB,
+    "UserPopRec": UserPopRec,
+    "Wilson": Wilson,
+    "Word2VecRec": lambda: Word2VecRec(seed=42, min_count=0),
+}
+
+# models which require 0-1 relevance
+BINARY_MODELS = {"UCB", "Wilson"}
+
+
+class Benchmark:
+    """Collects measurements of scenario stages"""
+
+    def __init__(self):
+        self.results: List[Dict] = []
+        self._scenario = ""
+
+    @contextmanager
+    def scenario(self, name: str):
+        """
+        Prefix stage names with scenario name
+
+        :param name: scenario name
+        """
+        self._scenario = name
+        yield self
+        self._scenario = ""
+
+    @contextmanager
+    def stage(self, name: str, rows: Optional[int] = None):
+        """
+        Measure code inside the context
+
+        :param name: stage name
+        :param rows: number of processed rows to get time per row
+        """
+        with Measurement(f"{self._scenario}.{name}") as measurement:
+            yield
+        self.results.append(
+            {
+                "scenario": self._scenario,
+                "stage": name,
+                **measurement.result,
+                "rows": rows,
+            }
+        )
+
+    @property
+    def pandas_df(self) -> pd.DataFrame:
+        """Measurements as pandas DataFrame"""
+        result = pd.DataFrame(self.results)
+        result["time_per_row"] = result["wall_time"] / result["rows"]
+        return result
+
+
+def prepare_data(size: str = "small", seed: int = 42) -> BenchmarkData:
+    """
+    Generate synthetic log and split it into train and test.
+
+    :param size: one of ``DATA_SIZES``
+    :param seed: random seed
+    :return: cached Spark DataFrames
+    """
+    params = DATA_SIZES[size]
+    log = convert2spark(generate_log(**params, seed=seed)).cache()
+    train, test = UserSplitter(
+        item_test_size=0.2, drop_cold_items=True, seed=seed
+    ).split(log)
+    binary_train = train.withColumn(
+        "relevance", (sf.col("relevance") > 3).cast("double")
+    ).cache()
+    user_features = convert2spark(
+        generate_features(params["num_users"], seed=seed)
+    ).cache()
+    item_features = convert2spark(
+        generate_features(params["num_items"], column="item_idx", seed=seed)
+    ).cache()
+    return BenchmarkData(
+        log, train, test, binary_train, user_features, item_features
+    )
+
+
+def _materialize(dataframe: DataFrame) -> DataFrame:
+    dataframe.cache().count()
+    return dataframe
+
+
+def model_scenario(
+    benchmark: Benchmark, data: BenchmarkData, model_name: str
+) -> DataFrame:
+    """
+    Fit, predict for test users and predict pairs from test.
+
+    :param benchmark: measurements collector
+    :param data: prepared data
+    :param model_name: key of ``MODELS``
+    :return: recommendations
+    """
+    model = MODELS[model_name]()
+    train = data.binary_train if model_name in BINARY_MODELS else data.train
+    features = {}
+    if isinstance(model, (HybridRecommender, UserRecommender)):
+        features["user_features"] = data.user_features
+    if isinstance(model, HybridRecommender):
+        features["item_features"] = data.item_features
+    users = data.test.select("user_idx").distinct()
+    with benchmark.stage("fit"):
+        model.fit(log=train, **features)
+    with benchmark.stage("predict"):
+        recs = _materialize(
+            model.predict(log=train, k=K, users=users, **features)
+        )
+    with benchmark.stage("predict_pairs"):
+        _materialize(
+            model.predict_pairs(
+                data.test.select("user_idx", "item_idx"),
+                log=train,
+                **features,
+            )
+        )
+    return recs
+
+
+def experiment_scenario(
+    benchmark: Benchmark, data: BenchmarkData, recs: DataFrame
+):
+    """
+    Calculate all metrics with ``Experiment``.
+
+    :param benchmark: measurements collector
+    :param data: prepared data
+    :param recs: recommendations
+    """
+    with benchmark.stage("get_enriched_recommendations"):
+        _materialize(get_enriched_recommendations(recs, data.test))
+    metrics = {
+        metric: [1, 5, K]
+        for metric in (
+            HitRate(),
+            MAP(),
+            MRR(),
+            NDCG(),
+            Precision(),
+            Recall(),
+            RocAuc(),
+        )
+    }
+    metrics.update(
+        {
+            Coverage(data.train): K,
+            Surprisal(data.train): K,
+            Unexpectedness(recs): K,
+        }
+    )
+    with benchmark.stage("experiment"):
+        experiment = Experiment(
+            data.test, metrics, calc_median=True, calc_conf_interval=0.95
+        )
+        experiment.add_result("recs", recs)
+
+
+def splitters_scenario(benchmark: Benchmark, data: BenchmarkData):
+    """
+    Split log with every splitter.
+
+    :param benchmark: measurements collector
+    :param data: prepared data
+    """
+    splitters = {
+        "UserSplitter": UserSplitter(item_test_size=0.2, seed=42),
+        "UserSplitter_shuffle": UserSplitter(
+            item_test_size=0.2, shuffle=True, seed=42
+        ),
+        "DateSplitter": DateSplitter(test_start=0.2),
+        "RandomSplitter": RandomSplitter(test_size=0.2, seed=42),
+        "NewUsersSplitter": NewUsersSplitter(test_size=0.2),
+        "ColdUserRandomSplitter": ColdUserRandomSplitter(test_size=0.2),
+    }
+    for name, splitter in splitters.items():
+        with benchmark.stage(name):
+            for dataframe in splitter.split(data.log):
+                dataframe.count()
+        CacheManager().release_scope(splitter.cache_scope)
+    with benchmark.stage("k_folds"):
+        for train, test in k_folds(data.log, n_folds=3, seed=42):
+            train.count()
+            test.count()
+
+
+def two_stages_scenario(benchmark: Benchmark, data: BenchmarkData):
+    """
+    Fit and predict ``TwoStagesScenario`` with ALS and KNN
+    as first level models.
+
+    :param benchmark: measurements collector
+    :param data: prepared data
+    """
+    scenario = TwoStagesScenario(
+        first_level_models=[ALSWrap(rank=16, seed=42), KNN()],
+        use_first_level_models_feat=[True, False],
+        second_model_params={
+            "general_params": {"use_algos": ["lgb"]},
+            "timeout": 600,
+        },
+        use_generated_features=True,
+        num_negatives=10,
+    )
+    with benchmark.stage("fit"):
+        scenario.fit(data.train, data.user_features, data.item_features)
+    with benchmark.stage("predict"):
+        _materialize(
+            scenario.predict(
+                data.train,
+                k=K,
+                users=data.test.select("user_idx").distinct(),
+                user_features=data.user_features,
+                item_features=data.item_features,
+            )
+        )
+
+
+def vector_functions_scenario(
+    benchmark: Benchmark, data: BenchmarkData, seed: int = 42
+):
+    """
+    Dot product and cosine similarity of random user and item vectors
+    for every interaction computed with Python UDFs on vectors,
+    Spark SQL higher-order functions and pandas UDFs on arrays.
+    Mean of item vectors by user, as user vectors of ``Word2VecRec``,
+    is computed with ``Summarizer`` on vectors and ``average_arrays``.
+    Per-row cost is ``time_per_row`` column of the results.
+
+    :param benchmark: measurements collector
+    :param data: prepared data
+    :param seed: random seed
+    """
+    rng = np.random.default_rng(seed)
+    pairs = data.log.select("user_idx", "item_idx")
+    max_ids = pairs.agg(sf.max("user_idx"), sf.max("item_idx")).first()
+    for entity, max_id in zip(["user", "item"], max_ids):
+        factors = convert2spark(
+            pd.DataFrame(
+                {
+                    f"{entity}_idx": np.arange(max_id + 1),
+                    f"{entity}_array": list(
+                        rng.random((max_id + 1, VECTOR_SIZE))
+                    ),
+                }
+            )
+        ).withColumn(f"{entity}_vector", list_to_vector_udf(f"{entity}_array"))
+        pairs = pairs.join(factors, on=f"{entity}_idx")
+    pairs = _materialize(pairs)
+    rows = pairs.count()
+    functions = {
+        "python_udf_dot": vector_dot("user_vector", "item_vector"),
+        "native_dot": arrays_dot("user_array", "item_array"),
+        "pandas_udf_dot": arrays_dot_pandas("user_array", "item_array"),
+        "python_udf_cosine": cosine_similarity("user_vector", "item_vector"),
+        "native_cosine": arrays_cosine_similarity("user_array", "item_array"),
+        "pandas_udf_cosine": arrays_cosine_similarity_pandas(
+            "user_array", "item_array"
+        ),
+    }
+    for name, column in functions.items():
+        with benchmark.stage(name, rows):
+            pairs.select(sf.sum(column)).first()
+    means = {
+        "summarizer_mean": Summarizer.mean(sf.col("item_vector")),
+        "native_mean": average_arrays("item_array", VECTOR_SIZE),
+    }
+    for name, column in means.items():
+        with benchmark.stage(name, rows):
+            user_means = pairs.groupBy("user_idx").agg(column.alias("mean"))
+            user_means.write.format("noop").mode("overwrite").save()
+    pairs.unpersist()
+
+
+def run_benchmarks(
+    size: str = "small", models: List[str] = None, seed: int = 42
+) -> pd.DataFrame:
+    """
+    Run model scenarios, ``Experiment`` on ``PopRec`` recommendations,
+    splitters, ``TwoStagesScenario`` and vector functions.
+
+    :param size: one of ``DATA_SIZES``
+    :param models: model names, all ``MODELS`` by default
+    :param seed: random seed
+    :return: measurements, one row per stage
+    """
+    benchmark = Benchmark()
+    data = prepare_data(size, seed)
+    pop_recs = None
+    for model_name in models or list(MODELS):
+        with benchmark.scenario(model_name):
+            recs = model_scenario(benchmark, data, model_name)
+        if model_name == "PopRec":
+            pop_recs = recs
+        else:
+            recs.unpersist()
+    if pop_recs is None:
+        with benchmark.scenario("PopRec"):
+            pop_recs = model_scenario(benchmark, data, "PopRec")
+    with benchmark.scenario("Experiment"):
+        experiment_scenario(benchmark, data, pop_recs)
+    with benchmark.scenario("splitters"):
+        splitters_scenario(benchmark, data)
+    with benchmark.scenario("TwoStagesScenario"):
+        two_stages_scenario(benchmark, data)
+    with benchmark.scenario("vector_functions"):
+        vector_functions_scenario(benchmark, data, seed)
+    return benchmark.pandas_df
@@ -0,0 +1,112 @@
+"""
+Compare Spark tuning profiles on the standard fit/predict pipeline.
+
+Every profile is measured in a separate process,
+because serializer and memory settings can not be changed
+for a running Spark session.
+
+.. code-block:: bash
+
+    python -m benchmarks.session_profiles --users 10000 --items 2000
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from benchmarks.data import generate_log
+from replay import models
+from replay.session_handler import State
+from replay.splitters import UserSplitter
+from replay.utils import convert2spark
+
+PIPELINE_MODELS = ["PopRec", "KNN", "ALSWrap"]
+
+
+def run_pipeline(
+    profile: Optional[str], num_users: int, num_items: int, k: int = 10
+) -> Dict[str, float]:
+    """
+    Fit and predict every model from ``PIPELINE_MODELS``
+    with a session created with ``profile``.
+
+    :param profile: tuning profile name, ``None`` for default settings
+    :param num_users: number of users in synthetic log
+    :param num_items: number of items in synthetic log
+    :param k: recommendation list length
+    :return: wall time in seconds for each stage
+    """
+    State(profile=profile)
+    log = convert2spark(generate_log(num_users, num_items, num_users * 20))
+    train, test = UserSplitter(item_test_size=0.2, seed=42).split(log)
+    users = test.select("user_idx").distinct()
+    timings = {}
+    for model_name in PIPELINE_MODELS:
+        model = getattr(models, model_name)()
+        start = time.perf_counter()
+        model.fit(train)
+        timings[f"{model_name}.fit"] = time.perf_counter() - start
+        start = time.perf_counter()
+        model.predict(train, k=k, users=users).count()
+        timings[f"{model_name}.predict"] = time.perf_counter() - start
+    return timings
+
+
+def compare_profiles(
+    profiles: List[str], num_users: int, num_items: int
+) -> pd.DataFrame:
+    """
+    Run the pipeline for every profile in a separate python process.
+
+    :param profiles: profile names, ``default`` stands for no tuning
+    :param num_users: number of users in synthetic log
+    :param num_items: number of items in synthetic log
+    :return: stage timings, profiles are columns
+    """
+    results = {}
+    for profile in profiles:
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.session_profiles",
+                "--single",
+                profile,
+                "--users",
+                str(num_users),
+                "--items",
+                str(num_items),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results[profile] = json.loads(output.strip().splitlines()[-1])
+    return pd.DataFrame(results)
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        default=["default", "local-small", "local-large"],
+    )
+    parser.add_argument("--single", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.single is not None:
+        profile = None if args.single == "default" else args.single
+        print(json.dumps(run_pipeline(profile, args.users, args.items)))
+    else:
+        print(compare_profiles(args.profiles, args.users, args.items))
+
+
+if __name__ == "__main__":
+    main()
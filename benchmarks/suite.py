@@ -0,0 +1,60 @@
+"""
+Run benchmark suite on a local Spark session
+and compare results between commits.
+
+.. code-block:: bash
+
+    python -m benchmarks.suite run --size small
+    python -m benchmarks.suite run --models PopRec KNN
+    python -m benchmarks.suite compare 1a2b3c4 5d6e7f8 --metric jobs
+"""
+import argparse
+
+import pandas as pd
+
+from benchmarks.data import DATA_SIZES
+from benchmarks.history import compare, save_results
+from benchmarks.scenarios import MODELS, run_benchmarks
+from replay.session_handler import State, get_spark_session
+
+HISTORY_PATH = "benchmarks/history.json"
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--history", default=HISTORY_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run benchmarks")
+    run.add_argument("--size", choices=list(DATA_SIZES), default="small")
+    run.add_argument("--models", nargs="+", choices=list(MODELS))
+    run.add_argument("--memory", type=int, default=None)
+    run.add_argument("--commit", help="run label, git commit by default")
+
+    diff = commands.add_parser("compare", help="compare two commits")
+    diff.add_argument("base")
+    diff.add_argument("head")
+    diff.add_argument(
+        "--metric",
+        choices=["wall_time", "jobs", "shuffle_bytes", "peak_rss_mb"],
+        default="wall_time",
+    )
+
+    args = parser.parse_args()
+    pd.set_option("display.width", None)
+    pd.set_option("display.max_rows", None)
+    if args.command == "run":
+        State(get_spark_session(args.memory))
+        results = run_benchmarks(args.size, args.models)
+        run_info = save_results(
+            results, args.history, args.commit, size=args.size
+        )
+        print(f"Results for {run_info['commit']}:")
+        print(results)
+    else:
+        print(compare(args.history, args.base, args.head, args.metric))
+
+
+if __name__ == "__main__":
+    main()
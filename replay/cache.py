@@ -0,0 +1,246 @@
+"""
+Central registry of cached DataFrames.
+
+DataFrames are persisted within named scopes, e.g. a fitted model
+or a splitter, and are unpersisted when the last scope releases them.
+Objects which own cached DataFrames get a scope with ``instance_scope``,
+it is released when the object is refitted or garbage collected.
+
+If ``spark.replay.cacheBudget`` option is set, e.g. to ``4g``,
+least recently used DataFrames are unpersisted
+when the total size of cached data exceeds the budget.
+"""
+import logging
+import threading
+import weakref
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Optional, Set
+
+import pandas as pd
+from pyspark import StorageLevel
+from pyspark.sql import DataFrame
+
+from replay.session_handler import Borg, State
+from replay.utils import byte_string_as_bytes, get_size_in_bytes
+
+CACHE_BUDGET_CONF = "spark.replay.cacheBudget"
+
+STORAGE_LEVELS: Dict[str, StorageLevel] = {
+    "MEMORY_AND_DISK": StorageLevel(True, True, False, True),
+    "MEMORY_AND_DISK_SER": StorageLevel(True, True, False, False),
+    "MEMORY_ONLY": StorageLevel(False, True, False, True),
+    "DISK_ONLY": StorageLevel.DISK_ONLY,
+}
+
+
+# pylint: disable=too-few-public-methods
+class CacheEntry:
+    """Cached DataFrame with its owners"""
+
+    def __init__(self, dataframe: DataFrame, name: str, storage_level: str):
+        self.dataframe = dataframe
+        self.name = name
+        self.storage_level = storage_level
+        self.scopes: Counter = Counter()
+
+
+class CacheManager(Borg):
+    """
+    Keeps track of cached DataFrames. All instances share the state.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> manager = CacheManager()
+    >>> df = spark.range(10)
+    >>> df = manager.persist(df, "example", name="range")
+    >>> df.is_cached
+    True
+    >>> manager.persist(df, "other example") is df
+    True
+    >>> pinned = manager.pinned()
+    >>> pinned[pinned["name"] == "range"]["scopes"].tolist()
+    [['example', 'other example']]
+    >>> manager.release_scope("example")
+    >>> df.is_cached
+    True
+    >>> manager.release(df, "other example")
+    >>> df.is_cached
+    False
+    """
+
+    entries: "OrderedDict[int, CacheEntry]"
+    finalized_scopes: Set[str]
+    default_storage_level: str
+
+    def __init__(self):
+        Borg.__init__(self)
+        if not hasattr(self, "entries"):
+            self.entries = OrderedDict()
+            self.finalized_scopes = set()
+            self.default_storage_level = "MEMORY_AND_DISK"
+            # models may be fitted in several threads
+            self.lock = threading.RLock()
+
+    @property
+    def logger(self) -> logging.Logger:
+        """
+        :return: logger
+        """
+        return logging.getLogger("replay")
+
+    def persist(
+        self,
+        dataframe: Optional[DataFrame],
+        scope: str,
+        name: Optional[str] = None,
+        storage_level: Optional[str] = None,
+    ) -> Optional[DataFrame]:
+        """
+        Persist DataFrame and pin it to a scope.
+        If DataFrame is already managed, only reference count is increased.
+
+        :param dataframe: Spark DataFrame or ``None``
+        :param scope: owner name
+        :param name: DataFrame name to show in ``pinned``
+        :param storage_level: one of ``STORAGE_LEVELS``,
+            ``default_storage_level`` by default
+        :return: the same DataFrame
+        """
+        if dataframe is None:
+            return None
+        with self.lock:
+            key = id(dataframe)
+            if key not in self.entries:
+                storage_level = storage_level or self.default_storage_level
+                if storage_level not in STORAGE_LEVELS:
+                    raise ValueError(
+                        f"Unknown storage level {storage_level}, "
+                        f"use one of {list(STORAGE_LEVELS)}"
+                    )
+                dataframe.persist(STORAGE_LEVELS[storage_level])
+                self.entries[key] = CacheEntry(
+                    dataframe, name or scope, storage_level
+                )
+            self.entries[key].scopes[scope] += 1
+            self.entries.move_to_end(key)
+            self._evict()
+            return dataframe
+
+    def touch(self, dataframe: DataFrame) -> None:
+        """
+        Mark DataFrame as recently used
+
+        :param dataframe: managed DataFrame
+        """
+        with self.lock:
+            if id(dataframe) in self.entries:
+                self.entries.move_to_end(id(dataframe))
+
+    def _unpersist(self, key: int) -> None:
+        entry = self.entries.pop(key)
+        entry.dataframe.unpersist()
+
+    def release(self, dataframe: Optional[DataFrame], scope: str) -> None:
+        """
+        Decrease reference count of DataFrame in a scope.
+        DataFrame is unpersisted when it is not referenced by any scope.
+
+        :param dataframe: managed DataFrame
+        :param scope: owner name
+        """
+        with self.lock:
+            key = id(dataframe)
+            if key not in self.entries:
+                return
+            entry = self.entries[key]
+            entry.scopes[scope] -= 1
+            if entry.scopes[scope] <= 0:
+                del entry.scopes[scope]
+            if not entry.scopes:
+                self._unpersist(key)
+
+    def release_scope(self, scope: str) -> None:
+        """
+        Release all DataFrames pinned to a scope
+
+        :param scope: owner name
+        """
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if scope in entry.scopes:
+                    del entry.scopes[scope]
+                    if not entry.scopes:
+                        self._unpersist(key)
+
+    def _finalize(self, scope: str) -> None:
+        self.finalized_scopes.discard(scope)
+        self.release_scope(scope)
+
+    def clear(self) -> None:
+        """Unpersist all managed DataFrames"""
+        with self.lock:
+            for key in list(self.entries):
+                self._unpersist(key)
+
+    def _evict(self) -> None:
+        budget = State().session.conf.get(CACHE_BUDGET_CONF, None)
+        if budget is None:
+            return
+        budget = byte_string_as_bytes(budget)
+        sizes = {
+            key: get_size_in_bytes(entry.dataframe) or 0
+            for key, entry in self.entries.items()
+        }
+        total = sum(sizes.values())
+        # the most recently persisted DataFrame is kept
+        for key in list(self.entries)[:-1]:
+            if total <= budget:
+                break
+            self.logger.info(
+                "Cache budget %s bytes is exceeded, unpersisting %s",
+                budget,
+                self.entries[key].name,
+            )
+            total -= sizes[key]
+            self._unpersist(key)
+
+    def pinned(self) -> pd.DataFrame:
+        """
+        Managed DataFrames from the least to the most recently used.
+        Size is estimated with Spark statistics
+        and is exact for materialized DataFrames.
+
+        :return: pandas DataFrame
+            ``[name, scopes, refs, storage_level, size_bytes]``
+        """
+        return pd.DataFrame(
+            [
+                {
+                    "name": entry.name,
+                    "scopes": sorted(entry.scopes),
+                    "refs": sum(entry.scopes.values()),
+                    "storage_level": entry.storage_level,
+                    "size_bytes": get_size_in_bytes(entry.dataframe),
+                }
+                for entry in self.entries.values()
+            ],
+            columns=["name", "scopes", "refs", "storage_level", "size_bytes"],
+        )
+
+
+def instance_scope(owner: Any) -> str:
+    """
+    Scope named after an object.
+    DataFrames pinned to it are released when the object is garbage collected.
+
+    :param owner: object owning cached DataFrames
+    :return: scope name
+    """
+    scope = f"{type(owner).__name__}@{id(owner):x}"
+    manager = CacheManager()
+    with manager.lock:
+        if scope not in manager.finalized_scopes:
+            manager.finalized_scopes.add(scope)
+            # pylint: disable=protected-access
+            weakref.finalize(owner, manager._finalize, scope)
+    return scope
@@ -30,6 +30,14 @@ REC_SCHEMA = StructType(
     ]
 )
 
+SIMILARITY_SCHEMA = StructType(
+    [
+        StructField("item_idx_one", IntegerType()),
+        StructField("item_idx_two", IntegerType()),
+        StructField("similarity", DoubleType()),
+    ]
+)
+
 BASE_SCHEMA = StructType(
     [
         StructField("user_idx", IntegerType()),
@@ -3,6 +3,7 @@ from typing import Any, Dict, Optional
 import pandas as pd
 
 from replay.constants import IntOrList, NumType
+from replay.profiler import profile
 from replay.utils import convert2spark
 from replay.metrics.base_metric import (
     Metric,
@@ -93,9 +94,10 @@ class Experiment:
                     pred, self.test
                 )
 
-            values, median, conf_interval = self._calculate(
-                metric, enriched or recs, k_list
-            )
+            with profile(f"Experiment.{metric}"):
+                values, median, conf_interval = self._calculate(
+                    metric, enriched or recs, k_list
+                )
 
             if isinstance(k_list, int):
                 self._add_metric(  # type: ignore
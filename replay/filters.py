@@ -2,10 +2,10 @@
 Select or remove data by some criteria
 """
 from datetime import datetime, timedelta
-from pyspark.sql import DataFrame, Window, functions as sf
+from pyspark.sql import Column, DataFrame, Window, functions as sf
 from pyspark.sql.functions import col
 from pyspark.sql.types import TimestampType
-from typing import Union, Optional
+from typing import Callable, List, Union, Optional
 
 from replay.constants import AnyDataFrame
 from replay.utils import convert2spark
@@ -374,3 +374,362 @@ def filter_by_duration(
         f"INTERVAL {duration_days} days"
     )
     return log.filter(col(date_column) > start_date)
+
+
+def _checkpoint(data_frame: DataFrame) -> DataFrame:
+    """
+    Materialize DataFrame and truncate its lineage.
+    Reliable checkpoint is used if checkpoint directory is set.
+    """
+    spark_context = State().session.sparkContext
+    # pylint: disable=protected-access
+    if spark_context._jsc.sc().getCheckpointDir().isDefined():
+        return data_frame.checkpoint()
+    return data_frame.localCheckpoint()
+
+
+class FilterPipeline:
+    """
+    Chain of log filters applied in the given order.
+
+    Per-user filters share one window partitioned by user and ordered
+    by date and item, so a chain of them is computed with
+    a single shuffle and sort, while calling separate filters
+    shuffles the log for each of them.
+
+    >>> import pandas as pd
+    >>> from replay.utils import convert2spark
+    >>> log_pd = pd.DataFrame({"user_idx": ["u1", "u2", "u2", "u3", "u3", "u3"],
+    ...                     "item_idx": ["i1", "i2","i3", "i1", "i2","i3"],
+    ...                     "rel": [1., 0.5, 3, 1, 0, 1],
+    ...                     "timestamp": ["2020-01-01 23:59:59", "2020-02-01",
+    ...                                   "2020-02-01", "2020-01-01 00:04:15",
+    ...                                   "2020-01-02 00:04:14", "2020-01-05 23:59:59"]},
+    ...             )
+    >>> log_pd["timestamp"] = pd.to_datetime(log_pd["timestamp"])
+    >>> log_sp = convert2spark(log_pd)
+    >>> pipeline = FilterPipeline().min_entries(2).user_interactions(1, first=False)
+    >>> pipeline.transform(log_sp).orderBy("user_idx").show()
+    +--------+--------+---+-------------------+
+    |user_idx|item_idx|rel|          timestamp|
+    +--------+--------+---+-------------------+
+    |      u2|      i3|3.0|2020-02-01 00:00:00|
+    |      u3|      i3|1.0|2020-01-05 23:59:59|
+    +--------+--------+---+-------------------+
+    <BLANKLINE>
+
+    ``k_core`` removes users and items repeatedly
+    until every user and item has enough interactions:
+
+    >>> pipeline = FilterPipeline().k_core(min_user_entries=2, min_item_entries=2)
+    >>> pipeline.transform(log_sp).orderBy("user_idx", "item_idx").show()
+    +--------+--------+---+-------------------+
+    |user_idx|item_idx|rel|          timestamp|
+    +--------+--------+---+-------------------+
+    |      u2|      i2|0.5|2020-02-01 00:00:00|
+    |      u2|      i3|3.0|2020-02-01 00:00:00|
+    |      u3|      i2|0.0|2020-01-02 00:04:14|
+    |      u3|      i3|1.0|2020-01-05 23:59:59|
+    +--------+--------+---+-------------------+
+    <BLANKLINE>
+    """
+
+    def __init__(
+        self,
+        user_col: str = "user_idx",
+        item_col: Optional[str] = "item_idx",
+        date_col: str = "timestamp",
+    ):
+        """
+        :param user_col: user column
+        :param item_col: item column to help sort simultaneous interactions.
+            If None, it is ignored and ``k_core`` is not available.
+        :param date_col: date column
+        """
+        self.user_col = user_col
+        self.item_col = item_col
+        self.date_col = date_col
+        self.steps: List[Callable[[DataFrame], DataFrame]] = []
+        order = [col(date_col)]
+        if item_col is not None:
+            order.append(col(item_col))
+        self._ordered_window = Window.partitionBy(user_col).orderBy(*order)
+        self._user_window = self._ordered_window.rowsBetween(
+            Window.unboundedPreceding, Window.unboundedFollowing
+        )
+
+    def _by_user(
+        self, value: Column, condition: Callable[[Column], Column]
+    ) -> "FilterPipeline":
+        def step(log: DataFrame) -> DataFrame:
+            return (
+                log.withColumn("_user_value", value)
+                .filter(condition(col("_user_value")))
+                .drop("_user_value")
+            )
+
+        self.steps.append(step)
+        return self
+
+    def min_rating(
+        self, value: float, column: str = "relevance"
+    ) -> "FilterPipeline":
+        """
+        Remove records with ``column`` less than or equal to ``value``,
+        same as ``min_rating`` function.
+
+        :param value: threshold
+        :param column: column to filter by
+        :return: the pipeline
+        """
+        self.steps.append(lambda log: log.filter(col(column) > value))
+        return self
+
+    def between_dates(
+        self,
+        start_date: Optional[Union[str, datetime]] = None,
+        end_date: Optional[Union[str, datetime]] = None,
+    ) -> "FilterPipeline":
+        """
+        Select records between ``[start_date, end_date)``.
+
+        :param start_date: datetime or str with format "yyyy-MM-dd HH:mm:ss",
+            not bounded if None
+        :param end_date: datetime or str with format "yyyy-MM-dd HH:mm:ss",
+            not bounded if None
+        :return: the pipeline
+        """
+        date = col(self.date_col)
+        condition = sf.lit(True)
+        if start_date is not None:
+            condition &= date >= sf.lit(start_date).cast(TimestampType())
+        if end_date is not None:
+            condition &= date < sf.lit(end_date).cast(TimestampType())
+        self.steps.append(lambda log: log.filter(condition))
+        return self
+
+    def duration(
+        self, duration_days: int, first: bool = True
+    ) -> "FilterPipeline":
+        """
+        Select first/last days of the whole log,
+        same as ``filter_by_duration``.
+
+        :param duration_days: length of selected data in days
+        :param first: take either first ``duration_days`` or last
+        :return: the pipeline
+        """
+        self.steps.append(
+            lambda log: filter_by_duration(
+                log, duration_days, first, self.date_col
+            )
+        )
+        return self
+
+    def min_entries(self, num_entries: int) -> "FilterPipeline":
+        """
+        Remove users with less than ``num_entries`` interactions.
+
+        :param num_entries: minimal number of interactions
+        :return: the pipeline
+        """
+        return self._by_user(
+            sf.count(sf.lit(1)).over(self._user_window),
+            lambda value: value >= num_entries,
+        )
+
+    def user_interactions(
+        self, num_interactions: int = 10, first: bool = True
+    ) -> "FilterPipeline":
+        """
+        Get first/last ``num_interactions`` interactions for each user,
+        same as ``filter_user_interactions``.
+
+        :param num_interactions: number of interactions to leave per user
+        :param first: take either first ``num_interactions`` or last
+        :return: the pipeline
+        """
+        rank = sf.row_number().over(self._ordered_window)
+        if first:
+            return self._by_user(rank, lambda value: value <= num_interactions)
+        # rank from the end is computed over the same ascending window
+        return self._by_user(
+            sf.count(sf.lit(1)).over(self._user_window) - rank,
+            lambda value: value < num_interactions,
+        )
+
+    def user_duration(
+        self, days: int = 10, first: bool = True
+    ) -> "FilterPipeline":
+        """
+        Get first/last ``days`` of user interactions,
+        same as ``filter_by_user_duration``.
+
+        :param days: how many days to return per user
+        :param first: take either first ``days`` or last
+        :return: the pipeline
+        """
+        date = col(self.date_col)
+        interval = sf.expr(f"INTERVAL {days} days")
+        if first:
+            return self._by_user(
+                sf.min(date).over(self._user_window),
+                lambda value: date < value + interval,
+            )
+        return self._by_user(
+            sf.max(date).over(self._user_window),
+            lambda value: date > value - interval,
+        )
+
+    def k_core(
+        self, min_user_entries: int = 1, min_item_entries: int = 1
+    ) -> "FilterPipeline":
+        """
+        Remove users and items with too few interactions repeatedly,
+        see ``KCoreFilter``.
+
+        :param min_user_entries: minimal number of interactions of a user
+        :param min_item_entries: minimal number of interactions of an item
+        :return: the pipeline
+        """
+        if self.item_col is None:
+            raise ValueError("k_core requires item_col")
+        k_core_filter = KCoreFilter(
+            min_user_entries, min_item_entries, self.user_col, self.item_col
+        )
+        self.steps.append(k_core_filter.transform)
+        return self
+
+    def transform(self, log: AnyDataFrame) -> DataFrame:
+        """
+        Apply filters to the log
+
+        :param log: historical interactions DataFrame
+        :return: filtered DataFrame
+        """
+        log = convert2spark(log)
+        for step in self.steps:
+            log = step(log)
+        return log
+
+
+class KCoreFilter:
+    """
+    Remove users and items with too few interactions repeatedly
+    until all of the remaining users and items have enough of them.
+
+    Interactions are counted once, after that only counts of users
+    and items losing interactions are updated in each round.
+    The log and the counts are checkpointed in each round
+    to keep query plans short.
+
+    >>> import pandas as pd
+    >>> log = pd.DataFrame({"user_idx": [1, 2, 2, 3, 3, 3],
+    ...                     "item_idx": [1, 2, 3, 1, 2, 3]})
+    >>> k_core_filter = KCoreFilter(min_user_entries=2, min_item_entries=2)
+    >>> k_core_filter.transform(log).orderBy("user_idx", "item_idx").toPandas()
+       user_idx  item_idx
+    0         2         2
+    1         2         3
+    2         3         2
+    3         3         3
+    >>> k_core_filter.iterations
+    2
+    >>> k_core_filter.removed_rows
+    [1, 1]
+    """
+
+    def __init__(
+        self,
+        min_user_entries: int = 1,
+        min_item_entries: int = 1,
+        user_col: str = "user_idx",
+        item_col: str = "item_idx",
+    ):
+        """
+        :param min_user_entries: minimal number of interactions of a user
+        :param min_item_entries: minimal number of interactions of an item
+        :param user_col: user column
+        :param item_col: item column
+        """
+        self.min_user_entries = min_user_entries
+        self.min_item_entries = min_item_entries
+        self.user_col = user_col
+        self.item_col = item_col
+        self.removed_rows: List[int] = []
+
+    @property
+    def iterations(self) -> int:
+        """
+        :return: number of rounds removing interactions in the last call
+        """
+        return len(self.removed_rows)
+
+    @staticmethod
+    def _update_counts(
+        counts: DataFrame, removed: DataFrame, column: str, threshold: int
+    ) -> DataFrame:
+        removed_counts = removed.groupBy(column).agg(
+            sf.count(sf.lit(1)).alias("removed")
+        )
+        count = col("count") - sf.coalesce(col("removed"), sf.lit(0))
+        # users and items without interactions are not kept
+        return _checkpoint(
+            counts.filter(col("count") >= threshold)
+            .join(removed_counts, on=column, how="left")
+            .select(column, count.alias("count"))
+            .filter(col("count") > 0)
+        )
+
+    def transform(self, log: AnyDataFrame) -> DataFrame:
+        """
+        Get k-core of the log
+
+        :param log: historical interactions DataFrame
+        :return: filtered DataFrame
+        """
+        log = _checkpoint(convert2spark(log))
+        columns = log.columns
+        user_counts = _checkpoint(
+            log.groupBy(self.user_col).agg(sf.count(sf.lit(1)).alias("count"))
+        )
+        item_counts = _checkpoint(
+            log.groupBy(self.item_col).agg(sf.count(sf.lit(1)).alias("count"))
+        )
+        self.removed_rows = []
+        while True:
+            removed_users = user_counts.filter(
+                col("count") < self.min_user_entries
+            ).select(self.user_col, sf.lit(True).alias("_removed_user"))
+            removed_items = item_counts.filter(
+                col("count") < self.min_item_entries
+            ).select(self.item_col, sf.lit(True).alias("_removed_item"))
+            if removed_users.count() == 0 and removed_items.count() == 0:
+                return log
+
+            marked = _checkpoint(
+                log.join(removed_users, on=self.user_col, how="left")
+                .join(removed_items, on=self.item_col, how="left")
+                .select(
+                    *columns,
+                    sf.coalesce(
+                        col("_removed_user"),
+                        col("_removed_item"),
+                        sf.lit(False),
+                    ).alias("_removed"),
+                )
+            )
+            removed = marked.filter(col("_removed"))
+            self.removed_rows.append(removed.count())
+            State().logger.info(
+                "k-core iteration %s removed %s rows",
+                self.iterations,
+                self.removed_rows[-1],
+            )
+            user_counts = self._update_counts(
+                user_counts, removed, self.user_col, self.min_user_entries
+            )
+            item_counts = self._update_counts(
+                item_counts, removed, self.item_col, self.min_item_entries
+            )
+            log = marked.filter(~col("_removed")).drop("_removed")
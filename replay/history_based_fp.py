@@ -6,28 +6,60 @@ Contains classes for users' and items' features generation based on interactions
     conditioned on categorical feature value
 ``HistoryBasedFeaturesProcessor`` applies LogStatFeaturesProcessor
     and ConditionalPopularityProcessor as a pipeline.
+
+Processors keep mergeable statistics of the log, so features can be updated
+with new interactions and saved as parquet tables keyed by ``user_idx``/``item_idx``.
 """
 
+# pylint: disable=unspecified-encoding
+import json
+import os
+import shutil
+from os.path import exists, join
 from typing import Dict, Optional, List
 
 import pyspark.sql.functions as sf
 
 from datetime import datetime
-from pyspark.sql import DataFrame
+from pyspark.sql import Column, DataFrame, Window
 from pyspark.sql.types import TimestampType
 
-from replay.utils import join_or_return, ugly_join, unpersist_if_exists
+from replay.cache import CacheManager, instance_scope
+from replay.history_based_state import (
+    bin_histogram,
+    count_by_features,
+    cross_state,
+    load_params,
+    merge_days,
+    merge_states,
+    relevance_bin,
+    relevance_quantiles,
+    save_params,
+    state_aggregates,
+)
+from replay.session_handler import State
+from replay.utils import join_or_return
 
 
 class EmptyFeatureProcessor:
     """Do not perform any transformations on the dataframe"""
 
-    def fit(self, log: DataFrame, features: DataFrame) -> None:
+    def fit(
+        self, log: DataFrame, features: Optional[DataFrame] = None
+    ) -> None:
         """
         :param log: input DataFrame ``[user_idx, item_idx, timestamp, relevance]``
         :param features: DataFrame with ``user_idx/item_idx`` and feature columns
         """
 
+    def update(
+        self, log: DataFrame, features: Optional[DataFrame] = None
+    ) -> None:
+        """
+        :param log: new interactions ``[user_idx, item_idx, timestamp, relevance]``
+        :param features: DataFrame with ``user_idx/item_idx`` and feature columns
+        """
+
     # pylint: disable=no-self-use
     def transform(self, log: DataFrame) -> DataFrame:
         """
@@ -36,7 +68,33 @@ class EmptyFeatureProcessor:
         """
         return log
 
+    def save(self, path: str) -> None:
+        """
+        :param path: folder to save processor state to
+        """
 
+    def load(self, path: str) -> None:
+        """
+        :param path: folder with saved processor state
+        """
+
+    def _cache(self, dataframe: DataFrame, name: str) -> DataFrame:
+        """
+        Persist DataFrame until the processor is refitted or garbage collected
+        """
+        return CacheManager().persist(
+            dataframe, instance_scope(self), f"{type(self).__name__}.{name}"
+        )
+
+    def _release(self, *dataframes: Optional[DataFrame]) -> None:
+        for dataframe in dataframes:
+            CacheManager().release(dataframe, instance_scope(self))
+
+    def _clear_cache(self):
+        CacheManager().release_scope(instance_scope(self))
+
+
+# pylint: disable=too-many-instance-attributes
 class LogStatFeaturesProcessor(EmptyFeatureProcessor):
     """
     Calculate user and item features based on interactions log:
@@ -54,70 +112,178 @@ class LogStatFeaturesProcessor(EmptyFeatureProcessor):
 
         Based or ratings/relevance:
         - relevance mean and std
-        - relevance approximate quantiles (0.05, 0.5, 0.95)
+        - relevance quantiles (0.05, 0.5, 0.95)
         - abnormality of user's preferences https://hal.inria.fr/hal-01254172/document
+
+    Features are calculated from mergeable statistics of users and items
+    (``user_state`` and ``item_state``): number of interactions,
+    sum and sum of squares of relevance, min and max timestamp
+    and sums of features of the items interacted with and vice versa.
+    Interaction days are kept in ``user_days`` and ``item_days`` tables,
+    numbers of interactions by relevance value in ``user_relevance_hist``
+    and ``item_relevance_hist``. Histograms keep at most ``max_relevance_values``
+    values, if relevance has more distinct values, it is reduced to as many
+    equal-width bins and quantiles are approximate.
+    Bins keep the relevance range of ``fit``, relevance of new interactions
+    out of the range is counted in the edge bins.
+    ``update`` adds new interactions to the statistics
+    without reading the whole log again. Averaged features of the items
+    interacted with (and vice versa) are accumulated as of the moment
+    the interactions were added, other features are exact.
     """
 
     calc_timestamp_based: bool = False
     calc_relevance_based: bool = False
+    calc_abnormality_cr: bool = False
+    max_relevance_values: int = 100
+    relevance_range: Optional[List[float]] = None
+    relevance_values: Optional[List[float]] = None
+    user_state: Optional[DataFrame] = None
+    item_state: Optional[DataFrame] = None
+    user_days: Optional[DataFrame] = None
+    item_days: Optional[DataFrame] = None
+    user_relevance_hist: Optional[DataFrame] = None
+    item_relevance_hist: Optional[DataFrame] = None
     user_log_features: Optional[DataFrame] = None
     item_log_features: Optional[DataFrame] = None
 
-    def _create_log_aggregates(self, agg_col: str = "user_idx") -> List:
+    def _cross_columns(self, entity: str) -> List[str]:
         """
-        Create features based on relevance type
-        (binary or not) and whether timestamp is present.
-        :param agg_col: column to create features for, user_idx or item_idx
-        :return: list of columns to pass into pyspark agg
+        :param entity: user_idx or item_idx
+        :return: state columns with sums of features of the items
+            interacted with by user or vice versa
         """
-        prefix = agg_col[:1]
+        columns = ["cross_log_num_interact_sum"]
+        if entity == "user_idx" and self.calc_relevance_based:
+            columns.append("abnormality_sum")
+            if self.calc_abnormality_cr:
+                columns.append("abnormalityCR_sum")
+        return columns
+
+    def _state_aggregates(self, merge: bool = False) -> List[Column]:
+        return state_aggregates(
+            merge, self.calc_relevance_based, self.calc_timestamp_based
+        )
+
+    def _relevance_bin(self) -> Column:
+        return relevance_bin(self.relevance_range, self.max_relevance_values)
+
+    def _add_days_and_hist(self, log: DataFrame, entity: str) -> None:
+        """
+        Add interaction days and relevance histogram of new interactions
+        to ``<user/item>_days`` and ``<user/item>_relevance_hist``
 
-        aggregates = [
-            sf.log(sf.count(sf.col("relevance"))).alias(
-                f"{prefix}_log_num_interact"
+        :param log: new interactions
+        :param entity: user_idx or item_idx
+        """
+        name = entity.split("_", maxsplit=1)[0]
+        if self.calc_timestamp_based:
+            days = merge_days(getattr(self, f"{name}_days"), log, entity)
+            setattr(self, f"{name}_days", self._cache(days, f"{name}_days"))
+        if self.calc_relevance_based:
+            hist = bin_histogram(
+                log.filter(sf.col("relevance").isNotNull()).withColumn(
+                    "num_interact", sf.lit(1)
+                ),
+                entity,
+                self._relevance_bin(),
+            )
+            previous = getattr(self, f"{name}_relevance_hist")
+            if previous is not None:
+                hist = bin_histogram(
+                    previous.unionByName(hist), entity, sf.col("relevance")
+                )
+            setattr(
+                self,
+                f"{name}_relevance_hist",
+                self._cache(hist, f"{name}_relevance_hist"),
             )
+
+    def _features_from_state(
+        self, state: DataFrame, entity: str, with_cross: bool = True
+    ) -> DataFrame:
+        """
+        Create features based on relevance type
+        (binary or not) and whether timestamp is present.
+
+        :param state: statistics of an entity
+        :param entity: user_idx or item_idx
+        :param with_cross: calculate averaged features of the items
+            interacted with by user or vice versa
+        :return: features dataframe
+        """
+        prefix = entity[0]
+        name = entity.split("_", maxsplit=1)[0]
+        columns = [
+            sf.col(entity),
+            sf.log("num_interact").alias(f"{prefix}_log_num_interact"),
         ]
 
         if self.calc_timestamp_based:
-            aggregates.extend(
+            columns.extend(
                 [
-                    sf.log(
-                        sf.countDistinct(
-                            sf.date_trunc("dd", sf.col("timestamp"))
-                        )
-                    ).alias(f"{prefix}_log_interact_days_count"),
-                    sf.min(sf.col("timestamp")).alias(
+                    sf.col("min_interact_date").alias(
                         f"{prefix}_min_interact_date"
                     ),
-                    sf.max(sf.col("timestamp")).alias(
+                    sf.col("max_interact_date").alias(
                         f"{prefix}_max_interact_date"
                     ),
                 ]
             )
 
         if self.calc_relevance_based:
-            aggregates.extend(
+            mean = sf.col("relevance_sum") / sf.col("num_interact")
+            # sample variance, null for a single interaction
+            variance = (
+                sf.col("relevance_sq_sum") - sf.col("relevance_sum") * mean
+            ) / (sf.col("num_interact") - 1)
+            std = sf.sqrt(sf.greatest(variance, sf.lit(0.0)))
+            columns.extend(
                 [
-                    (
-                        sf.when(
-                            sf.stddev(sf.col("relevance")).isNull()
-                            | sf.isnan(sf.stddev(sf.col("relevance"))),
-                            0,
-                        )
-                        .otherwise(sf.stddev(sf.col("relevance")))
-                        .alias(f"{prefix}_std")
-                    ),
-                    sf.mean(sf.col("relevance")).alias(f"{prefix}_mean"),
+                    mean.alias(f"{prefix}_mean"),
+                    sf.when(std.isNull() | sf.isnan(std), 0)
+                    .otherwise(std)
+                    .alias(f"{prefix}_std"),
+                ]
+            )
+
+        if with_cross:
+            other_prefix = "i" if entity == "user_idx" else "u"
+            names = {
+                "cross_log_num_interact_sum": (
+                    f"{prefix}_mean_{other_prefix}_log_num_interact"
+                ),
+                "abnormality_sum": "abnormality",
+                "abnormalityCR_sum": "abnormalityCR",
+            }
+            columns.extend(
+                [
+                    (sf.col(col) / sf.col("num_interact")).alias(names[col])
+                    for col in self._cross_columns(entity)
                 ]
             )
-            for percentile in [0.05, 0.5, 0.95]:
-                aggregates.append(
-                    sf.expr(
-                        f"percentile_approx(relevance, {percentile})"
-                    ).alias(f"{prefix}_quantile_{str(percentile)[2:]}")
-                )
 
-        return aggregates
+        features = state.select(*columns)
+        if self.calc_timestamp_based:
+            days = (
+                getattr(self, f"{name}_days")
+                .groupBy(entity)
+                .agg(
+                    sf.log(sf.count("day")).alias(
+                        f"{prefix}_log_interact_days_count"
+                    )
+                )
+            )
+            features = features.join(days, on=entity, how="left")
+        if self.calc_relevance_based:
+            features = features.join(
+                relevance_quantiles(
+                    getattr(self, f"{name}_relevance_hist"), entity
+                ),
+                on=entity,
+                how="left",
+            )
+        return features
 
     @staticmethod
     def _add_ts_based(
@@ -145,84 +311,121 @@ class LogStatFeaturesProcessor(EmptyFeatureProcessor):
             ),
         )
 
-    @staticmethod
-    def _cals_cross_interactions_count(
-        log: DataFrame, features: DataFrame
-    ) -> DataFrame:
+    def _add_log(self, log: DataFrame) -> None:
         """
-        Calculate difference between the log number of interactions by the user
-        and average log number of interactions users interacted with the item has.
+        Add interactions to the statistics and recalculate features.
+        Previous statistics and features are released.
 
-        :param log: dataframe with calculated log-based features
-        :param features: dataframe with calculated log-based features
-        :return: features dataframe with new columns
+        :param log: input DataFrame ``[user_idx, item_idx, timestamp, relevance]``
         """
-        if "user_idx" in features.columns:
-            new_feature_entity, calc_by_entity = "item_idx", "user_idx"
-        else:
-            new_feature_entity, calc_by_entity = "user_idx", "item_idx"
+        previous = [getattr(self, name) for name in self._state_names]
+        merged = {}
+        for entity, state in [
+            ("user_idx", self.user_state),
+            ("item_idx", self.item_state),
+        ]:
+            delta = log.groupBy(entity).agg(*self._state_aggregates())
+            if state is not None:
+                delta = merge_states(
+                    state,
+                    delta,
+                    entity,
+                    self._state_aggregates(merge=True),
+                    self._cross_columns(entity),
+                )
+            merged[entity] = self._cache(delta, f"{entity[0]}_merged_state")
+            self._add_days_and_hist(log, entity)
 
-        mean_log_num_interact = log.join(
-            features.select(
-                calc_by_entity, f"{calc_by_entity[0]}_log_num_interact"
+        user_stats = self._features_from_state(
+            merged["user_idx"], "user_idx", with_cross=False
+        )
+        item_stats = self._cache(
+            self._features_from_state(
+                merged["item_idx"], "item_idx", with_cross=False
             ),
-            on=calc_by_entity,
-            how="left",
+            "item_stats",
         )
-        return mean_log_num_interact.groupBy(new_feature_entity).agg(
-            sf.mean(f"{calc_by_entity[0]}_log_num_interact").alias(
-                f"{new_feature_entity[0]}_mean_{calc_by_entity[0]}_log_num_interact"
+        std_range = None
+        if self.calc_relevance_based:
+            std_range = list(
+                item_stats.agg(sf.min("i_std"), sf.max("i_std")).first()
             )
-        )
+            if self.user_state is None:
+                self.calc_abnormality_cr = std_range[1] - std_range[0] != 0
+
+        cross = {
+            "user_idx": cross_state(
+                log,
+                item_stats,
+                "user_idx",
+                self._cross_columns("user_idx"),
+                std_range,
+            ),
+            "item_idx": cross_state(
+                log, user_stats, "item_idx", self._cross_columns("item_idx")
+            ),
+        }
+        for entity in ["user_idx", "item_idx"]:
+            cross_columns = self._cross_columns(entity)
+            state = merged[entity].join(
+                cross[entity],
+                on=sf.col(entity) == sf.col(f"{entity}_delta"),
+                how="left",
+            )
+            state = state.select(
+                *[
+                    col
+                    for col in merged[entity].columns
+                    if col not in cross_columns
+                ],
+                *[
+                    (
+                        (
+                            sf.col(col)
+                            if col in merged[entity].columns
+                            else sf.lit(0.0)
+                        )
+                        + sf.coalesce(sf.col(f"{col}_delta"), sf.lit(0.0))
+                    ).alias(col)
+                    for col in cross_columns
+                ],
+            )
+            name = f"{entity.split('_', maxsplit=1)[0]}_state"
+            setattr(self, name, self._cache(state, name))
 
-    @staticmethod
-    def _calc_abnormality(
-        log: DataFrame, item_features: DataFrame
-    ) -> DataFrame:
+        # materialize new statistics before previous ones are released,
+        # features are calculated from them below
+        for name in self._state_names[:-2]:
+            getattr(self, name).count()
+        self._release(item_stats, *merged.values(), *previous)
+        self._set_features()
+
+    def _set_features(self) -> None:
         """
-        Calculate  discrepancy between a rating on a resource
-        and the average rating of this resource (Abnormality) and
-        abnormality taking controversy of the item into account (AbnormalityCR).
-        https://hal.inria.fr/hal-01254172/document
-
-        :param log: dataframe with calculated log-based features
-        :param item_features: dataframe with calculated log-based features
-        :return: features dataframe with new columns
-        """
-        # Abnormality
-        abnormality_df = ugly_join(
-            left=log,
-            right=item_features.select("item_idx", "i_mean", "i_std"),
-            on_col_name="item_idx",
-            how="left",
+        Calculate features from ``user_state`` and ``item_state``
+        """
+        user_log_features = self._features_from_state(
+            self.user_state, "user_idx"
         )
-        abnormality_df = abnormality_df.withColumn(
-            "abnormality", sf.abs(sf.col("relevance") - sf.col("i_mean"))
+        item_log_features = self._features_from_state(
+            self.item_state, "item_idx"
         )
-
-        abnormality_aggs = [
-            sf.mean(sf.col("abnormality")).alias("abnormality")
-        ]
-
-        # Abnormality CR:
-        max_std = item_features.select(sf.max("i_std")).collect()[0][0]
-        min_std = item_features.select(sf.min("i_std")).collect()[0][0]
-        if max_std - min_std != 0:
-            abnormality_df = abnormality_df.withColumn(
-                "controversy",
-                1
-                - (sf.col("i_std") - sf.lit(min_std))
-                / (sf.lit(max_std - min_std)),
-            )
-            abnormality_df = abnormality_df.withColumn(
-                "abnormalityCR",
-                (sf.col("abnormality") * sf.col("controversy")) ** 2,
+        if self.calc_timestamp_based:
+            last_date = self.user_state.agg(
+                sf.max("max_interact_date")
+            ).first()[0]
+            user_log_features = self._add_ts_based(
+                features=user_log_features, max_log_date=last_date, prefix="u"
             )
-            abnormality_aggs.append(
-                sf.mean(sf.col("abnormalityCR")).alias("abnormalityCR")
+            item_log_features = self._add_ts_based(
+                features=item_log_features, max_log_date=last_date, prefix="i"
             )
-
-        return abnormality_df.groupBy("user_idx").agg(*abnormality_aggs)
+        self.user_log_features = self._cache(
+            user_log_features, "user_log_features"
+        )
+        self.item_log_features = self._cache(
+            item_log_features, "item_log_features"
+        )
 
     def fit(
         self, log: DataFrame, features: Optional[DataFrame] = None
@@ -233,60 +436,164 @@ class LogStatFeaturesProcessor(EmptyFeatureProcessor):
          :param log: input DataFrame ``[user_idx, item_idx, timestamp, relevance]``
          :param features: not required
         """
-        self.calc_timestamp_based = (
-            isinstance(log.schema["timestamp"].dataType, TimestampType)
-        ) & (
-            log.select(sf.countDistinct(sf.col("timestamp"))).collect()[0][0]
-            > 1
-        )
-        self.calc_relevance_based = (
-            log.select(sf.countDistinct(sf.col("relevance"))).collect()[0][0]
-            > 1
+        self._clear_cache()
+        self.user_state, self.item_state = None, None
+        self.user_days, self.item_days = None, None
+        self.user_relevance_hist, self.item_relevance_hist = None, None
+        self.user_log_features, self.item_log_features = None, None
+        # countDistinct(...) > 1 is the same as min != max
+        log_stats = log.agg(
+            (sf.min("timestamp") != sf.max("timestamp")).alias("ts_varies"),
+            sf.min("relevance").alias("min_relevance"),
+            sf.max("relevance").alias("max_relevance"),
+        ).first()
+        self.calc_timestamp_based = isinstance(
+            log.schema["timestamp"].dataType, TimestampType
+        ) and bool(log_stats["ts_varies"])
+        self.calc_relevance_based = bool(
+            log_stats["min_relevance"] != log_stats["max_relevance"]
         )
+        self.calc_abnormality_cr = False
+        self.relevance_range, self.relevance_values = None, None
+        if self.calc_relevance_based:
+            values = self._distinct_relevance(log)
+            if len(values) > self.max_relevance_values:
+                State().logger.warning(
+                    "Relevance has more than %s distinct values, "
+                    "relevance quantiles are approximated "
+                    "with a histogram of equal-width bins",
+                    self.max_relevance_values,
+                )
+                self.relevance_range = [
+                    float(log_stats["min_relevance"]),
+                    float(log_stats["max_relevance"]),
+                ]
+            else:
+                self.relevance_values = values
+        self._add_log(log)
 
-        user_log_features = log.groupBy("user_idx").agg(
-            *self._create_log_aggregates(agg_col="user_idx")
+    def _distinct_relevance(self, log: DataFrame) -> List[float]:
+        """
+        :param log: interactions
+        :return: at most ``max_relevance_values + 1``
+            distinct relevance values
+        """
+        return sorted(
+            float(row[0])
+            for row in log.select("relevance")
+            .dropna()
+            .distinct()
+            .limit(self.max_relevance_values + 1)
+            .collect()
         )
-        item_log_features = log.groupBy("item_idx").agg(
-            *self._create_log_aggregates(agg_col="item_idx")
+
+    def update(
+        self, log: DataFrame, features: Optional[DataFrame] = None
+    ) -> None:
+        """
+        Add new interactions to the statistics and recalculate features.
+        Set of features is defined by the log passed to ``fit``.
+
+        If relevance histograms become longer than ``max_relevance_values``,
+        they are reduced to equal-width bins between min and max relevance
+        of the previous and new interactions.
+        Binned histograms keep the range, relevance of new interactions
+        out of ``relevance_range`` is counted in the edge bins.
+
+         :param log: new interactions ``[user_idx, item_idx, timestamp, relevance]``
+         :param features: not required
+        """
+        if self.user_state is None:
+            raise AttributeError("Call fit before running update")
+        binned = []
+        if self.relevance_values is not None:
+            values = sorted(
+                set(self.relevance_values) | set(self._distinct_relevance(log))
+            )
+            if len(values) > self.max_relevance_values:
+                binned = self._reduce_to_bins(log)
+            else:
+                self.relevance_values = values
+        self._add_log(log)
+        self._release(*binned)
+
+    def _reduce_to_bins(self, log: DataFrame) -> List[DataFrame]:
+        """
+        Set ``relevance_range`` and reduce exact relevance histograms to bins
+
+        :param log: new interactions
+        :return: exact histograms to release when binned ones are cached
+        """
+        State().logger.warning(
+            "New interactions have relevance values unseen in fit, "
+            "relevance histograms with more than %s values "
+            "are reduced to equal-width bins",
+            self.max_relevance_values,
         )
+        log_range = log.agg(sf.min("relevance"), sf.max("relevance")).first()
+        self.relevance_range = [
+            min(self.relevance_values[0], float(log_range[0])),
+            max(self.relevance_values[-1], float(log_range[1])),
+        ]
+        self.relevance_values = None
+        exact = []
+        for entity in ["user_idx", "item_idx"]:
+            name = f"{entity.split('_', maxsplit=1)[0]}_relevance_hist"
+            exact.append(getattr(self, name))
+            setattr(
+                self,
+                name,
+                bin_histogram(exact[-1], entity, self._relevance_bin()),
+            )
+        return exact
 
-        if self.calc_timestamp_based:
-            last_date = log.select(sf.max("timestamp")).collect()[0][0]
-            user_log_features = self._add_ts_based(
-                features=user_log_features, max_log_date=last_date, prefix="u"
+    def save(self, path: str) -> None:
+        """
+        Save statistics and features to parquet files
+        ``user_state``, ``item_state``, ``user_days``, ``item_days``,
+        ``user_relevance_hist``, ``item_relevance_hist``,
+        ``user_log_features`` and ``item_log_features``
+
+        :param path: folder to save processor state to
+        """
+        save_params(
+            path,
+            {
+                "calc_timestamp_based": self.calc_timestamp_based,
+                "calc_relevance_based": self.calc_relevance_based,
+                "calc_abnormality_cr": self.calc_abnormality_cr,
+                "relevance_range": self.relevance_range,
+                "relevance_values": self.relevance_values,
+            },
+        )
+        for name in self._state_names:
+            getattr(self, name).write.mode("overwrite").parquet(
+                join(path, name)
             )
 
-            item_log_features = self._add_ts_based(
-                features=item_log_features, max_log_date=last_date, prefix="i"
+    def load(self, path: str) -> None:
+        """
+        :param path: folder with saved processor state
+        """
+        self._clear_cache()
+        for param, value in load_params(path).items():
+            setattr(self, param, value)
+        spark = State().session
+        for name in self._state_names:
+            setattr(
+                self,
+                name,
+                self._cache(spark.read.parquet(join(path, name)), name),
             )
 
+    @property
+    def _state_names(self) -> List[str]:
+        names = ["user_state", "item_state"]
+        if self.calc_timestamp_based:
+            names.extend(["user_days", "item_days"])
         if self.calc_relevance_based:
-            user_log_features = user_log_features.join(
-                self._calc_abnormality(
-                    log=log, item_features=item_log_features
-                ),
-                on="user_idx",
-                how="left",
-            ).cache()
-
-        self.user_log_features = ugly_join(
-            left=user_log_features,
-            right=self._cals_cross_interactions_count(
-                log=log, features=item_log_features
-            ),
-            on_col_name="user_idx",
-            how="left",
-        ).cache()
-
-        self.item_log_features = ugly_join(
-            left=item_log_features,
-            right=self._cals_cross_interactions_count(
-                log=log, features=user_log_features
-            ),
-            on_col_name="item_idx",
-            how="left",
-        ).cache()
+            names.extend(["user_relevance_hist", "item_relevance_hist"])
+        return names + ["user_log_features", "item_log_features"]
 
     def transform(self, log: DataFrame) -> DataFrame:
         """
@@ -340,10 +647,6 @@ class LogStatFeaturesProcessor(EmptyFeatureProcessor):
 
         return joined
 
-    def __del__(self):
-        unpersist_if_exists(self.user_log_features)
-        unpersist_if_exists(self.item_log_features)
-
 
 class ConditionalPopularityProcessor(EmptyFeatureProcessor):
     """
@@ -353,6 +656,7 @@ class ConditionalPopularityProcessor(EmptyFeatureProcessor):
     """
 
     conditional_pop_dict: Optional[Dict[str, DataFrame]]
+    conditional_pop: Optional[DataFrame] = None
     entity_name: str
 
     def __init__(
@@ -365,14 +669,21 @@ class ConditionalPopularityProcessor(EmptyFeatureProcessor):
         """
         self.cat_features_list = cat_features_list
 
-    def fit(self, log: DataFrame, features: DataFrame) -> None:
+    def _count_by_features(
+        self, log: DataFrame, features: Optional[DataFrame]
+    ) -> DataFrame:
         """
-        Calculate conditional popularity for id and categorical features
-        defined in `cat_features_list`
+        Count interactions of each entity with each categorical feature value
 
         :param log: input DataFrame ``[user_idx, item_idx, timestamp, relevance]``
         :param features: DataFrame with ``user_idx/item_idx`` and feature columns
+        :return: counts ``[entity, grouping_set_id, <cat features>, conditional_count]``
         """
+        if features is None:
+            raise ValueError(
+                "Features with `cat_features_list` columns are required "
+                "to calculate conditional popularity"
+            )
         if len(
             set(self.cat_features_list).intersection(features.columns)
         ) != len(self.cat_features_list):
@@ -387,29 +698,105 @@ class ConditionalPopularityProcessor(EmptyFeatureProcessor):
             if "item_idx" in features.columns
             else ("user_idx", "item_idx")
         )
-
-        self.conditional_pop_dict = {}
         log_with_features = log.join(features, on=join_col, how="left")
+
+        return count_by_features(
+            log_with_features, self.entity_name, self.cat_features_list
+        )
+
+    def _set_popularity(self, counts: DataFrame) -> None:
+        """
+        Calculate conditional popularity from interaction counts
+
+        :param counts: output of ``_count_by_features``
+        """
         count_by_entity_col_name = f"count_by_{self.entity_name}"
+        conditional_pop = counts.withColumn(
+            count_by_entity_col_name,
+            sf.sum("conditional_count").over(
+                Window.partitionBy(self.entity_name, "grouping_set_id")
+            ),
+        ).withColumn(
+            "conditional_pop",
+            sf.col("conditional_count") / sf.col(count_by_entity_col_name),
+        )
+        self.conditional_pop = self._cache(conditional_pop, "conditional_pop")
+
+        self.conditional_pop_dict = {}
+        for set_id, cat_col in enumerate(self.cat_features_list):
+            self.conditional_pop_dict[cat_col] = self.conditional_pop.filter(
+                sf.col("grouping_set_id") == set_id
+            ).select(
+                self.entity_name,
+                cat_col,
+                sf.col("conditional_pop").alias(
+                    f"{self.entity_name[0]}_pop_by_{cat_col}"
+                ),
+            )
 
-        count_by_entity_col = log_with_features.groupBy(self.entity_name).agg(
-            sf.count("relevance").alias(count_by_entity_col_name)
+    def fit(
+        self, log: DataFrame, features: Optional[DataFrame] = None
+    ) -> None:
+        """
+        Calculate conditional popularity for id and categorical features
+        defined in `cat_features_list`
+
+        :param log: input DataFrame ``[user_idx, item_idx, timestamp, relevance]``
+        :param features: DataFrame with ``user_idx/item_idx`` and feature columns
+        """
+        counts = self._count_by_features(log, features)
+        self._clear_cache()
+        self._set_popularity(counts)
+
+    def update(
+        self, log: DataFrame, features: Optional[DataFrame] = None
+    ) -> None:
+        """
+        Add new interactions to the counts and recalculate conditional popularity
+
+        :param log: new interactions ``[user_idx, item_idx, timestamp, relevance]``
+        :param features: DataFrame with ``user_idx/item_idx`` and feature columns
+        """
+        if self.conditional_pop is None:
+            raise AttributeError("Call fit before running update")
+        previous = self.conditional_pop
+        keys = [self.entity_name, "grouping_set_id", *self.cat_features_list]
+        counts = (
+            previous.select(*keys, "conditional_count")
+            .unionByName(self._count_by_features(log, features))
+            .groupBy(*keys)
+            .agg(sf.sum("conditional_count").alias("conditional_count"))
         )
+        self._set_popularity(counts)
+        # materialize new popularity before previous one is released
+        self.conditional_pop.count()
+        self._release(previous)
 
-        for cat_col in self.cat_features_list:
-            col_name = f"{self.entity_name[0]}_pop_by_{cat_col}"
-            intermediate_df = log_with_features.groupBy(
-                self.entity_name, cat_col
-            ).agg(sf.count("relevance").alias(col_name))
-            intermediate_df = intermediate_df.join(
-                sf.broadcast(count_by_entity_col),
-                on=self.entity_name,
-                how="left",
+    def save(self, path: str) -> None:
+        """
+        Save interaction counts and popularity to parquet file ``conditional_pop``
+
+        :param path: folder to save processor state to
+        """
+        save_params(path, {"entity_name": self.entity_name})
+        self.conditional_pop.write.mode("overwrite").parquet(
+            join(path, "conditional_pop")
+        )
+
+    def load(self, path: str) -> None:
+        """
+        :param path: folder with saved processor state
+        """
+        self._clear_cache()
+        self.entity_name = load_params(path)["entity_name"]
+        conditional_pop = State().session.read.parquet(
+            join(path, "conditional_pop")
+        )
+        self._set_popularity(
+            conditional_pop.drop(
+                f"count_by_{self.entity_name}", "conditional_pop"
             )
-            self.conditional_pop_dict[cat_col] = intermediate_df.withColumn(
-                col_name, sf.col(col_name) / sf.col(count_by_entity_col_name)
-            ).drop(count_by_entity_col_name)
-            self.conditional_pop_dict[cat_col].cache()
+        )
 
     def transform(self, log: DataFrame) -> DataFrame:
         """
@@ -440,10 +827,6 @@ class ConditionalPopularityProcessor(EmptyFeatureProcessor):
             joined = joined.fillna({f"{self.entity_name[0]}_pop_by_{key}": 0})
         return joined
 
-    def __del__(self):
-        for df in self.conditional_pop_dict.values():
-            unpersist_if_exists(df)
-
 
 # pylint: disable=too-many-instance-attributes, too-many-arguments
 class HistoryBasedFeaturesProcessor:
@@ -456,7 +839,7 @@ class HistoryBasedFeaturesProcessor:
     for detailed description of generated features.
     """
 
-    log_proc = EmptyFeatureProcessor()
+    log_processor = EmptyFeatureProcessor()
     user_cond_pop_proc = EmptyFeatureProcessor()
     item_cond_pop_proc = EmptyFeatureProcessor()
 
@@ -477,6 +860,12 @@ class HistoryBasedFeaturesProcessor:
         :param item_cat_features_list: list of item categorical features
             used to calculate user conditional popularity features
         """
+        self._init_args = {
+            "use_log_features": use_log_features,
+            "use_conditional_popularity": use_conditional_popularity,
+            "user_cat_features_list": user_cat_features_list,
+            "item_cat_features_list": item_cat_features_list,
+        }
         if use_log_features:
             self.log_processor = LogStatFeaturesProcessor()
         if use_conditional_popularity and user_cat_features_list:
@@ -503,12 +892,74 @@ class HistoryBasedFeaturesProcessor:
         :param user_features: DataFrame with ``user_idx`` and feature columns
         :param item_features: DataFrame with ``item_idx`` and feature columns
         """
-        log = log.cache()
+        scope = instance_scope(self)
+        log = CacheManager().persist(
+            log, scope, "HistoryBasedFeaturesProcessor.log"
+        )
         self.log_processor.fit(log=log)
         self.user_cond_pop_proc.fit(log=log, features=user_features)
         self.item_cond_pop_proc.fit(log=log, features=item_features)
         self.fitted = True
-        log.unpersist()
+        CacheManager().release(log, scope)
+
+    def update(
+        self,
+        log: DataFrame,
+        user_features: Optional[DataFrame] = None,
+        item_features: Optional[DataFrame] = None,
+    ) -> None:
+        """
+        Update features with new interactions without reading
+        the whole history again.
+
+        :param log: new interactions ``[user_idx, item_idx, timestamp, relevance]``
+        :param user_features: DataFrame with ``user_idx`` and feature columns
+        :param item_features: DataFrame with ``item_idx`` and feature columns
+        """
+        if not self.fitted:
+            raise AttributeError("Call fit before running update")
+        scope = instance_scope(self)
+        log = CacheManager().persist(
+            log, scope, "HistoryBasedFeaturesProcessor.log"
+        )
+        self.log_processor.update(log=log)
+        self.user_cond_pop_proc.update(log=log, features=user_features)
+        self.item_cond_pop_proc.update(log=log, features=item_features)
+        CacheManager().release(log, scope)
+
+    def save(self, path: str) -> None:
+        """
+        Save fitted processor to disk as a folder.
+        Features and statistics are stored as parquet files.
+
+        :param path: destination folder
+        """
+        if not self.fitted:
+            raise AttributeError("Call fit before running save")
+        if exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        with open(join(path, "init_args.json"), "w") as json_file:
+            json.dump(self._init_args, json_file)
+        self.log_processor.save(join(path, "log_processor"))
+        self.user_cond_pop_proc.save(join(path, "user_cond_pop_proc"))
+        self.item_cond_pop_proc.save(join(path, "item_cond_pop_proc"))
+
+    @classmethod
+    def load(cls, path: str) -> "HistoryBasedFeaturesProcessor":
+        """
+        Load saved processor from disk
+
+        :param path: folder with saved processor
+        :return: fitted processor which can be updated
+        """
+        with open(join(path, "init_args.json"), "r") as json_file:
+            processor = cls(**json.load(json_file))
+        processor.log_processor.load(join(path, "log_processor"))
+        processor.user_cond_pop_proc.load(join(path, "user_cond_pop_proc"))
+        processor.item_cond_pop_proc.load(join(path, "item_cond_pop_proc"))
+        processor.fitted = True
+        return processor
 
     def transform(
         self,
@@ -0,0 +1,347 @@
+"""
+Mergeable statistics of interactions kept by history based features processors
+(see ``replay.history_based_fp``) and helpers to persist
+processors' parameters.
+
+Statistics of an entity (``user_idx`` or ``item_idx``) are kept as a state
+with a row per entity, as a table of interaction days
+and as a histogram of relevance values ``[entity, relevance, num_interact]``.
+All of them are merged with statistics of new interactions by aggregation.
+"""
+
+import json
+import os
+from os.path import join
+from typing import Dict, List, Optional
+
+import pyspark.sql.functions as sf
+from pyspark.sql import Column, DataFrame
+
+from replay.utils import ugly_join
+
+QUANTILES = [0.05, 0.5, 0.95]
+
+
+def save_params(path: str, params: Dict) -> None:
+    """
+    Save processor parameters to ``params.json``
+
+    :param path: folder to save processor state to
+    :param params: json serializable parameters
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(join(path, "params.json"), "w", encoding="utf-8") as json_file:
+        json.dump(params, json_file)
+
+
+def load_params(path: str) -> Dict:
+    """
+    :param path: folder with saved processor state
+    :return: parameters saved with ``save_params``
+    """
+    with open(join(path, "params.json"), "r", encoding="utf-8") as json_file:
+        return json.load(json_file)
+
+
+def state_aggregates(
+    merge: bool, relevance_based: bool, timestamp_based: bool
+) -> List[Column]:
+    """
+    Statistics of interactions with the same user/item.
+
+    :param merge: aggregate states if ``True`` and log otherwise
+    :param relevance_based: add sum and sum of squares of relevance
+    :param timestamp_based: add min and max timestamp
+    :return: list of columns to pass into pyspark agg
+    """
+    if merge:
+        aggregates = [sf.sum("num_interact").alias("num_interact")]
+    else:
+        aggregates = [sf.count("relevance").alias("num_interact")]
+
+    if relevance_based:
+        if merge:
+            relevance_sum = sf.sum("relevance_sum")
+            relevance_sq_sum = sf.sum("relevance_sq_sum")
+        else:
+            relevance = sf.col("relevance").cast("double")
+            relevance_sum = sf.sum(relevance)
+            relevance_sq_sum = sf.sum(relevance * relevance)
+        aggregates.extend(
+            [
+                relevance_sum.alias("relevance_sum"),
+                relevance_sq_sum.alias("relevance_sq_sum"),
+            ]
+        )
+
+    if timestamp_based:
+        if merge:
+            min_date, max_date = "min_interact_date", "max_interact_date"
+        else:
+            min_date, max_date = "timestamp", "timestamp"
+        aggregates.extend(
+            [
+                sf.min(min_date).alias("min_interact_date"),
+                sf.max(max_date).alias("max_interact_date"),
+            ]
+        )
+
+    return aggregates
+
+
+def merge_states(
+    state: DataFrame,
+    delta: DataFrame,
+    entity: str,
+    aggregates: List[Column],
+    cross_columns: List[str],
+) -> DataFrame:
+    """
+    :param state: statistics of an entity
+    :param delta: statistics of new interactions of an entity
+        without ``cross_columns``
+    :param entity: user_idx or item_idx
+    :param aggregates: ``state_aggregates`` with ``merge=True``
+    :param cross_columns: state columns with sums of features
+        of the counterparts, they are summed up
+    :return: merged statistics
+    """
+    return (
+        state.unionByName(
+            delta.select(
+                *[col for col in state.columns if col not in cross_columns],
+                *[sf.lit(0.0).alias(col) for col in cross_columns],
+            )
+        )
+        .groupBy(entity)
+        .agg(
+            *aggregates,
+            *[sf.sum(col).alias(col) for col in cross_columns],
+        )
+    )
+
+
+def cross_state(
+    log: DataFrame,
+    features: DataFrame,
+    entity: str,
+    cross_columns: List[str],
+    std_range: Optional[List[float]] = None,
+) -> DataFrame:
+    """
+    Sum features of the items interacted with by user or vice versa:
+    log number of interactions, discrepancy between a rating on a resource
+    and the average rating of this resource (Abnormality) and
+    abnormality taking controversy of the item into account (AbnormalityCR).
+    https://hal.inria.fr/hal-01254172/document
+
+    :param log: new interactions
+    :param features: features of the items interacted with or vice versa
+    :param entity: user_idx or item_idx
+    :param cross_columns: state columns to calculate,
+        ``cross_log_num_interact_sum``, ``abnormality_sum``
+        and ``abnormalityCR_sum``
+    :param std_range: min and max relevance std of items
+    :return: sums of features by entity
+        with ``_delta`` suffix in column names
+    """
+    other = "item_idx" if entity == "user_idx" else "user_idx"
+    columns = [other, f"{other[0]}_log_num_interact"]
+    aggregates = [
+        sf.sum(f"{other[0]}_log_num_interact").alias(
+            "cross_log_num_interact_sum"
+        )
+    ]
+    if "abnormality_sum" in cross_columns:
+        columns.extend(["i_mean", "i_std"])
+        abnormality = sf.abs(sf.col("relevance") - sf.col("i_mean"))
+        aggregates.append(sf.sum(abnormality).alias("abnormality_sum"))
+    if "abnormalityCR_sum" in cross_columns:
+        min_std, max_std = std_range
+        controversy = (
+            1 - (sf.col("i_std") - sf.lit(min_std)) / sf.lit(max_std - min_std)
+            if max_std - min_std != 0
+            else sf.lit(1.0)
+        )
+        aggregates.append(
+            sf.sum((abnormality * controversy) ** 2).alias("abnormalityCR_sum")
+        )
+
+    state = (
+        ugly_join(
+            left=log,
+            right=features.select(*columns),
+            on_col_name=other,
+            how="left",
+        )
+        .groupBy(entity)
+        .agg(*aggregates)
+    )
+    return state.select(
+        *[
+            sf.col(col).alias(f"{col}_delta")
+            for col in [entity] + cross_columns
+        ]
+    )
+
+
+def merge_days(
+    previous: Optional[DataFrame], log: DataFrame, entity: str
+) -> DataFrame:
+    """
+    :param previous: interaction days ``[entity, day]`` or ``None``
+    :param log: new interactions
+    :param entity: user_idx or item_idx
+    :return: distinct interaction days ``[entity, day]``
+    """
+    days = log.select(
+        entity, sf.date_trunc("dd", sf.col("timestamp")).alias("day")
+    )
+    if previous is not None:
+        days = previous.unionByName(days)
+    return days.distinct()
+
+
+def relevance_bin(
+    relevance_range: Optional[List[float]], num_bins: int
+) -> Column:
+    """
+    Relevance value kept in the histogram.
+    If ``relevance_range`` is set, relevance is reduced to the center
+    of one of ``num_bins`` equal-width bins,
+    values out of the range fall into the edge bins.
+
+    :param relevance_range: min and max relevance or ``None``
+        to keep exact values
+    :param num_bins: number of bins
+    :return: relevance column
+    """
+    relevance = sf.col("relevance").cast("double")
+    if relevance_range is None:
+        return relevance
+    min_value, max_value = relevance_range
+    width = (max_value - min_value) / num_bins
+    bin_idx = sf.least(
+        sf.greatest(
+            sf.floor((relevance - sf.lit(min_value)) / width), sf.lit(0)
+        ),
+        sf.lit(num_bins - 1),
+    )
+    return sf.lit(min_value) + (bin_idx + 0.5) * width
+
+
+def bin_histogram(
+    hist: DataFrame, entity: str, relevance: Column
+) -> DataFrame:
+    """
+    Sum numbers of interactions by entity and relevance value.
+    Used to add up histograms and to reduce them to bins.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> hist = spark.createDataFrame(
+    ...     [(1, 1.0, 2), (1, 2.0, 1), (1, 4.0, 1)],
+    ...     schema="user_idx int, relevance double, num_interact long",
+    ... )
+    >>> binned = bin_histogram(
+    ...     hist, "user_idx", relevance_bin([1.0, 4.0], 2)
+    ... )
+    >>> binned.orderBy("relevance").show()
+    +--------+---------+------------+
+    |user_idx|relevance|num_interact|
+    +--------+---------+------------+
+    |       1|     1.75|           3|
+    |       1|     3.25|           1|
+    +--------+---------+------------+
+    <BLANKLINE>
+
+    :param hist: ``[entity, relevance, num_interact]``
+    :param entity: user_idx or item_idx
+    :param relevance: relevance value to group by, e.g. ``relevance_bin``
+    :return: histogram ``[entity, relevance, num_interact]``
+    """
+    return hist.groupBy(entity, relevance.alias("relevance")).agg(
+        sf.sum("num_interact").alias("num_interact")
+    )
+
+
+def relevance_quantiles(hist: DataFrame, entity: str) -> DataFrame:
+    """
+    Relevance quantiles from the histogram of relevance values
+
+    :param hist: ``[entity, relevance, num_interact]``
+    :param entity: user_idx or item_idx
+    :return: ``[entity, <prefix>_quantile_05, ...]``
+    """
+    hist = hist.groupBy(entity).agg(
+        sf.sum("num_interact").alias("num_interact"),
+        # relevance histogram sorted by relevance value
+        sf.array_sort(
+            sf.collect_list(sf.struct("relevance", "num_interact"))
+        ).alias("relevance_hist"),
+    )
+    # the smallest value with rank >= ceil(percentile * count),
+    # percentile_approx returns it when the number of values is small
+    return hist.select(
+        entity,
+        *[
+            sf.expr(
+                "aggregate(relevance_hist, "
+                "named_struct('rank', 0L, 'value', CAST(NULL AS DOUBLE)), "
+                "(acc, x) -> named_struct("
+                "'rank', acc.rank + x.num_interact, "
+                "'value', IF(acc.value IS NULL AND "
+                "acc.rank + x.num_interact >= "
+                f"ceil({percentile} * num_interact), "
+                "x.relevance, acc.value)), "
+                "acc -> acc.value)"
+            ).alias(f"{entity[0]}_quantile_{str(percentile)[2:]}")
+            for percentile in QUANTILES
+        ],
+    )
+
+
+def count_by_features(
+    log_with_features: DataFrame, entity: str, cat_features_list: List[str]
+) -> DataFrame:
+    """
+    Count interactions of each entity with each categorical feature value
+
+    :param log_with_features: interactions joined with categorical features
+    :param entity: user_idx or item_idx
+    :param cat_features_list: categorical feature columns
+    :return: counts ``[entity, grouping_set_id, <cat features>,
+        conditional_count]``
+    """
+    # GROUPING SETS ((entity, cat_1), (entity, cat_2), ...):
+    # each row is repeated for every categorical feature with
+    # the other features set to null, so that all popularities
+    # are counted in a single aggregation
+    grouping_sets = sf.array(
+        *[
+            sf.struct(
+                sf.lit(set_id).alias("grouping_set_id"),
+                *[
+                    (
+                        sf.col(col)
+                        if col == cat_col
+                        else sf.lit(None).cast(
+                            log_with_features.schema[col].dataType
+                        )
+                    ).alias(col)
+                    for col in cat_features_list
+                ],
+            )
+            for set_id, cat_col in enumerate(cat_features_list)
+        ]
+    )
+    return (
+        log_with_features.select(
+            entity,
+            "relevance",
+            sf.explode(grouping_sets).alias("grouping_set"),
+        )
+        .select(entity, "relevance", "grouping_set.*")
+        .groupBy(entity, "grouping_set_id", *cat_features_list)
+        .agg(sf.count("relevance").alias("conditional_count"))
+    )
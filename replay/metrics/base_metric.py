@@ -12,6 +12,7 @@ from pyspark.sql import types as st
 from scipy.stats import norm
 
 from replay.constants import AnyDataFrame, IntOrList, NumType
+from replay.profiler import profile_stage
 from replay.utils import convert2spark
 
 
@@ -35,6 +36,7 @@ def sorter(items, index=1):
     return list_res
 
 
+@profile_stage()
 def get_enriched_recommendations(
     recommendations: AnyDataFrame, ground_truth: AnyDataFrame
 ) -> DataFrame:
@@ -97,6 +99,7 @@ class Metric(ABC):
     def __str__(self):
         return type(self).__name__
 
+    @profile_stage()
     def __call__(
         self,
         recommendations: AnyDataFrame,
@@ -246,6 +249,7 @@ class RecOnlyMetric(Metric):
     ) -> DataFrame:
         pass
 
+    @profile_stage()
     def __call__(  # type: ignore
         self, recommendations: AnyDataFrame, k: IntOrList
     ) -> Union[Dict[int, NumType], NumType]:
@@ -4,10 +4,12 @@ import numba as nb
 import numpy as np
 import pandas as pd
 from pyspark.sql import DataFrame
-from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse import coo_matrix
 
+from replay.constants import SIMILARITY_SCHEMA
 from replay.models.base_rec import NeighbourRec
-from replay.session_handler import State
+from replay.sparse import to_csr
+from replay.utils import convert2spark
 
 
 # pylint: disable=too-many-arguments, too-many-locals
@@ -122,13 +124,8 @@ class ADMMSLIM(NeighbourRec):
         item_features: Optional[DataFrame] = None,
     ) -> None:
         self.logger.debug("Fitting ADMM SLIM")
-        pandas_log = log.select("user_idx", "item_idx", "relevance").toPandas()
-        interactions_matrix = csr_matrix(
-            (
-                pandas_log["relevance"],
-                (pandas_log["user_idx"], pandas_log["item_idx"]),
-            ),
-            shape=(self._user_dim, self._item_dim),
+        interactions_matrix = to_csr(
+            log, self._user_dim, self._item_dim, dtype=np.float64
         )
         self.logger.debug("Gram matrix")
         xtx = (interactions_matrix.T @ interactions_matrix).toarray()
@@ -185,11 +182,8 @@ class ADMMSLIM(NeighbourRec):
                 "similarity": mat_c_sparse.data,
             }
         )
-        self.similarity = State().session.createDataFrame(
-            mat_c_pd,
-            schema="item_idx_one int, item_idx_two int, similarity double",
-        )
-        self.similarity.cache()
+        self.similarity = convert2spark(mat_c_pd, SIMILARITY_SCHEMA)
+        self.similarity = self._cache(self.similarity, "similarity")
 
     def _init_matrix(
         self, size: int
@@ -7,7 +7,7 @@ from pyspark.sql import DataFrame
 from pyspark.sql.types import DoubleType
 
 from replay.models.base_rec import Recommender, ItemVectorModel
-from replay.utils import list_to_vector_udf
+from replay.utils import cross_join_by_size
 
 
 class ALSWrap(Recommender, ItemVectorModel):
@@ -48,8 +48,8 @@ class ALSWrap(Recommender, ItemVectorModel):
 
     def _load_model(self, path: str):
         self.model = ALSModel.load(path)
-        self.model.itemFactors.cache()
-        self.model.userFactors.cache()
+        self._cache(self.model.itemFactors, "itemFactors")
+        self._cache(self.model.userFactors, "userFactors")
 
     def _fit(
         self,
@@ -66,13 +66,8 @@ class ALSWrap(Recommender, ItemVectorModel):
             seed=self._seed,
             coldStartStrategy="drop",
         ).fit(log)
-        self.model.itemFactors.cache()
-        self.model.userFactors.cache()
-
-    def _clear_cache(self):
-        if hasattr(self, "model"):
-            self.model.itemFactors.unpersist()
-            self.model.userFactors.unpersist()
+        self._cache(self.model.itemFactors, "itemFactors")
+        self._cache(self.model.userFactors, "userFactors")
 
     # pylint: disable=too-many-arguments
     def _predict(
@@ -85,7 +80,9 @@ class ALSWrap(Recommender, ItemVectorModel):
         item_features: Optional[DataFrame] = None,
         filter_seen_items: bool = True,
     ) -> DataFrame:
-        test_data = users.crossJoin(items).withColumn("relevance", sf.lit(1))
+        test_data = cross_join_by_size(
+            users, items, "ALS predict"
+        ).withColumn("relevance", sf.lit(1))
         recs = (
             self.model.transform(test_data)
             .withColumn("relevance", sf.col("prediction").cast(DoubleType()))
@@ -122,5 +119,5 @@ class ALSWrap(Recommender, ItemVectorModel):
     def _get_item_vectors(self):
         return self.model.itemFactors.select(
             sf.col("id").alias("item_idx"),
-            list_to_vector_udf(sf.col("features")).alias("item_vector"),
+            sf.col("features").alias("item_vector"),
         )
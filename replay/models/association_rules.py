@@ -7,7 +7,7 @@ from pyspark.sql import DataFrame
 from pyspark.sql.window import Window
 
 from replay.models.base_rec import Recommender
-from replay.utils import unpersist_if_exists
+from replay.utils import get_self_join_size, repartition_by_size
 
 
 class AssociationRulesItemRec(Recommender):
@@ -94,6 +94,15 @@ class AssociationRulesItemRec(Recommender):
         frequent_items_log = log.join(
             frequent_items_cached.select("item_idx"), on="item_idx"
         )
+        # join tasks get about target partition size of item pairs each
+        frequent_items_log = repartition_by_size(
+            frequent_items_log,
+            "AssociationRulesItemRec item pairs",
+            self.session_col,
+            size_in_bytes=get_self_join_size(
+                frequent_items_log, self.session_col
+            ),
+        )
 
         frequent_item_pairs = (
             frequent_items_log.withColumnRenamed("item_idx", "antecedent")
@@ -198,8 +207,8 @@ class AssociationRulesItemRec(Recommender):
                 "lift",
                 "confidence_gain",
             )
-            .cache()
         )
+        self.pair_metrics = self._cache(self.pair_metrics, "pair_metrics")
         frequent_items_cached.unpersist()
 
     # pylint: disable=too-many-arguments
@@ -291,10 +300,6 @@ class AssociationRulesItemRec(Recommender):
             )
         )
 
-    def _clear_cache(self):
-        if hasattr(self, "pair_metrics"):
-            unpersist_if_exists(self.pair_metrics)
-
     @property
     def _dataframes(self):
         return {"pair_metrics": self.pair_metrics}
@@ -20,18 +20,23 @@ from optuna import create_study
 from optuna.samplers import TPESampler
 from pyspark.sql import DataFrame, Window
 from pyspark.sql import functions as sf
+from pyspark.sql import types as st
 from pyspark.sql.column import Column
 
+from replay.cache import CacheManager, instance_scope
 from replay.metrics import Metric, NDCG
 from replay.optuna_objective import SplitData, MainObjective
-from replay.session_handler import State
+from replay.profiler import profile, profile_stage
 from replay.utils import (
+    arrays_cosine_similarity,
+    arrays_dot,
+    arrays_euclidean_distance_similarity,
+    compact_precision,
     convert2spark,
-    cosine_similarity,
     get_top_k,
     get_top_k_recs,
-    vector_euclidean_distance_similarity,
-    vector_dot,
+    repartition_by_size,
+    vectors_to_arrays,
 )
 
 
@@ -299,6 +304,7 @@ class BaseRecommender(ABC):
     def __str__(self):
         return type(self).__name__
 
+    @profile_stage()
     def _fit_wrap(
         self,
         log: DataFrame,
@@ -317,6 +323,7 @@ class BaseRecommender(ABC):
         :return:
         """
         self.logger.debug("Starting fit %s", type(self).__name__)
+        self._clear_cache()
         if user_features is None:
             users = log.select("user_idx").distinct()
         else:
@@ -333,8 +340,8 @@ class BaseRecommender(ABC):
                 .union(item_features.select("item_idx"))
                 .distinct()
             )
-        self.fit_users = users.cache()
-        self.fit_items = items.cache()
+        self.fit_users = self._cache(users, "fit_users")
+        self.fit_items = self._cache(items, "fit_items")
         self._num_users = self.fit_users.count()
         self._num_items = self.fit_items.count()
         self._user_dim_size = (
@@ -343,7 +350,8 @@ class BaseRecommender(ABC):
         self._item_dim_size = (
             self.fit_items.agg({"item_idx": "max"}).collect()[0][0] + 1
         )
-        self._fit(log, user_features, item_features)
+        with profile(f"{type(self).__name__}._fit"):
+            self._fit(log, user_features, item_features)
 
     @abstractmethod
     def _fit(
@@ -365,6 +373,7 @@ class BaseRecommender(ABC):
         """
 
     @staticmethod
+    @profile_stage("_filter_seen")
     def _filter_seen(
         recs: DataFrame, log: DataFrame, k: int, users: DataFrame
     ):
@@ -385,6 +394,9 @@ class BaseRecommender(ABC):
         if num_seen.count() > 0:
             max_seen = num_seen.select(sf.max("seen_count")).collect()[0][0]
 
+        # window and both joins below are partitioned by user_idx
+        recs = repartition_by_size(recs, "filter seen items", "user_idx")
+
         # crop recommendations to first k + max_seen items for each user
         recs = recs.withColumn(
             "temp_rank",
@@ -419,6 +431,7 @@ class BaseRecommender(ABC):
         return recs
 
     # pylint: disable=too-many-arguments
+    @profile_stage()
     def _predict_wrap(
         self,
         log: Optional[DataFrame],
@@ -468,22 +481,26 @@ class BaseRecommender(ABC):
             message = f"k = {k} > number of items = {num_items}"
             self.logger.debug(message)
 
-        recs = self._predict(
-            log,
-            k,
-            users,
-            items,
-            user_features,
-            item_features,
-            filter_seen_items,
-        )
+        with profile(f"{type(self).__name__}._predict"):
+            recs = self._predict(
+                log,
+                k,
+                users,
+                items,
+                user_features,
+                item_features,
+                filter_seen_items,
+            )
         if filter_seen_items and log:
             recs = self._filter_seen(recs=recs, log=log, users=users, k=k)
 
         recs = get_top_k_recs(recs, k=k)
-        return recs.select("user_idx", "item_idx", "relevance")
+        return compact_precision(
+            recs.select("user_idx", "item_idx", "relevance")
+        )
 
     @staticmethod
+    @profile_stage("_get_ids")
     def _get_ids(
         log: Union[Iterable, DataFrame],
         column: str,
@@ -491,17 +508,19 @@ class BaseRecommender(ABC):
         """
         Get unique values from ``array`` and put them into dataframe with column ``column``.
         """
-        spark = State().session
         if isinstance(log, DataFrame):
             unique = log.select(column).distinct()
         elif isinstance(log, collections.abc.Iterable):
-            unique = spark.createDataFrame(
-                data=pd.DataFrame(pd.unique(list(log)), columns=[column])
+            # ids are integers as in LOG_SCHEMA, not inferred bigint
+            unique = convert2spark(
+                pd.DataFrame(pd.unique(list(log)), columns=[column]),
+                st.StructType([st.StructField(column, st.IntegerType())]),
             )
         else:
             raise ValueError(f"Wrong type {type(log)}")
         return unique
 
+    @profile_stage()
     def _filter_ids(self, log: DataFrame, column: str) -> DataFrame:
         """
         Filter out new ids if the model cannot predict cold items
@@ -628,11 +647,35 @@ class BaseRecommender(ABC):
             filter_seen_items,
         )
 
+    def _cache(
+        self, dataframe: DataFrame, name: str, storage_level: str = None
+    ) -> DataFrame:
+        """
+        Persist DataFrame until the model is refitted or garbage collected.
+        Double columns are stored as floats
+        if ``spark.replay.compactPrecision`` option is ``true``,
+        so the result should replace the original DataFrame.
+
+        :param dataframe: Spark DataFrame
+        :param name: attribute name
+        :param storage_level: storage level name,
+            see ``replay.cache.STORAGE_LEVELS``
+        :return: persisted DataFrame
+        """
+        return CacheManager().persist(
+            compact_precision(dataframe),
+            instance_scope(self),
+            name=f"{type(self).__name__}.{name}",
+            storage_level=storage_level,
+        )
+
     def _clear_cache(self):
         """
         Clear spark cache
         """
+        CacheManager().release_scope(instance_scope(self))
 
+    @profile_stage()
     def _predict_pairs_wrap(
         self,
         pairs: DataFrame,
@@ -669,14 +712,15 @@ class BaseRecommender(ABC):
         pairs = self._filter_ids(pairs, "item_idx")
         pairs = self._filter_ids(pairs, "user_idx")
 
-        pred = self._predict_pairs(
-            pairs=pairs,
-            log=log,
-            user_features=user_features,
-            item_features=item_features,
-        )
+        with profile(f"{type(self).__name__}._predict_pairs"):
+            pred = self._predict_pairs(
+                pairs=pairs,
+                log=log,
+                user_features=user_features,
+                item_features=item_features,
+            )
 
-        return pred
+        return compact_precision(pred)
 
     def _predict_pairs(
         self,
@@ -860,7 +904,8 @@ class ItemVectorModel(BaseRecommender):
     def _get_item_vectors(self) -> DataFrame:
         """
         Return dataframe with items' vectors as a
-            spark dataframe with columns ``[item_idx, item_vector]``
+            spark dataframe with columns ``[item_idx, item_vector]``,
+            vectors are arrays or ``VectorUDT``
         """
 
     def _get_nearest_items(
@@ -880,18 +925,20 @@ class ItemVectorModel(BaseRecommender):
         :return: dataframe with neighbours,
             spark-dataframe with columns ``[item_idx_one, item_idx_two, similarity]``
         """
-        dist_function = cosine_similarity
+        dist_function = arrays_cosine_similarity
         if metric == "euclidean_distance_sim":
-            dist_function = vector_euclidean_distance_similarity
+            dist_function = arrays_euclidean_distance_similarity
         elif metric == "dot_product":
-            dist_function = vector_dot
+            dist_function = arrays_dot
         elif metric != "cosine_similarity":
             raise NotImplementedError(
                 f"{metric} metric is not implemented, valid metrics are "
                 "'euclidean_distance_sim', 'cosine_similarity', 'dot_product'"
             )
 
-        items_vectors = self._get_item_vectors()
+        items_vectors = vectors_to_arrays(
+            self._get_item_vectors(), "item_vector"
+        )
         left_part = (
             items_vectors.withColumnRenamed("item_idx", "item_idx_one")
             .withColumnRenamed("item_vector", "item_vector_one")
@@ -917,9 +964,7 @@ class ItemVectorModel(BaseRecommender):
 
         joined_factors = joined_factors.withColumn(
             metric,
-            dist_function(
-                sf.col("item_vector_one"), sf.col("item_vector_two")
-            ),
+            dist_function("item_vector_one", "item_vector_two"),
         )
 
         similarity_matrix = joined_factors.select(
@@ -1286,10 +1331,6 @@ class NeighbourRec(Recommender, ABC):
     def _dataframes(self):
         return {"similarity": self.similarity}
 
-    def _clear_cache(self):
-        if hasattr(self, "similarity"):
-            self.similarity.unpersist()
-
     def _predict_pairs_inner(
         self,
         log: DataFrame,
@@ -5,7 +5,7 @@ import pandas as pd
 from pyspark.sql import DataFrame
 
 from replay.models.base_rec import Recommender
-from replay.utils import to_csr
+from replay.sparse import to_csc, to_csr
 from replay.constants import REC_SCHEMA
 
 
@@ -54,7 +54,8 @@ class ImplicitWrap(Recommender):
         user_features: Optional[DataFrame] = None,
         item_features: Optional[DataFrame] = None,
     ) -> None:
-        matrix = to_csr(log).T
+        # item-user csr matrix
+        matrix = to_csc(log).T
         self.model.fit(matrix)
 
     # pylint: disable=too-many-arguments
@@ -88,7 +89,7 @@ class ImplicitWrap(Recommender):
             .toPandas()
             .item_idx.to_list()
         )
-        user_item_data = to_csr(log).tocsr()
+        user_item_data = to_csr(log)
         model = self.model
         return (
             users.select("user_idx")
@@ -6,6 +6,7 @@ from pyspark.sql.window import Window
 
 from replay.models.base_rec import NeighbourRec
 from replay.optuna_objective import KNNObjective
+from replay.utils import get_self_join_size, repartition_by_size
 
 
 class KNN(NeighbourRec):
@@ -70,6 +71,13 @@ class KNN(NeighbourRec):
         :param log: DataFrame with interactions, `[user_idx, item_idx, relevance]`
         :return: similarity matrix `[item_idx_one, item_idx_two, norm1, norm2]`
         """
+        # join tasks get about target partition size of item pairs each
+        log = repartition_by_size(
+            log,
+            "KNN item pairs",
+            "user_idx",
+            size_in_bytes=get_self_join_size(log, "user_idx"),
+        )
         left = log.withColumnRenamed(
             "item_idx", "item_idx_one"
         ).withColumnRenamed("relevance", "rel_one")
@@ -140,4 +148,6 @@ class KNN(NeighbourRec):
             df = df.withColumn("relevance", sf.lit(1))
 
         similarity_matrix = self._get_similarity(df)
-        self.similarity = self._get_k_most_similar(similarity_matrix).cache()
+        self.similarity = self._cache(
+            self._get_k_most_similar(similarity_matrix), "similarity"
+        )
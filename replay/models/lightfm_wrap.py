@@ -6,6 +6,7 @@ import joblib
 import numpy as np
 import pandas as pd
 import pyspark.sql.functions as sf
+import pyspark.sql.types as st
 
 from lightfm import LightFM
 from pyspark.sql import DataFrame
@@ -14,8 +15,8 @@ from sklearn.preprocessing import MinMaxScaler
 
 from replay.constants import REC_SCHEMA
 from replay.models.base_rec import HybridRecommender
-from replay.utils import to_csr, check_numeric
-from replay.session_handler import State
+from replay.sparse import to_csr
+from replay.utils import check_numeric, convert2spark, cross_join_by_size
 
 
 # pylint: disable=too-many-locals, too-many-instance-attributes
@@ -252,7 +253,9 @@ class LightFMWrap(HybridRecommender):
         filter_seen_items: bool = True,
     ) -> DataFrame:
         return self._predict_selected_pairs(
-            users.crossJoin(items), user_features, item_features
+            cross_join_by_size(users, items, "LightFMWrap predict"),
+            user_features,
+            item_features,
         )
 
     def _predict_pairs(
@@ -299,19 +302,24 @@ class LightFMWrap(HybridRecommender):
             sparse_features
         )
 
-        embed_list = list(
-            zip(
-                ids_list,
-                biases[ids_list].tolist(),
-                vectors[ids_list].tolist(),
-            )
-        )
-        lightfm_factors = State().session.createDataFrame(
-            embed_list,
-            schema=[
-                f"{entity}_idx",
-                f"{entity}_bias",
-                f"{entity}_factors",
-            ],
+        lightfm_factors = convert2spark(
+            pd.DataFrame(
+                {
+                    f"{entity}_idx": ids_list.to_numpy(),
+                    f"{entity}_bias": biases[ids_list].astype(np.float64),
+                    f"{entity}_factors": list(
+                        vectors[ids_list].astype(np.float64)
+                    ),
+                }
+            ),
+            st.StructType(
+                [
+                    st.StructField(f"{entity}_idx", st.IntegerType()),
+                    st.StructField(f"{entity}_bias", st.DoubleType()),
+                    st.StructField(
+                        f"{entity}_factors", st.ArrayType(st.DoubleType())
+                    ),
+                ]
+            ),
         )
         return lightfm_factors, self.model.no_components
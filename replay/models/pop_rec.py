@@ -4,6 +4,7 @@ from pyspark.sql import DataFrame, Window
 from pyspark.sql import functions as sf
 
 from replay.models.base_rec import Recommender
+from replay.utils import cross_join_by_size, repartition_by_size
 
 
 class PopRec(Recommender):
@@ -101,11 +102,12 @@ class PopRec(Recommender):
                     ),
                 )
             )
-        self.item_popularity.cache()
-
-    def _clear_cache(self):
-        if hasattr(self, "item_popularity"):
-            self.item_popularity.unpersist()
+        self.item_popularity = repartition_by_size(
+            self.item_popularity, "PopRec item popularity"
+        )
+        self.item_popularity = self._cache(
+            self.item_popularity, "item_popularity"
+        )
 
     # pylint: disable=too-many-arguments
     def _predict(
@@ -142,8 +144,12 @@ class PopRec(Recommender):
             if max_hist_len is None:
                 max_hist_len = 0
 
-        return users.crossJoin(
-            selected_item_popularity.filter(sf.col("rank") <= k + max_hist_len)
+        return cross_join_by_size(
+            users,
+            selected_item_popularity.filter(
+                sf.col("rank") <= k + max_hist_len
+            ),
+            "PopRec predict",
         ).drop("rank")
 
     def _predict_pairs(
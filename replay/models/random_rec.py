@@ -201,17 +201,15 @@ class RandomRec(Recommender):
                 .withColumn("probability", sf.lit(1.0))
             )
 
-        self.item_popularity.cache()
+        self.item_popularity = self._cache(
+            self.item_popularity, "item_popularity"
+        )
         self.fill = (
             self.item_popularity.agg({"probability": "min"}).first()[0]
             if self.add_cold
             else 0.0
         )
 
-    def _clear_cache(self):
-        if hasattr(self, "item_popularity"):
-            self.item_popularity.unpersist()
-
     def _get_ids_and_probs_pd(self, item_popularity):
         if self.distribution == "uniform":
             return (
@@ -3,12 +3,12 @@ from typing import Optional
 import numpy as np
 import pandas as pd
 from pyspark.sql import DataFrame
+from pyspark.sql import functions as sf
 from pyspark.sql import types as st
-from scipy.sparse import csc_matrix
 from sklearn.linear_model import ElasticNet
 
 from replay.models.base_rec import NeighbourRec
-from replay.session_handler import State
+from replay.sparse import to_csc
 
 
 class SLIM(NeighbourRec):
@@ -47,16 +47,11 @@ class SLIM(NeighbourRec):
         user_features: Optional[DataFrame] = None,
         item_features: Optional[DataFrame] = None,
     ) -> None:
-        pandas_log = log.select("user_idx", "item_idx", "relevance").toPandas()
-
-        interactions_matrix = csc_matrix(
-            (pandas_log.relevance, (pandas_log.user_idx, pandas_log.item_idx)),
-            shape=(self._user_dim, self._item_dim),
+        interactions_matrix = to_csc(
+            log, self._user_dim, self._item_dim, dtype=np.float64
         )
-        similarity = (
-            State()
-            .session.createDataFrame(pandas_log.item_idx, st.IntegerType())
-            .withColumnRenamed("value", "item_idx_one")
+        similarity = log.select(
+            sf.col("item_idx").cast(st.IntegerType()).alias("item_idx_one")
         )
 
         alpha = self.beta + self.lambda_
@@ -100,4 +95,4 @@ class SLIM(NeighbourRec):
             slim_column,
             "item_idx_one int, item_idx_two int, similarity double",
         )
-        self.similarity.cache()
+        self.similarity = self._cache(self.similarity, "similarity")
@@ -6,6 +6,7 @@ from pyspark.sql import DataFrame, Window
 from pyspark.sql import functions as sf
 
 from replay.models.base_rec import Recommender
+from replay.utils import cross_join_by_size
 
 
 class UCB(Recommender):
@@ -78,7 +79,9 @@ class UCB(Recommender):
         )
 
         self.item_popularity = items_counts.drop("pos", "total")
-        self.item_popularity.cache()
+        self.item_popularity = self._cache(
+            self.item_popularity, "item_popularity"
+        )
 
         self.fill = 1 + math.sqrt(math.log(self.coef * full_count))
 
@@ -86,10 +89,6 @@ class UCB(Recommender):
     def _dataframes(self):
         return {"item_popularity": self.item_popularity}
 
-    def _clear_cache(self):
-        if hasattr(self, "item_popularity"):
-            self.item_popularity.unpersist()
-
     # pylint: disable=too-many-arguments
     def _predict(
             self,
@@ -126,8 +125,12 @@ class UCB(Recommender):
             if max_hist_len is None:
                 max_hist_len = 0
 
-        return users.crossJoin(
-            selected_item_popularity.filter(sf.col("rank") <= k + max_hist_len)
+        return cross_join_by_size(
+            users,
+            selected_item_popularity.filter(
+                sf.col("rank") <= k + max_hist_len
+            ),
+            "UCB predict",
         ).drop("rank")
 
     def _predict_pairs(
@@ -80,11 +80,9 @@ class UserPopRec(Recommender):
                 ),
             )
         )
-        self.user_item_popularity.cache()
-
-    def _clear_cache(self):
-        if hasattr(self, "user_item_popularity"):
-            self.user_item_popularity.unpersist()
+        self.user_item_popularity = self._cache(
+            self.user_item_popularity, "user_item_popularity"
+        )
 
     # pylint: disable=too-many-arguments
     def _predict(
@@ -74,4 +74,6 @@ class Wilson(PopRec):
         )
 
         self.item_popularity = items_counts.drop("pos", "total")
-        self.item_popularity.cache()
+        self.item_popularity = self._cache(
+            self.item_popularity, "item_popularity"
+        )
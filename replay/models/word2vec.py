@@ -1,13 +1,19 @@
 from typing import Optional
 
 from pyspark.ml.feature import Word2Vec
+from pyspark.ml.functions import vector_to_array
 from pyspark.sql import DataFrame
 from pyspark.sql import functions as sf
 from pyspark.sql import types as st
-from pyspark.ml.stat import Summarizer
 
 from replay.models.base_rec import Recommender, ItemVectorModel
-from replay.utils import vector_dot, vector_mult
+from replay.utils import (
+    arrays_dot,
+    average_arrays,
+    cross_join_by_size,
+    scale_array,
+    vectors_to_arrays,
+)
 
 
 # pylint: disable=too-many-instance-attributes
@@ -86,7 +92,7 @@ class Word2VecRec(Recommender, ItemVectorModel):
                 ).alias("idf"),
             )
         )
-        self.idf.cache()
+        self.idf = self._cache(self.idf, "idf")
 
         log_by_users = (
             log.groupBy("user_idx")
@@ -120,14 +126,12 @@ class Word2VecRec(Recommender, ItemVectorModel):
         self.vectors = (
             word_2_vec.fit(log_by_users)
             .getVectors()
-            .select(sf.col("word").cast("int").alias("item"), "vector")
+            .select(
+                sf.col("word").cast("int").alias("item"),
+                vector_to_array("vector").alias("vector"),
+            )
         )
-        self.vectors.cache()
-
-    def _clear_cache(self):
-        if hasattr(self, "idf") and hasattr(self, "vectors"):
-            self.idf.unpersist()
-            self.vectors.unpersist()
+        self.vectors = self._cache(self.vectors, "vectors")
 
     @property
     def _dataframes(self):
@@ -149,17 +153,15 @@ class Word2VecRec(Recommender, ItemVectorModel):
             log.join(users, how="inner", on="user_idx")
             .join(self.idf, how="inner", on="item_idx")
             .join(
-                self.vectors,
+                vectors_to_arrays(self.vectors, "vector"),
                 how="inner",
                 on=sf.col("item_idx") == sf.col("item"),
             )
-            .groupby("user_idx")
-            .agg(
-                Summarizer.mean(
-                    vector_mult(sf.col("idf"), sf.col("vector"))
-                ).alias("user_vector")
+            .select(
+                "user_idx", scale_array("idf", "vector").alias("user_vector")
             )
-            .select("user_idx", "user_vector")
+            .groupby("user_idx")
+            .agg(average_arrays("user_vector", self.rank).alias("user_vector"))
         )
 
     def _predict_pairs_inner(
@@ -178,15 +180,16 @@ class Word2VecRec(Recommender, ItemVectorModel):
         pairs_with_vectors = pairs.join(
             user_vectors, on="user_idx", how="inner"
         ).join(
-            self.vectors, on=sf.col("item_idx") == sf.col("item"), how="inner"
+            vectors_to_arrays(self.vectors, "vector"),
+            on=sf.col("item_idx") == sf.col("item"),
+            how="inner",
         )
         return pairs_with_vectors.select(
             "user_idx",
             sf.col("item_idx"),
-            (
-                vector_dot(sf.col("vector"), sf.col("user_vector"))
-                + sf.lit(self.rank)
-            ).alias("relevance"),
+            (arrays_dot("vector", "user_vector") + sf.lit(self.rank)).alias(
+                "relevance"
+            ),
         )
 
     # pylint: disable=too-many-arguments
@@ -200,7 +203,9 @@ class Word2VecRec(Recommender, ItemVectorModel):
         item_features: Optional[DataFrame] = None,
         filter_seen_items: bool = True,
     ) -> DataFrame:
-        return self._predict_pairs_inner(users.crossJoin(items), log)
+        return self._predict_pairs_inner(
+            cross_join_by_size(users, items, "Word2VecRec predict"), log
+        )
 
     def _predict_pairs(
         self,
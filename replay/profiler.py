@@ -0,0 +1,286 @@
+"""
+Opt-in profiling of RePlay stages.
+
+Fit and predict steps of models, metrics and ``TwoStagesScenario`` are
+marked as stages. When a ``Profiler`` is active, every stage records
+elapsed time, Spark jobs and stages started inside it, cache usage
+and, optionally, the number of rows of input and output DataFrames.
+When no profiler is active stages are called directly,
+after checking a module-level flag, without creating ``State``.
+
+Spark evaluates DataFrames lazily, so a stage accounts only for the jobs
+it triggers itself, e.g. ``count``, ``collect`` or model training.
+Transformations are computed by the stage which starts a job on the result.
+"""
+import functools
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import pandas as pd
+from pyspark.sql import DataFrame
+
+from replay.session_handler import State, is_profiling
+
+_JOB_PROPERTIES = (
+    "spark.jobGroup.id",
+    "spark.job.description",
+    "spark.job.interruptOnCancel",
+)
+
+
+def _cache_usage() -> Dict[str, int]:
+    """
+    :return: number and size of cached RDDs
+    """
+    spark_context = State().session.sparkContext
+    # pylint: disable=protected-access
+    storage_info = spark_context._jsc.sc().getRDDStorageInfo()
+    return {
+        "cached_rdds": len(storage_info),
+        "cached_bytes": sum(
+            info.memSize() + info.diskSize() for info in storage_info
+        ),
+    }
+
+
+class Profiler:
+    """
+    Collects statistics of stages executed inside the context.
+
+    >>> from replay.session_handler import State
+    >>> from replay.models import PopRec
+    >>> from replay.utils import convert2spark
+    >>> import pandas as pd
+    >>> log = convert2spark(pd.DataFrame({"user_idx": [1, 1, 2], "item_idx": [1, 2, 3], "relevance": [1, 1, 1]}))
+    >>> with Profiler(count_rows=True) as profiler:
+    ...     recs = PopRec().fit_predict(log, k=1)
+    >>> report = profiler.report
+    >>> report.columns.tolist()[:5]
+    ['name', 'depth', 'parent', 'time', 'jobs']
+    >>> report.columns.tolist()[5:]
+    ['spark_stages', 'cached_rdds', 'cached_bytes', 'rows_in', 'rows_out']
+    >>> report["name"].tolist()[:2]
+    ['PopRec._fit_wrap', 'PopRec._fit']
+    >>> State().profiler is None
+    True
+
+    Profiler can also be enabled with ``State().profiler = Profiler()``.
+    """
+
+    def __init__(self, count_rows: bool = False):
+        """
+        :param count_rows: count rows of the first input DataFrame and
+            output DataFrame of a stage. Counting starts additional Spark jobs,
+            which are not included into stage statistics.
+        """
+        self.count_rows = count_rows
+        self.records: List[Dict[str, Any]] = []
+        self._stack: List[Dict[str, Any]] = []
+        self._previous: Optional["Profiler"] = None
+
+    def __enter__(self):
+        state = State()
+        self._previous = state.profiler
+        state.profiler = self
+        return self
+
+    def __exit__(self, *args):
+        State().profiler = self._previous
+
+    @staticmethod
+    def _job_properties() -> Dict[str, Optional[str]]:
+        """
+        :return: job group properties of the current thread
+        """
+        spark_context = State().session.sparkContext
+        return {
+            key: spark_context.getLocalProperty(key) for key in _JOB_PROPERTIES
+        }
+
+    @staticmethod
+    def _restore_job_properties(properties: Dict[str, Optional[str]]):
+        """
+        Restore job group set before the stage, e.g. by the caller
+
+        :param properties: result of ``_job_properties``
+        """
+        spark_context = State().session.sparkContext
+        for key, value in properties.items():
+            spark_context.setLocalProperty(key, value)
+
+    def count(self, dataframe: Any) -> Optional[int]:
+        """
+        Count rows outside of the current stage
+
+        :param dataframe: DataFrame or any other object
+        :return: number of rows or ``None`` if rows are not counted
+        """
+        if not self.count_rows or not isinstance(dataframe, DataFrame):
+            return None
+        previous = self._job_properties()
+        spark_context = State().session.sparkContext
+        spark_context.setJobGroup(f"replay-profiler-{uuid.uuid4().hex}", "")
+        try:
+            return dataframe.count()
+        finally:
+            self._restore_job_properties(previous)
+
+    @contextmanager
+    def stage(self, name: str, rows_in: Optional[int] = None):
+        """
+        Record statistics of the code inside the context.
+        Statistics of nested stages are included into parent stage.
+
+        :param name: stage name
+        :param rows_in: number of input rows
+        """
+        record = {
+            "name": name,
+            "depth": len(self._stack),
+            "parent": self._stack[-1]["name"] if self._stack else None,
+            "group": f"replay-profiler-{uuid.uuid4().hex}",
+            "children_jobs": 0,
+            "children_stages": 0,
+            "rows_in": rows_in,
+            "rows_out": None,
+        }
+        self.records.append(record)
+        self._stack.append(record)
+        previous = self._job_properties()
+        State().session.sparkContext.setJobGroup(record["group"], name)
+        cache_before = _cache_usage()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["time"] = time.perf_counter() - start
+            self._stack.pop()
+            self._restore_job_properties(previous)
+            self._finish(record, cache_before)
+
+    def _finish(self, record: Dict[str, Any], cache_before: Dict[str, int]):
+        tracker = State().session.sparkContext.statusTracker()
+        job_ids = tracker.getJobIdsForGroup(record.pop("group"))
+        spark_stages = 0
+        for job_id in job_ids:
+            info = tracker.getJobInfo(job_id)
+            if info is not None:
+                spark_stages += len(info.stageIds)
+        record["jobs"] = len(job_ids) + record.pop("children_jobs")
+        record["spark_stages"] = spark_stages + record.pop("children_stages")
+        if self._stack:
+            self._stack[-1]["children_jobs"] += record["jobs"]
+            self._stack[-1]["children_stages"] += record["spark_stages"]
+        cache_after = _cache_usage()
+        record["cached_rdds"] = cache_after["cached_rdds"]
+        record["cached_bytes"] = (
+            cache_after["cached_bytes"] - cache_before["cached_bytes"]
+        )
+
+    @property
+    def report(self) -> pd.DataFrame:
+        """
+        Stage statistics in order of stage start:
+        ``time`` in seconds, number of Spark ``jobs`` and ``spark_stages``,
+        number of ``cached_rdds`` after the stage, change of ``cached_bytes``,
+        ``rows_in`` and ``rows_out`` if ``count_rows`` is set.
+        """
+        columns = [
+            "name",
+            "depth",
+            "parent",
+            "time",
+            "jobs",
+            "spark_stages",
+            "cached_rdds",
+            "cached_bytes",
+            "rows_in",
+            "rows_out",
+        ]
+        return pd.DataFrame(self.records, columns=columns)
+
+    def summary(self) -> pd.DataFrame:
+        """
+        :return: statistics aggregated by stage name
+        """
+        return (
+            self.report.groupby("name", sort=False)
+            .agg(
+                calls=("time", "count"),
+                time=("time", "sum"),
+                jobs=("jobs", "sum"),
+                spark_stages=("spark_stages", "sum"),
+            )
+            .sort_values("time", ascending=False)
+        )
+
+    def to_json(self, path: Optional[str] = None) -> str:
+        """
+        :param path: file to save the report to
+        :return: report as json string
+        """
+        result = self.report.to_json(orient="records")
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as report_file:
+                report_file.write(result)
+        return result
+
+
+def profile(name: str):
+    """
+    Mark a block of code as a stage.
+    Returns an empty context if profiling is disabled.
+
+    :param name: stage name
+    """
+    if not is_profiling():
+        return _NULL_STAGE
+    return State().profiler.stage(name)
+
+
+class _NullStage:
+    """Reusable empty context manager"""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def profile_stage(name: Optional[str] = None) -> Callable:
+    """
+    Decorator marking function as a stage.
+    Methods are named after the class of the instance they are called on.
+
+    :param name: stage name, function name by default
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_profiling():
+                return func(*args, **kwargs)
+            profiler = State().profiler
+            stage_name = name or func.__qualname__
+            if args and hasattr(type(args[0]), func.__name__):
+                stage_name = f"{type(args[0]).__name__}.{func.__name__}"
+            inputs = [
+                arg
+                for arg in list(args) + list(kwargs.values())
+                if isinstance(arg, DataFrame)
+            ]
+            rows_in = profiler.count(inputs[0]) if inputs else None
+            with profiler.stage(stage_name, rows_in) as record:
+                result = func(*args, **kwargs)
+            record["rows_out"] = profiler.count(result)
+            return result
+
+        return wrapper
+
+    return decorator
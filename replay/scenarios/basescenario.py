@@ -4,6 +4,7 @@ from abc import abstractmethod
 from typing import Optional, Union, Iterable, Dict, List, Any, Tuple
 
 from pyspark.sql import DataFrame
+from pyspark.sql import functions as sf
 
 from replay.constants import AnyDataFrame
 from replay.filters import min_entries
@@ -12,6 +13,57 @@ from replay.models.base_rec import BaseRecommender
 from replay.utils import convert2spark
 
 
+def route_users(
+    log: Optional[DataFrame],
+    users: DataFrame,
+    threshold: int,
+    fitted_hot_users: Optional[DataFrame] = None,
+) -> DataFrame:
+    """
+    Mark users as hot or cold in one pass over the log.
+    User is hot if it has at least ``threshold`` interactions in ``log``
+    and belongs to ``fitted_hot_users`` if they are passed.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> log = spark.createDataFrame([(1, 1), (1, 2), (2, 1)], ["user_idx", "item_idx"])
+    >>> users = spark.createDataFrame([(1,), (2,), (3,)], ["user_idx"])
+    >>> route_users(log, users, 2).orderBy("user_idx").show()
+    +--------+------+
+    |user_idx|is_hot|
+    +--------+------+
+    |       1|  true|
+    |       2| false|
+    |       3| false|
+    +--------+------+
+    <BLANKLINE>
+
+    :param log: historical log of interactions
+    :param users: users to route ``[user_idx]``
+    :param threshold: minimal number of interactions of a hot user
+    :param fitted_hot_users: hot users of train log ``[user_idx]``
+    :return: ``[user_idx, is_hot]``
+    """
+    if log is None:
+        return users.select("user_idx", sf.lit(threshold <= 0).alias("is_hot"))
+    is_hot = sf.coalesce(sf.col("num_entries"), sf.lit(0)) >= threshold
+    routed = users.select("user_idx").join(
+        log.groupBy("user_idx").agg(sf.count(sf.lit(1)).alias("num_entries")),
+        on="user_idx",
+        how="left",
+    )
+    if fitted_hot_users is not None:
+        routed = routed.join(
+            fitted_hot_users.select("user_idx").withColumn(
+                "is_fitted", sf.lit(True)
+            ),
+            on="user_idx",
+            how="left",
+        )
+        is_hot &= sf.col("is_fitted").isNotNull()
+    return routed.select("user_idx", is_hot.alias("is_hot"))
+
+
 class BaseScenario(BaseRecommender):
     """Base scenario class"""
 
@@ -74,11 +126,18 @@ class BaseScenario(BaseRecommender):
         log = convert2spark(log)
         users = users or log or user_features or self.fit_users
         users = self._get_ids(users, "user_idx")
-        hot_data = min_entries(log, self.threshold)
-        hot_users = hot_data.select("user_idx").distinct()
-        if not self.can_predict_cold_users:
-            hot_users = hot_users.join(self.hot_users)
-        hot_users = hot_users.join(users, on="user_idx", how="inner")
+        routed = route_users(
+            log,
+            users,
+            self.threshold,
+            None if self.can_predict_cold_users else self.hot_users,
+        )
+        hot_users = routed.filter(sf.col("is_hot")).select("user_idx")
+        cold_users = routed.filter(~sf.col("is_hot")).select("user_idx")
+        hot_data, cold_data = None, None
+        if log is not None:
+            hot_data = log.join(hot_users, on="user_idx", how="left_semi")
+            cold_data = log.join(cold_users, on="user_idx", how="left_semi")
 
         hot_pred = self._predict_wrap(
             log=hot_data,
@@ -89,11 +148,6 @@ class BaseScenario(BaseRecommender):
             item_features=item_features,
             filter_seen_items=filter_seen_items,
         )
-        if log is not None:
-            cold_data = log.join(self.hot_users, how="anti", on="user_idx")
-        else:
-            cold_data = None
-        cold_users = users.join(self.hot_users, how="anti", on="user_idx")
         cold_pred = self.cold_model._predict_wrap(
             log=cold_data,
             k=k,
@@ -2,12 +2,14 @@
 from typing import Optional, Dict, List, Any, Tuple, Union, Iterable
 
 from pyspark.sql import DataFrame
+from pyspark.sql import functions as sf
 
 from replay.constants import AnyDataFrame
 from replay.filters import min_entries
 from replay.metrics import Metric, NDCG
 from replay.models import PopRec
 from replay.models.base_rec import BaseRecommender
+from replay.scenarios.basescenario import route_users
 from replay.utils import fallback
 
 
@@ -90,10 +92,12 @@ class Fallback(BaseRecommender):
         """
         users = users or log or user_features or self.fit_users
         users = self._get_ids(users, "user_idx")
-        hot_data = min_entries(log, self.threshold)
-        hot_users = hot_data.select("user_idx").distinct()
-        hot_users = hot_users.join(self.hot_users, on="user_idx")
-        hot_users = hot_users.join(users, on="user_idx", how="inner")
+        hot_users = (
+            route_users(log, users, self.threshold, self.hot_users)
+            .filter(sf.col("is_hot"))
+            .select("user_idx")
+        )
+        hot_data = log.join(hot_users, on="user_idx", how="left_semi")
 
         hot_pred = self._predict_wrap(
             log=hot_data,
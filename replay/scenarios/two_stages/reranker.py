@@ -1,15 +1,20 @@
 import logging
 from abc import abstractmethod
-from typing import Dict, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
+import numpy as np
+import pandas as pd
 from lightautoml.automl.presets.tabular_presets import TabularAutoML
 from lightautoml.tasks import Task
-from pyspark.sql import DataFrame
+from lightgbm import LGBMRanker
+from pyspark.ml.classification import LogisticRegression
+from pyspark.ml.feature import VectorAssembler
+from pyspark.sql import Column, DataFrame
+from pyspark.sql import functions as sf
+from pyspark.sql import types as st
 
-from replay.utils import (
-    convert2spark,
-    get_top_k_recs,
-)
+from replay.session_handler import State
+from replay.utils import get_top_k_recs
 
 
 class ReRanker:
@@ -50,28 +55,200 @@ class ReRanker:
         """
 
 
+def stratified_sample(
+    data: DataFrame,
+    max_rows: Optional[int],
+    column: str = "target",
+    seed: Optional[int] = None,
+) -> DataFrame:
+    """
+    Sample at most ``max_rows`` rows (approximately)
+    keeping the share of each ``column`` value.
+
+    :param data: spark dataframe
+    :param max_rows: sample size, ``None`` to return ``data`` as is
+    :param column: column to stratify by
+    :param seed: random seed
+    :return: sample
+    """
+    if max_rows is None:
+        return data
+    counts = {
+        row[column]: row["count"]
+        for row in data.groupBy(column).count().collect()
+    }
+    total = sum(counts.values())
+    if total <= max_rows:
+        return data
+    fraction = max_rows / total
+    return data.sampleBy(
+        column, fractions={value: fraction for value in counts}, seed=seed
+    )
+
+
+def sample_users(
+    data: DataFrame, max_rows: Optional[int], seed: Optional[int] = None,
+) -> DataFrame:
+    """
+    Sample users to get at most ``max_rows`` rows (approximately)
+    keeping all rows of sampled users.
+
+    :param data: spark dataframe with ``user_idx`` column
+    :param max_rows: sample size, ``None`` to return ``data`` as is
+    :param seed: random seed
+    :return: sample
+    """
+    if max_rows is None:
+        return data
+    total = data.count()
+    if total <= max_rows:
+        return data
+    users = (
+        data.select("user_idx")
+        .distinct()
+        .sample(fraction=max_rows / total, seed=seed)
+    )
+    return data.join(users, on="user_idx")
+
+
+def get_feature_columns(data: DataFrame) -> List[str]:
+    """
+    :param data: spark dataframe with ``[user_idx, item_idx]`` columns,
+        features' columns and optional ``target`` column
+    :return: names of numeric and numeric array features' columns
+    """
+    return [
+        field.name
+        for field in data.schema.fields
+        if (
+            isinstance(field.dataType, st.NumericType)
+            or (
+                isinstance(field.dataType, st.ArrayType)
+                and isinstance(field.dataType.elementType, st.NumericType)
+            )
+        )
+        and field.name not in ["user_idx", "item_idx", "target"]
+    ]
+
+
+def get_array_columns(data: DataFrame) -> List[str]:
+    """
+    :param data: spark dataframe
+    :return: names of array columns
+    """
+    return [
+        field.name
+        for field in data.schema.fields
+        if isinstance(field.dataType, st.ArrayType)
+    ]
+
+
+def expand_arrays(data: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """
+    Replace array columns with dense blocks of columns, one per element.
+    Arrays in a column must have the same length.
+
+    >>> data = pd.DataFrame({"id": [1, 2], "factors": [[1.0, 2.0], [3.0, 4.0]]})
+    >>> expand_arrays(data, ["factors"])
+       id  factors_0  factors_1
+    0   1        1.0        2.0
+    1   2        3.0        4.0
+
+    :param data: pandas dataframe
+    :param columns: names of array columns
+    :return: pandas dataframe
+    """
+    if not columns:
+        return data
+    blocks = [data.drop(columns=columns)]
+    for column in columns:
+        block = np.vstack(data[column].values)
+        blocks.append(
+            pd.DataFrame(
+                block,
+                index=data.index,
+                columns=[f"{column}_{i}" for i in range(block.shape[1])],
+            )
+        )
+    return pd.concat(blocks, axis=1)
+
+
+def score_in_batches(
+    data: DataFrame,
+    model: Any,
+    score: Callable[[Any, pd.DataFrame], np.ndarray],
+) -> DataFrame:
+    """
+    Score candidates on executors.
+    The model is broadcast and applied to Arrow batches of candidates.
+
+    :param data: spark dataframe with obligatory ``[user_idx, item_idx]``
+        columns and features' columns
+    :param model: fitted model
+    :param score: function of the model and pandas dataframe with features
+        returning array of relevance values
+    :return: spark dataframe ``[user_idx, item_idx, relevance]``
+    """
+    model_broadcast = State().session.sparkContext.broadcast(model)
+
+    def predict_batches(
+        batches: Iterator[pd.DataFrame],
+    ) -> Iterator[pd.DataFrame]:
+        for batch in batches:
+            if batch.empty:
+                continue
+            candidates_ids = batch[["user_idx", "item_idx"]].copy()
+            candidates_ids["relevance"] = score(
+                model_broadcast.value,
+                batch.drop(columns=["user_idx", "item_idx"]),
+            )
+            yield candidates_ids
+
+    schema = st.StructType(
+        [
+            data.schema["user_idx"],
+            data.schema["item_idx"],
+            st.StructField("relevance", st.DoubleType()),
+        ]
+    )
+    return data.mapInPandas(predict_batches, schema)
+
+
 class LamaWrap(ReRanker):
     """
     LightAutoML TabularPipeline binary classification model wrapper for recommendations re-ranking.
     Read more: https://github.com/sberbank-ai-lab/LightAutoML
+
+    The model is fitted on the driver, so the training data can be limited
+    with a stratified sample. Prediction is distributed: the fitted model
+    is broadcast to executors and applied to Arrow batches of candidates.
     """
 
     def __init__(
         self,
         params: Optional[Dict] = None,
         config_path: Optional[str] = None,
+        fit_max_rows: Optional[int] = None,
+        seed: Optional[int] = None,
     ):
         """
         Initialize LightAutoML TabularPipeline with passed params/configuration file.
 
         :param params: dict of model parameters
         :param config_path: path to configuration file
+        :param fit_max_rows: maximal number of rows collected to the driver
+            to fit the model, train data is sampled with ``target`` stratification.
+            ``None`` means all rows are used.
+        :param seed: random seed for sampling
         """
         self.model = TabularAutoML(
             task=Task("binary"),
             config_path=config_path,
             **(params if params is not None else {}),
         )
+        self.fit_max_rows = fit_max_rows
+        self.seed = seed
+        self.array_columns: List[str] = []
 
     def fit(self, data: DataFrame, fit_params: Optional[Dict] = None) -> None:
         """
@@ -87,8 +264,11 @@ class LamaWrap(ReRanker):
 
         params = {"roles": {"target": "target"}, "verbose": 1}
         params.update({} if fit_params is None else fit_params)
-        data = data.drop("user_idx", "item_idx")
-        data_pd = data.toPandas()
+        self.array_columns = get_array_columns(data)
+        data = stratified_sample(data, self.fit_max_rows, seed=self.seed)
+        data_pd = expand_arrays(
+            data.drop("user_idx", "item_idx").toPandas(), self.array_columns
+        )
         self.model.fit_predict(data_pd, **params)
 
     def predict(self, data: DataFrame, k: int) -> DataFrame:
@@ -101,19 +281,198 @@ class LamaWrap(ReRanker):
         :return: spark dataframe with top-k recommendations for each user
             the dataframe columns are ``[user_idx, item_idx, relevance]``
         """
-        data_pd = data.toPandas()
-        candidates_ids = data_pd[["user_idx", "item_idx"]]
-        data_pd.drop(columns=["user_idx", "item_idx"], inplace=True)
+        array_columns = self.array_columns
         self.logger.info("Starting re-ranking")
-        candidates_pred = self.model.predict(data_pd)
-        candidates_ids.loc[:, "relevance"] = candidates_pred.data[:, 0]
-        self.logger.info(
-            "%s candidates rated for %s users",
-            candidates_ids.shape[0],
-            candidates_ids["user_idx"].nunique(),
+        candidates = score_in_batches(
+            data,
+            self.model,
+            lambda model, features: model.predict(
+                expand_arrays(features, array_columns)
+            ).data[:, 0],
         )
+        return get_top_k_recs(recs=candidates, k=k, id_type="idx")
+
+
+class LightGBMRanker(ReRanker):
+    """
+    LightGBM learning-to-rank model wrapper for recommendations re-ranking.
+    Candidates of each user form a query group, LambdaRank objective is used by default.
+    Read more: https://lightgbm.readthedocs.io/en/latest/pythonapi/lightgbm.LGBMRanker.html
+
+    The model is fitted on the driver on numeric features,
+    prediction is distributed as in ``LamaWrap``.
+    """
+
+    def __init__(
+        self,
+        params: Optional[Dict] = None,
+        fit_max_rows: Optional[int] = None,
+        seed: Optional[int] = None,
+    ):
+        """
+        :param params: ``LGBMRanker`` parameters,
+            e.g. ``{"objective": "rank_xendcg", "n_estimators": 200}``
+        :param fit_max_rows: maximal number of rows collected to the driver
+            to fit the model, train data is sampled by users.
+            ``None`` means all rows are used.
+        :param seed: random seed for sampling and the model
+        """
+        model_params = {"objective": "lambdarank", "random_state": seed}
+        model_params.update({} if params is None else params)
+        self.model = LGBMRanker(**model_params)
+        self.fit_max_rows = fit_max_rows
+        self.seed = seed
+        self.feature_columns: List[str] = []
+        self.array_columns: List[str] = []
 
-        self.logger.info("top-k")
-        return get_top_k_recs(
-            recs=convert2spark(candidates_ids), k=k, id_type="idx"
+    def fit(self, data: DataFrame, fit_params: Optional[Dict] = None) -> None:
+        """
+        Fit LightGBM ranker grouping candidates by user.
+
+        :param data: spark dataframe with obligatory ``[user_idx, item_idx, target]``
+            columns and features' columns. `Target` column should consist of zeros and ones.
+        :param fit_params: dict of parameters to pass to ``LGBMRanker.fit()``
+        """
+        self.feature_columns = get_feature_columns(data)
+        self.array_columns = get_array_columns(
+            data.select(*self.feature_columns)
+        )
+        data = sample_users(data, self.fit_max_rows, seed=self.seed)
+        data_pd = (
+            data.select("user_idx", "target", *self.feature_columns)
+            .toPandas()
+            .sort_values("user_idx", kind="stable")
+        )
+        group_sizes = data_pd.groupby("user_idx", sort=True).size()
+        self.model.fit(
+            expand_arrays(data_pd[self.feature_columns], self.array_columns),
+            data_pd["target"].astype(int),
+            group=group_sizes.values,
+            **({} if fit_params is None else fit_params),
+        )
+
+    def predict(self, data: DataFrame, k: int) -> DataFrame:
+        """
+        Re-rank data with the model and get top-k recommendations for each user.
+
+        :param data: spark dataframe with obligatory ``[user_idx, item_idx]``
+            columns and features' columns
+        :param k: number of recommendations for each user
+        :return: spark dataframe with top-k recommendations for each user
+            the dataframe columns are ``[user_idx, item_idx, relevance]``
+        """
+        array_columns = self.array_columns
+        self.logger.info("Starting re-ranking")
+        candidates = score_in_batches(
+            data.select("user_idx", "item_idx", *self.feature_columns),
+            self.model,
+            lambda model, features: model.predict(
+                expand_arrays(features, array_columns)
+            ),
+        )
+        return get_top_k_recs(recs=candidates, k=k, id_type="idx")
+
+
+class LogisticReRanker(ReRanker):
+    """
+    Spark ML logistic regression for recommendations re-ranking.
+    The model is fitted on executors and candidates are scored
+    with a Spark SQL expression, no Python code is run on executors.
+    Array features are used elementwise, missing values are replaced with zeros.
+    """
+
+    def __init__(self, params: Optional[Dict] = None):
+        """
+        :param params: ``pyspark.ml.classification.LogisticRegression`` parameters,
+            e.g. ``{"regParam": 0.01, "maxIter": 50}``
+        """
+        self.params = {} if params is None else params
+        self.feature_columns: List[str] = []
+        self.array_sizes: Dict[str, int] = {}
+        self.coefficients: List[float] = []
+        self.intercept = 0.0
+
+    def fit(self, data: DataFrame, fit_params: Optional[Dict] = None) -> None:
+        """
+        Fit logistic regression on numeric features.
+
+        :param data: spark dataframe with obligatory ``[user_idx, item_idx, target]``
+            columns and features' columns. `Target` column should consist of zeros and ones.
+        :param fit_params: dict of ``LogisticRegression`` parameters
+            overriding the ones passed to ``__init__``
+        """
+        self.feature_columns = get_feature_columns(data)
+        array_columns = get_array_columns(data.select(*self.feature_columns))
+        self.array_sizes = {}
+        if array_columns:
+            self.array_sizes = (
+                data.select(
+                    *[
+                        sf.max(sf.size(column)).alias(column)
+                        for column in array_columns
+                    ]
+                )
+                .first()
+                .asDict()
+            )
+        params = {**self.params, **({} if fit_params is None else fit_params)}
+        values = self._feature_values()
+        train = VectorAssembler(
+            inputCols=[f"feature_{i}" for i in range(len(values))],
+            outputCol="features",
+        ).transform(
+            data.select(
+                "target",
+                *[
+                    value.alias(f"feature_{i}")
+                    for i, value in enumerate(values)
+                ],
+            )
+        )
+        model = LogisticRegression(
+            featuresCol="features", labelCol="target", **params
+        ).fit(train)
+        self.coefficients = model.coefficients.toArray().tolist()
+        self.intercept = float(model.intercept)
+
+    def _feature_values(self) -> List[Column]:
+        """
+        :return: a double column per feature and element of array feature
+        """
+        columns = []
+        for column in self.feature_columns:
+            if column in self.array_sizes:
+                columns.extend(
+                    sf.col(column).getItem(i)
+                    for i in range(self.array_sizes[column])
+                )
+            else:
+                columns.append(sf.col(column))
+        return [
+            sf.coalesce(
+                sf.nanvl(column.cast(st.DoubleType()), sf.lit(0.0)),
+                sf.lit(0.0),
+            )
+            for column in columns
+        ]
+
+    def _relevance(self) -> Column:
+        logit = sf.lit(self.intercept)
+        for value, weight in zip(self._feature_values(), self.coefficients):
+            logit = logit + value * weight
+        return 1 / (1 + sf.exp(-logit))
+
+    def predict(self, data: DataFrame, k: int) -> DataFrame:
+        """
+        Re-rank data with the model and get top-k recommendations for each user.
+
+        :param data: spark dataframe with obligatory ``[user_idx, item_idx]``
+            columns and features' columns
+        :param k: number of recommendations for each user
+        :return: spark dataframe with top-k recommendations for each user
+            the dataframe columns are ``[user_idx, item_idx, relevance]``
+        """
+        candidates = data.select(
+            "user_idx", "item_idx", self._relevance().alias("relevance")
         )
+        return get_top_k_recs(recs=candidates, k=k, id_type="idx")
@@ -1,32 +1,54 @@
 # pylint: disable=too-many-lines
+import os
 from collections.abc import Iterable
-from typing import Dict, Optional, Tuple, List, Union, Any
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists, join
+from typing import Callable, Dict, Optional, Tuple, List, Union, Any
 
+import joblib
+import psutil
 import pyspark.sql.functions as sf
-from pyspark.sql import DataFrame
+from py4j.clientserver import ClientServer
+from pyspark.sql import DataFrame, Window
 
+from replay.cache import CacheManager, instance_scope
 from replay.constants import AnyDataFrame
 from replay.data_preparator import ToNumericFeatureTransformer
 from replay.history_based_fp import HistoryBasedFeaturesProcessor
 from replay.metrics import Metric, Precision
+from replay.model_handler import load, save
 from replay.models import ALSWrap, RandomRec, PopRec
 from replay.models.base_rec import BaseRecommender, HybridRecommender
-from replay.scenarios.two_stages.reranker import LamaWrap
+from replay.profiler import profile, profile_stage
+from replay.scenarios.two_stages.reranker import LamaWrap, ReRanker
 
 from replay.session_handler import State
 from replay.splitters import Splitter, UserSplitter
 from replay.utils import (
-    array_mult,
-    cache_if_exists,
-    fallback,
+    arrays_dot,
+    byte_string_as_bytes,
+    get_fingerprint,
     get_log_info,
-    get_top_k_recs,
     horizontal_explode,
     join_or_return,
+    multiply_arrays,
+    repartition_by_size,
     ugly_join,
-    unpersist_if_exists,
 )
 
+STAGE_COMPLETED = "_COMPLETED"
+
+
+def _is_pinned_thread_mode() -> bool:
+    """
+    Python threads are mapped to JVM threads, and thread local properties
+    such as scheduler pool apply to jobs of the thread, only in pinned
+    thread mode. It is enabled with ``PYSPARK_PIN_THREAD=true``
+    environment variable before Spark is started.
+    """
+    # pylint: disable=protected-access
+    return isinstance(State().session.sparkContext._gateway, ClientServer)
+
 
 # pylint: disable=too-many-locals, too-many-arguments
 def get_first_level_model_features(
@@ -36,18 +58,25 @@ def get_first_level_model_features(
     item_features: Optional[DataFrame] = None,
     add_factors_mult: bool = True,
     prefix: str = "",
+    keep_arrays: bool = False,
 ) -> DataFrame:
     """
     Get user and item embeddings from replay model.
     Can also compute elementwise multiplication between them with ``add_factors_mult`` parameter.
     Zero vectors are returned if a model does not have embeddings for specific users/items.
 
+    Embeddings are exploded into a column per dimension by default.
+    With ``keep_arrays`` they are returned as array columns
+    ``{prefix}_uf``, ``{prefix}_if``, ``{prefix}_fm``
+    and the dot product of user and item embeddings is added as ``{prefix}_dot``.
+
     :param model: trained model
     :param pairs: user-item pairs to get vectors for `[user_id/user_idx, item_id/item_id]`
     :param user_features: user features `[user_id/user_idx, feature_1, ....]`
     :param item_features: item features `[item_id/item_idx, feature_1, ....]`
     :param add_factors_mult: flag to add elementwise multiplication
     :param prefix: name to add to the columns
+    :param keep_arrays: keep embeddings as array columns
     :return: DataFrame
     """
     users = pairs.select("user_idx").distinct()
@@ -78,7 +107,7 @@ def get_first_level_model_features(
                 sf.array([sf.lit(0.0)] * user_vector_len),
             ),
         )
-        factors_to_explode.append(("user_factors", "uf"))
+        factors_to_explode.append(("user_factors", "uf", user_vector_len))
 
     if item_factors is not None:
         pairs_with_features = pairs_with_features.withColumn(
@@ -88,7 +117,7 @@ def get_first_level_model_features(
                 sf.array([sf.lit(0.0)] * item_vector_len),
             ),
         )
-        factors_to_explode.append(("item_factors", "if"))
+        factors_to_explode.append(("item_factors", "if", item_vector_len))
 
     if model.__str__() == "LightFMWrap":
         pairs_with_features = (
@@ -103,12 +132,20 @@ def get_first_level_model_features(
         and item_factors is not None
     ):
         pairs_with_features = pairs_with_features.withColumn(
-            "factors_mult",
-            array_mult(sf.col("item_factors"), sf.col("user_factors")),
+            "factors_mult", multiply_arrays("item_factors", "user_factors"),
         )
-        factors_to_explode.append(("factors_mult", "fm"))
+        factors_to_explode.append(("factors_mult", "fm", user_vector_len))
+        if keep_arrays:
+            pairs_with_features = pairs_with_features.withColumn(
+                f"{prefix}_dot", arrays_dot("item_factors", "user_factors")
+            )
 
-    for col_name, feature_prefix in factors_to_explode:
+    for col_name, feature_prefix, vector_len in factors_to_explode:
+        if keep_arrays:
+            pairs_with_features = pairs_with_features.withColumnRenamed(
+                col_name, f"{prefix}_{feature_prefix}"
+            )
+            continue
         col_set = set(pairs_with_features.columns)
         col_set.remove(col_name)
         pairs_with_features = horizontal_explode(
@@ -116,11 +153,44 @@ def get_first_level_model_features(
             column_to_explode=col_name,
             other_columns=[sf.col(column) for column in sorted(list(col_set))],
             prefix=f"{prefix}_{feature_prefix}",
+            num_columns=vector_len,
         )
 
     return pairs_with_features
 
 
+def _merge_by_pairs(dataframes: List[DataFrame]) -> DataFrame:
+    """
+    Merge DataFrames with different columns keyed by ``[user_idx, item_idx]``
+    with one aggregation instead of a join per DataFrame.
+    The first non-null value of each column is taken for a pair.
+
+    :param dataframes: DataFrames ``[user_idx, item_idx]`` + value columns
+    :return: DataFrame ``[user_idx, item_idx]`` + all value columns
+    """
+    keys = ["user_idx", "item_idx"]
+    fields = {}
+    for dataframe in dataframes:
+        for field in dataframe.schema.fields:
+            if field.name not in keys:
+                fields.setdefault(field.name, field.dataType)
+    merged = None
+    for dataframe in dataframes:
+        aligned = dataframe.select(
+            *keys,
+            *[
+                sf.col(name)
+                if name in dataframe.columns
+                else sf.lit(None).cast(data_type).alias(name)
+                for name, data_type in fields.items()
+            ],
+        )
+        merged = aligned if merged is None else merged.unionByName(aligned)
+    return merged.groupBy(*keys).agg(
+        *[sf.first(name, ignorenulls=True).alias(name) for name in fields]
+    )
+
+
 # pylint: disable=too-many-instance-attributes
 class TwoStagesScenario(HybridRecommender):
     """
@@ -142,15 +212,24 @@ class TwoStagesScenario(HybridRecommender):
        - add user and item features
        - generate statistical and pair features
 
-    5) train ``TabularAutoML`` from LightAutoML
+    5) train ``second_stage_model``, ``TabularAutoML`` from LightAutoML by default
 
     *inference*:
 
     1) take ``log``
-    2) generate candidates, their number can be specified with ``num_candidates``
+    2) generate candidates, their number can be specified with ``num_negatives``
+       or ``num_candidates_per_model`` to merge candidates of all first level models
     3) add features as in train
     4) get recommendations
 
+    *checkpoints*:
+
+    If ``checkpoint_dir`` is set, outputs of fit stages ``split``, ``first_level_fit``,
+    ``candidates``, ``features`` and ``second_level_fit`` are saved
+    to ``checkpoint_dir/<fingerprint>/<stage>``, where fingerprint depends on input data
+    and scenario parameters. Fit with the same data and parameters resumes
+    after the last completed stage. Candidates with features for inference
+    are saved the same way and reused by repeated ``predict`` calls.
     """
 
     can_predict_cold_users: bool = True
@@ -167,14 +246,21 @@ class TwoStagesScenario(HybridRecommender):
         ] = ALSWrap(rank=128),
         fallback_model: Optional[BaseRecommender] = PopRec(),
         use_first_level_models_feat: Union[List[bool], bool] = False,
+        keep_factors_arrays: bool = False,
         second_model_params: Optional[Union[Dict, str]] = None,
         second_model_config_path: Optional[str] = None,
+        second_model_fit_max_rows: Optional[int] = None,
+        second_stage_model: Optional[ReRanker] = None,
         num_negatives: int = 100,
         negatives_type: str = "first_level",
+        num_candidates_per_model: Optional[List[int]] = None,
         use_generated_features: bool = False,
         user_cat_features_list: Optional[List] = None,
         item_cat_features_list: Optional[List] = None,
         custom_features_processor: HistoryBasedFeaturesProcessor = None,
+        num_fit_threads: int = 1,
+        fit_memory_per_model: Optional[str] = None,
+        checkpoint_dir: Optional[str] = None,
         seed: int = 123,
     ) -> None:
         """
@@ -184,20 +270,44 @@ class TwoStagesScenario(HybridRecommender):
         :param fallback_model: model used to fill missing recommendations at first level models
         :param use_first_level_models_feat: flag or a list of flags to use
             features created by first level models
+        :param keep_factors_arrays: pass embeddings of first level models
+            to the second stage model as array columns
+            instead of a column per dimension
         :param second_model_params: TabularAutoML parameters
         :param second_model_config_path: path to config file for TabularAutoML
+        :param second_model_fit_max_rows: maximal number of second level train rows
+            collected to the driver to fit TabularAutoML,
+            a sample stratified by target is taken. ``None`` to use all rows.
+        :param second_stage_model: re-ranker, e.g. ``LightGBMRanker`` or ``LogisticReRanker``.
+            ``LamaWrap`` built with ``second_model_*`` parameters is used by default.
         :param num_negatives: number of negative examples used during train
         :param negatives_type: negative examples creation strategy,``random``
             or most relevant examples from ``first-level``
+        :param num_candidates_per_model: number of candidates taken from each
+            first level model. If set, candidates of all first level models are merged
+            and deduplicated, lists are filled by the fallback model up to the sum of quotas,
+            which is used instead of ``num_negatives``. With ``first_level`` negatives
+            the models which proposed a candidate are passed to the second stage model as features.
+            By default candidates are taken from the first model of ``first_level_models``.
         :param use_generated_features: flag to use generated features to train second level
         :param user_cat_features_list: list of user categorical features
         :param item_cat_features_list: list of item categorical features
         :param custom_features_processor: you can pass custom feature processor
+        :param num_fit_threads: number of first level models fitted concurrently.
+            Each model submits Spark jobs to its own scheduler pool,
+            set ``spark.scheduler.mode`` to ``FAIR`` to share the cluster between them.
+            Requires pinned thread mode, start Spark with ``PYSPARK_PIN_THREAD=true``
+            environment variable, otherwise models are fitted sequentially.
+            Models are fitted sequentially while ``Profiler`` is active.
+        :param fit_memory_per_model: driver memory required to fit one model, e.g. ``4g``,
+            the number of threads is limited by available memory. Not limited by default.
+        :param checkpoint_dir: directory to save stage outputs to, parquet files
+            are written by Spark, so it must be available to executors.
+            Checkpoints are not saved by default.
         :param seed: random seed
 
         """
         self.train_splitter = train_splitter
-        self.cached_list = []
 
         self.first_level_models = (
             first_level_models
@@ -234,9 +344,15 @@ class TwoStagesScenario(HybridRecommender):
 
             self.use_first_level_models_feat = use_first_level_models_feat
 
-        self.second_stage_model = LamaWrap(
-            params=second_model_params, config_path=second_model_config_path
-        )
+        self.keep_factors_arrays = keep_factors_arrays
+        if second_stage_model is None:
+            second_stage_model = LamaWrap(
+                params=second_model_params,
+                config_path=second_model_config_path,
+                fit_max_rows=second_model_fit_max_rows,
+                seed=seed,
+            )
+        self.second_stage_model = second_stage_model
 
         self.num_negatives = num_negatives
         if negatives_type not in ["random", "first_level"]:
@@ -245,6 +361,17 @@ class TwoStagesScenario(HybridRecommender):
             )
         self.negatives_type = negatives_type
 
+        if num_candidates_per_model is not None and len(
+            num_candidates_per_model
+        ) != len(self.first_level_models):
+            raise ValueError(
+                f"For each model from first_level_models specify "
+                f"number of candidates. "
+                f"Length of first_level_models is {len(self.first_level_models)}, "
+                f"Length of num_candidates_per_model is {len(num_candidates_per_model)}"
+            )
+        self.num_candidates_per_model = num_candidates_per_model
+
         self.use_generated_features = use_generated_features
         self.features_processor = (
             custom_features_processor
@@ -254,9 +381,23 @@ class TwoStagesScenario(HybridRecommender):
                 item_cat_features_list=item_cat_features_list,
             )
         )
+        self.num_fit_threads = num_fit_threads
+        self.fit_memory_per_model = fit_memory_per_model
+        self.checkpoint_dir = checkpoint_dir
+        self._checkpoint_path: Optional[str] = None
+        self._predictions: Optional[DataFrame] = None
         self.seed = seed
 
+    @property
+    def _candidates_scope(self) -> str:
+        """
+        Cache scope of candidates, seen items and first level features,
+        released when the second level dataset is materialized.
+        """
+        return f"{instance_scope(self)}.candidates"
+
     # pylint: disable=too-many-locals
+    @profile_stage()
     def _add_features_for_second_level(
         self,
         log_to_add_features: DataFrame,
@@ -278,52 +419,70 @@ class TwoStagesScenario(HybridRecommender):
         :return: DataFrame
         """
         self.logger.info("Generating features")
-        full_second_level_train = log_to_add_features
-        first_level_item_features_cached = cache_if_exists(
-            self.first_level_item_features_transformer.transform(item_features)
+        # candidate store shared by all first level models
+        full_second_level_train = CacheManager().persist(
+            repartition_by_size(
+                log_to_add_features, "TwoStagesScenario.candidates", "user_idx"
+            ),
+            self._candidates_scope,
+            "TwoStagesScenario.candidates",
         )
-        first_level_user_features_cached = cache_if_exists(
-            self.first_level_user_features_transformer.transform(user_features)
+        pairs = full_second_level_train.select("user_idx", "item_idx")
+        first_level_item_features_cached = CacheManager().persist(
+            self.first_level_item_features_transformer.transform(
+                item_features
+            ),
+            self._candidates_scope,
+            "TwoStagesScenario.first_level_item_features",
+        )
+        first_level_user_features_cached = CacheManager().persist(
+            self.first_level_user_features_transformer.transform(
+                user_features
+            ),
+            self._candidates_scope,
+            "TwoStagesScenario.first_level_user_features",
         )
 
-        pairs = log_to_add_features.select("user_idx", "item_idx")
+        # scores and embeddings of all first level models are merged by pair
+        # and added to the candidates with one join
+        model_columns = []
         for idx, model in enumerate(self.first_level_models):
-            current_pred = self._predict_pairs_with_first_level_model(
-                model=model,
-                log=log_for_first_level_models,
-                pairs=pairs,
-                user_features=first_level_user_features_cached,
-                item_features=first_level_item_features_cached,
-            ).withColumnRenamed("relevance", f"rel_{idx}_{model}")
-            full_second_level_train = full_second_level_train.join(
-                sf.broadcast(current_pred),
-                on=["user_idx", "item_idx"],
-                how="left",
-            )
-
-            if self.use_first_level_models_feat[idx]:
-                features = get_first_level_model_features(
+            model_columns.append(
+                self._predict_pairs_with_first_level_model(
                     model=model,
-                    pairs=full_second_level_train.select(
-                        "user_idx", "item_idx"
-                    ),
+                    log=log_for_first_level_models,
+                    pairs=pairs,
                     user_features=first_level_user_features_cached,
                     item_features=first_level_item_features_cached,
-                    prefix=f"m_{idx}",
+                ).select(
+                    "user_idx",
+                    "item_idx",
+                    sf.col("relevance").alias(f"rel_{idx}_{model}"),
                 )
-                full_second_level_train = ugly_join(
-                    left=full_second_level_train,
-                    right=features,
-                    on_col_name=["user_idx", "item_idx"],
-                    how="left",
+            )
+            if self.use_first_level_models_feat[idx]:
+                model_columns.append(
+                    get_first_level_model_features(
+                        model=model,
+                        pairs=pairs,
+                        user_features=first_level_user_features_cached,
+                        item_features=first_level_item_features_cached,
+                        prefix=f"m_{idx}",
+                        keep_arrays=self.keep_factors_arrays,
+                    )
                 )
+        full_second_level_train = ugly_join(
+            left=full_second_level_train,
+            right=_merge_by_pairs(model_columns),
+            on_col_name=["user_idx", "item_idx"],
+            how="left",
+        )
 
-        unpersist_if_exists(first_level_user_features_cached)
-        unpersist_if_exists(first_level_item_features_cached)
-
-        full_second_level_train_cached = full_second_level_train.fillna(
-            0
-        ).cache()
+        full_second_level_train_cached = CacheManager().persist(
+            full_second_level_train.fillna(0),
+            self._candidates_scope,
+            "TwoStagesScenario.first_level_features",
+        )
 
         self.logger.info("Adding features from the dataset")
         full_second_level_train = join_or_return(
@@ -355,9 +514,205 @@ class TwoStagesScenario(HybridRecommender):
             "Columns at second level: %s",
             " ".join(full_second_level_train.columns),
         )
-        full_second_level_train_cached.unpersist()
         return full_second_level_train
 
+    @property
+    def _checkpoint_params(self) -> Dict[str, Any]:
+        """
+        Parameters which change checkpointed results
+        """
+        models = [*self.first_level_models, self.fallback_model]
+        return {
+            "models": [
+                (str(model), model._init_args)
+                for model in models
+                if model is not None
+            ],
+            "splitter": (
+                str(type(self.train_splitter)),
+                {
+                    name: value
+                    for name, value in vars(self.train_splitter).items()
+                    if not name.startswith("_")
+                },
+            ),
+            "use_first_level_models_feat": self.use_first_level_models_feat,
+            "keep_factors_arrays": self.keep_factors_arrays,
+            "num_negatives": self.num_negatives,
+            "negatives_type": self.negatives_type,
+            "num_candidates_per_model": self.num_candidates_per_model,
+            "use_generated_features": self.use_generated_features,
+            "second_stage_model": str(type(self.second_stage_model)),
+            "seed": self.seed,
+        }
+
+    def _stage_path(self, stage: str) -> Optional[str]:
+        if self._checkpoint_path is None:
+            return None
+        return join(self._checkpoint_path, stage)
+
+    def _is_completed(self, stage: str) -> bool:
+        path = self._stage_path(stage)
+        return path is not None and exists(join(path, STAGE_COMPLETED))
+
+    def _complete(self, stage: str) -> None:
+        path = self._stage_path(stage)
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            with open(join(path, STAGE_COMPLETED), "w"):
+                pass
+
+    def _checkpoint_dataframes(
+        self,
+        stage: str,
+        names: List[str],
+        compute: Callable[[], List[DataFrame]],
+    ) -> List[DataFrame]:
+        """
+        Compute DataFrames of a stage or load them from the checkpoint.
+
+        :param stage: stage name
+        :param names: names of DataFrames returned by ``compute``
+        :param compute: function computing stage DataFrames
+        :return: computed or checkpointed DataFrames
+        """
+        path = self._stage_path(stage)
+        if path is None:
+            return compute()
+        if self._is_completed(stage):
+            self.logger.info("Loading stage %s from %s", stage, path)
+        else:
+            for name, dataframe in zip(names, compute()):
+                dataframe.write.mode("overwrite").parquet(join(path, name))
+            self._complete(stage)
+        spark = State().session
+        return [spark.read.parquet(join(path, name)) for name in names]
+
+    def _get_num_fit_threads(self, num_models: int) -> int:
+        """
+        Limit ``num_fit_threads`` by the number of models and available memory
+        """
+        num_threads = max(1, min(self.num_fit_threads, num_models))
+        if num_threads > 1 and State().profiler is not None:
+            self.logger.info(
+                "Profiler is active, first level models are fitted one by one"
+            )
+            return 1
+        if num_threads > 1 and not _is_pinned_thread_mode():
+            self.logger.warning(
+                "Python threads are not pinned to JVM threads, "
+                "set PYSPARK_PIN_THREAD=true before Spark is started "
+                "to fit first level models concurrently"
+            )
+            return 1
+        if self.fit_memory_per_model is not None:
+            available = psutil.virtual_memory().available
+            num_threads = max(
+                1,
+                min(
+                    num_threads,
+                    available
+                    // byte_string_as_bytes(self.fit_memory_per_model),
+                ),
+            )
+        return num_threads
+
+    @staticmethod
+    def _fit_in_pool(
+        model: BaseRecommender,
+        pool: Optional[str],
+        log: DataFrame,
+        user_features: Optional[DataFrame],
+        item_features: Optional[DataFrame],
+    ) -> None:
+        spark_context = State().session.sparkContext
+        spark_context.setLocalProperty("spark.scheduler.pool", pool)
+        try:
+            model._fit_wrap(
+                log=log,
+                user_features=user_features,
+                item_features=item_features,
+            )
+        finally:
+            spark_context.setLocalProperty("spark.scheduler.pool", None)
+
+    def _fit_first_level_models(
+        self,
+        log: DataFrame,
+        user_features: Optional[DataFrame],
+        item_features: Optional[DataFrame],
+    ) -> None:
+        """
+        Fit first level, random and fallback models
+        or load them from the checkpoint.
+        Models are independent, so they are fitted concurrently
+        if ``num_fit_threads`` is greater than one.
+        """
+        models = {
+            f"first_level_{idx}": model
+            for idx, model in enumerate(self.first_level_models)
+        }
+        models["random"] = self.random_model
+        if self.fallback_model is not None:
+            models["fallback"] = self.fallback_model
+
+        stage = "first_level_fit"
+        path = self._stage_path(stage)
+        if self._is_completed(stage):
+            self.logger.info("Loading stage %s from %s", stage, path)
+            models = {name: load(join(path, name)) for name in models}
+            self.first_level_models = [
+                models[f"first_level_{idx}"]
+                for idx in range(len(self.first_level_models))
+            ]
+            self.random_model = models["random"]
+            self.fallback_model = models.get("fallback")
+            return
+
+        self._fit_models(
+            list(models.values()), log, user_features, item_features
+        )
+        if path is not None:
+            for name, model in models.items():
+                save(model, join(path, name))
+            self._complete(stage)
+
+    def _fit_models(
+        self,
+        models: List[BaseRecommender],
+        log: DataFrame,
+        user_features: Optional[DataFrame],
+        item_features: Optional[DataFrame],
+    ) -> None:
+        num_threads = self._get_num_fit_threads(len(models))
+        if num_threads == 1:
+            for model in models:
+                model._fit_wrap(
+                    log=log,
+                    user_features=user_features,
+                    item_features=item_features,
+                )
+            return
+
+        self.logger.info(
+            "Fitting %s models in %s threads", len(models), num_threads
+        )
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = [
+                executor.submit(
+                    self._fit_in_pool,
+                    model,
+                    f"replay_{idx}_{model}",
+                    log,
+                    user_features,
+                    item_features,
+                )
+                for idx, model in enumerate(models)
+            ]
+            for future in futures:
+                future.result()
+
+    @profile_stage()
     def _split_data(self, log: DataFrame) -> Tuple[DataFrame, DataFrame]:
         """Write statistics"""
         first_level_train, second_level_train = self.train_splitter.split(log)
@@ -385,7 +740,6 @@ class TwoStagesScenario(HybridRecommender):
         items: DataFrame,
         user_features: DataFrame,
         item_features: DataFrame,
-        log_to_filter: DataFrame,
     ):
         """
         Filter users and items using can_predict_cold_items and can_predict_cold_users, and predict
@@ -407,40 +761,15 @@ class TwoStagesScenario(HybridRecommender):
                 for df in [log, users, user_features]
             ]
 
-        log_to_filter_cached = ugly_join(
-            left=log_to_filter,
-            right=users,
-            on_col_name="user_idx",
-        ).cache()
-        max_positives_to_filter = 0
-
-        if log_to_filter_cached.count() > 0:
-            max_positives_to_filter = (
-                log_to_filter_cached.groupBy("user_idx")
-                .agg(sf.count("item_idx").alias("num_positives"))
-                .select(sf.max("num_positives"))
-                .collect()[0][0]
-            )
-
-        pred = model._predict(
+        return model._predict(
             log,
-            k=k + max_positives_to_filter,
+            k=k,
             users=users,
             items=items,
             user_features=user_features,
             item_features=item_features,
             filter_seen_items=False,
-        )
-
-        pred = pred.join(
-            log_to_filter_cached.select("user_idx", "item_idx"),
-            on=["user_idx", "item_idx"],
-            how="anti",
-        ).drop("user", "item")
-
-        log_to_filter_cached.unpersist()
-
-        return get_top_k_recs(pred, k)
+        ).select("user_idx", "item_idx", "relevance")
 
     def _predict_pairs_with_first_level_model(
         self,
@@ -477,7 +806,25 @@ class TwoStagesScenario(HybridRecommender):
             item_features=item_features,
         )
 
-    # pylint: disable=unused-argument
+    @property
+    def _source_columns(self) -> List[str]:
+        """
+        Columns flagging first level models which proposed a candidate,
+        used as features if candidates for train and inference are merged
+        from several first level models.
+        """
+        if (
+            self.num_candidates_per_model is None
+            or self.negatives_type != "first_level"
+        ):
+            return []
+        return [
+            f"source_{idx}_{model}"
+            for idx, model in enumerate(self.first_level_models)
+        ]
+
+    # pylint: disable=too-many-locals
+    @profile_stage()
     def _get_first_level_candidates(
         self,
         model: BaseRecommender,
@@ -488,26 +835,123 @@ class TwoStagesScenario(HybridRecommender):
         user_features: DataFrame,
         item_features: DataFrame,
         log_to_filter: DataFrame,
+        quotas: Optional[List[int]] = None,
     ) -> DataFrame:
         """
         Combining the base model predictions with the fallback model
         predictions.
-        """
-        passed_arguments = locals()
-        passed_arguments.pop("self")
-        candidates = self._predict_with_first_level_model(**passed_arguments)
 
+        Seen items are computed once and shared by all models:
+        each model predicts its quota plus the maximal number of seen items per user.
+        Predictions and seen items form a candidate store partitioned by user
+        with a ``seen`` flag, seen items are removed, lists are cut and merged
+        in the same pass without further shuffles.
+        Fallback model fills the lists only after the base model candidates.
+
+        If ``quotas`` are passed, top ``quotas[i]`` candidates of each first level model
+        are merged instead of ``model`` candidates. Lists are filled up to ``sum(quotas)``
+        and ``source_{i}_{model}`` columns flag models which proposed a candidate.
+        """
+        seen = CacheManager().persist(
+            ugly_join(
+                left=log_to_filter.select("user_idx", "item_idx"),
+                right=users,
+                on_col_name="user_idx",
+                how="left_semi",
+            ),
+            self._candidates_scope,
+            "TwoStagesScenario.seen",
+        )
+        max_seen = (
+            seen.groupBy("user_idx")
+            .count()
+            .agg(sf.max("count"))
+            .collect()[0][0]
+        ) or 0
+
+        if quotas is None:
+            sources = [(model, k)]
+        else:
+            sources = list(zip(self.first_level_models, quotas))
+            k = sum(quotas)
+        main_sources = len(sources)
         if self.fallback_model is not None:
-            passed_arguments.pop("model")
-            fallback_candidates = self._predict_with_first_level_model(
-                model=self.fallback_model, **passed_arguments
+            sources.append((self.fallback_model, k))
+
+        candidates = None
+        quota = sf.lit(k)
+        for source_idx, (source, source_k) in enumerate(sources):
+            pred = self._predict_with_first_level_model(
+                model=source,
+                log=log,
+                k=source_k + max_seen,
+                users=users,
+                items=items,
+                user_features=user_features,
+                item_features=item_features,
+            ).withColumn("source", sf.lit(source_idx))
+            candidates = (
+                pred if candidates is None else candidates.unionByName(pred)
             )
+            quota = sf.when(
+                sf.col("source") == source_idx, source_k
+            ).otherwise(quota)
 
-            candidates = fallback(
-                base=candidates,
-                fill=fallback_candidates,
-                k=self.num_negatives,
+        source_flags = [
+            sf.max((sf.col("source") == source_idx).cast("int")).alias(
+                f"source_{source_idx}_{self.first_level_models[source_idx]}"
+            )
+            for source_idx in range(main_sources if quotas else 0)
+        ]
+        # candidate store partitioned by user with seen items flagged,
+        # windows and aggregations below need no more shuffles
+        candidates = (
+            candidates.unionByName(
+                seen.select(
+                    "user_idx",
+                    "item_idx",
+                    sf.lit(None).cast("double").alias("relevance"),
+                    sf.lit(None).cast("int").alias("source"),
+                )
+            )
+            .repartition("user_idx")
+            .withColumn(
+                "seen",
+                sf.max(sf.col("source").isNull().cast("int")).over(
+                    Window.partitionBy("user_idx", "item_idx")
+                ),
+            )
+            .filter((sf.col("seen") == 0) & sf.col("source").isNotNull())
+            .withColumn(
+                "source_rank",
+                sf.row_number().over(
+                    Window.partitionBy("user_idx", "source").orderBy(
+                        sf.col("relevance").desc()
+                    )
+                ),
+            )
+            .filter(sf.col("source_rank") <= quota)
+            .withColumn(
+                "priority",
+                (sf.col("source") >= main_sources).cast("int"),
+            )
+            .groupBy("user_idx", "item_idx")
+            .agg(
+                sf.min("priority").alias("priority"),
+                sf.max("relevance").alias("relevance"),
+                *source_flags,
             )
+            .withColumn(
+                "rank",
+                sf.row_number().over(
+                    Window.partitionBy("user_idx").orderBy(
+                        "priority", sf.col("relevance").desc()
+                    )
+                ),
+            )
+            .filter(sf.col("rank") <= k)
+            .drop("priority", "rank")
+        )
         return candidates
 
     # pylint: disable=too-many-locals,too-many-statements
@@ -518,10 +962,33 @@ class TwoStagesScenario(HybridRecommender):
         item_features: Optional[DataFrame] = None,
     ) -> None:
 
-        self.cached_list = []
+        scope = f"{instance_scope(self)}.fit"
+        manager = CacheManager()
+        self._checkpoint_path = None
+        if self.checkpoint_dir is not None:
+            self._checkpoint_path = join(
+                self.checkpoint_dir,
+                get_fingerprint(
+                    log,
+                    user_features,
+                    item_features,
+                    params=self._checkpoint_params,
+                ),
+            )
+            self.logger.info("Checkpoints path: %s", self._checkpoint_path)
 
         self.logger.info("Data split")
-        first_level_train, second_level_positive = self._split_data(log)
+        # results pinned by the splitter, checkpointed stage returns
+        # DataFrames read from parquet instead
+        split_results: List[DataFrame] = []
+
+        def split_data() -> List[DataFrame]:
+            split_results.extend(self._split_data(log))
+            return split_results
+
+        first_level_train, second_level_positive = self._checkpoint_dataframes(
+            "split", ["first_level_train", "second_level_positive"], split_data
+        )
         # second_level_positive = second_level_positive
         # .join(first_level_train.select("user_idx"), on="user_idx", how="left")
 
@@ -532,80 +999,89 @@ class TwoStagesScenario(HybridRecommender):
             first_level_train.select("user_idx").distinct().count()
         )
 
-        log.cache()
-        first_level_train.cache()
-        second_level_positive.cache()
-        self.cached_list.extend(
-            [log, first_level_train, second_level_positive]
-        )
-
-        if user_features is not None:
-            user_features.cache()
-            self.cached_list.append(user_features)
-
-        if item_features is not None:
-            item_features.cache()
-            self.cached_list.append(item_features)
+        for dataframe in [
+            log,
+            first_level_train,
+            second_level_positive,
+            user_features,
+            item_features,
+        ]:
+            manager.persist(dataframe, scope)
+        # split results are owned by the scenario from now on
+        for dataframe in split_results:
+            manager.release(dataframe, self.train_splitter.cache_scope)
 
         self.first_level_item_features_transformer.fit(item_features)
         self.first_level_user_features_transformer.fit(user_features)
 
-        first_level_item_features = cache_if_exists(
-            self.first_level_item_features_transformer.transform(item_features)
-        )
-        first_level_user_features = cache_if_exists(
-            self.first_level_user_features_transformer.transform(user_features)
+        first_level_item_features = manager.persist(
+            self.first_level_item_features_transformer.transform(
+                item_features
+            ),
+            scope,
+            "TwoStagesScenario.first_level_item_features",
         )
-
-        for base_model in [
-            *self.first_level_models,
-            self.random_model,
-            self.fallback_model,
-        ]:
-            base_model._fit_wrap(
-                log=first_level_train,
-                user_features=first_level_user_features.filter(
-                    sf.col("user_idx") < self.first_level_user_len
-                ),
-                item_features=first_level_item_features.filter(
-                    sf.col("item_idx") < self.first_level_item_len
-                ),
-            )
-
-        self.logger.info("Generate negative examples")
-        negatives_source = (
-            self.first_level_models[0]
-            if self.negatives_type == "first_level"
-            else self.random_model
+        first_level_user_features = manager.persist(
+            self.first_level_user_features_transformer.transform(
+                user_features
+            ),
+            scope,
+            "TwoStagesScenario.first_level_user_features",
         )
 
-        first_level_candidates = self._get_first_level_candidates(
-            model=negatives_source,
+        self._fit_first_level_models(
             log=first_level_train,
-            k=self.num_negatives,
-            users=log.select("user_idx").distinct(),
-            items=log.select("item_idx").distinct(),
-            user_features=first_level_user_features,
-            item_features=first_level_item_features,
-            log_to_filter=first_level_train,
-        ).select("user_idx", "item_idx")
-
-        unpersist_if_exists(first_level_user_features)
-        unpersist_if_exists(first_level_item_features)
+            user_features=self._filter_or_return(
+                first_level_user_features,
+                sf.col("user_idx") < self.first_level_user_len,
+            ),
+            item_features=self._filter_or_return(
+                first_level_item_features,
+                sf.col("item_idx") < self.first_level_item_len,
+            ),
+        )
 
-        self.logger.info("Crate train dataset for second level")
+        def get_second_level_train() -> List[DataFrame]:
+            self.logger.info("Generate negative examples")
+            negatives_source = (
+                self.first_level_models[0]
+                if self.negatives_type == "first_level"
+                else self.random_model
+            )
 
-        second_level_train = (
-            first_level_candidates.join(
-                second_level_positive.select(
-                    "user_idx", "item_idx"
-                ).withColumn("target", sf.lit(1.0)),
-                on=["user_idx", "item_idx"],
-                how="left",
-            ).fillna(0.0, subset="target")
-        ).cache()
+            first_level_candidates = self._get_first_level_candidates(
+                model=negatives_source,
+                log=first_level_train,
+                k=self.num_negatives,
+                users=log.select("user_idx").distinct(),
+                items=log.select("item_idx").distinct(),
+                user_features=first_level_user_features,
+                item_features=first_level_item_features,
+                log_to_filter=first_level_train,
+                quotas=self.num_candidates_per_model
+                if self._source_columns
+                else None,
+            ).select("user_idx", "item_idx", *self._source_columns)
+
+            self.logger.info("Crate train dataset for second level")
+            return [
+                first_level_candidates.join(
+                    second_level_positive.select(
+                        "user_idx", "item_idx"
+                    ).withColumn("target", sf.lit(1.0)),
+                    on=["user_idx", "item_idx"],
+                    how="left",
+                ).fillna(0.0, subset="target")
+            ]
 
-        self.cached_list.append(second_level_train)
+        (second_level_train,) = self._checkpoint_dataframes(
+            "candidates", ["second_level_train"], get_second_level_train
+        )
+        second_level_train = manager.persist(
+            second_level_train, scope, "TwoStagesScenario.second_level_train",
+        )
+        manager.release(first_level_user_features, scope)
+        manager.release(first_level_item_features, scope)
 
         self.logger.info(
             "Distribution of classes in second-level train dataset:/n %s",
@@ -616,24 +1092,49 @@ class TwoStagesScenario(HybridRecommender):
             ),
         )
 
-        self.features_processor.fit(
-            log=first_level_train,
-            user_features=user_features,
-            item_features=item_features,
-        )
+        with profile("TwoStagesScenario.features_processor.fit"):
+            self.features_processor.fit(
+                log=first_level_train,
+                user_features=user_features,
+                item_features=item_features,
+            )
 
         self.logger.info("Adding features to second-level train dataset")
-        second_level_train_to_convert = self._add_features_for_second_level(
-            log_to_add_features=second_level_train,
-            log_for_first_level_models=first_level_train,
-            user_features=user_features,
-            item_features=item_features,
-        ).cache()
+        (second_level_train_to_convert,) = self._checkpoint_dataframes(
+            "features",
+            ["second_level_train_to_convert"],
+            lambda: [
+                self._add_features_for_second_level(
+                    log_to_add_features=second_level_train,
+                    log_for_first_level_models=first_level_train,
+                    user_features=user_features,
+                    item_features=item_features,
+                )
+            ],
+        )
+        second_level_train_to_convert = manager.persist(
+            second_level_train_to_convert,
+            scope,
+            "TwoStagesScenario.second_level_train_to_convert",
+        )
 
-        self.cached_list.append(second_level_train_to_convert)
-        self.second_stage_model.fit(second_level_train_to_convert)
-        for dataframe in self.cached_list:
-            unpersist_if_exists(dataframe)
+        stage = "second_level_fit"
+        stage_path = self._stage_path(stage)
+        if self._is_completed(stage):
+            model_path = join(stage_path, "model.joblib")
+            self.logger.info("Loading stage %s from %s", stage, model_path)
+            self.second_stage_model = joblib.load(model_path)
+        else:
+            with profile("TwoStagesScenario.second_stage_model.fit"):
+                self.second_stage_model.fit(second_level_train_to_convert)
+            if stage_path is not None:
+                os.makedirs(stage_path, exist_ok=True)
+                joblib.dump(
+                    self.second_stage_model, join(stage_path, "model.joblib")
+                )
+                self._complete(stage)
+        manager.release_scope(self._candidates_scope)
+        manager.release_scope(scope)
 
     # pylint: disable=too-many-arguments
     def _predict(
@@ -646,14 +1147,78 @@ class TwoStagesScenario(HybridRecommender):
         item_features: Optional[DataFrame] = None,
         filter_seen_items: bool = True,
     ) -> DataFrame:
+        """
+        Predictions are cached and materialized,
+        so candidates are released before returning.
+        They stay cached until the next predict, refit
+        or garbage collection of the scenario.
+        """
+        manager = CacheManager()
+        manager.release(self._predictions, instance_scope(self))
+        self._predictions = None
+        scope = f"{instance_scope(self)}.predict"
+        if self._checkpoint_path is None:
+            candidates_features = self._get_candidates_features(
+                log, users, items, user_features, item_features
+            )
+        else:
+            stage = "predict_" + get_fingerprint(
+                log, users, items, user_features, item_features
+            )
+            (candidates_features,) = self._checkpoint_dataframes(
+                stage,
+                ["candidates_features"],
+                lambda: [
+                    self._get_candidates_features(
+                        log, users, items, user_features, item_features
+                    )
+                ],
+            )
+        candidates_features = manager.persist(
+            candidates_features, scope, "TwoStagesScenario.candidates_features"
+        )
+        self.logger.info(
+            "Generated %s candidates for %s users",
+            candidates_features.count(),
+            candidates_features.select("user_idx").distinct().count(),
+        )
+        with profile("TwoStagesScenario.second_stage_model.predict"):
+            self._predictions = self._cache(
+                self.second_stage_model.predict(data=candidates_features, k=k),
+                "predictions",
+            )
+            self._predictions.count()
+        manager.release_scope(scope)
+        manager.release_scope(self._candidates_scope)
+        return self._predictions
 
+    def _get_candidates_features(
+        self,
+        log: DataFrame,
+        users: DataFrame,
+        items: DataFrame,
+        user_features: Optional[DataFrame] = None,
+        item_features: Optional[DataFrame] = None,
+    ) -> DataFrame:
+        """
+        Get candidates for inference and add features to them
+        """
         State().logger.debug(msg="Generating candidates to rerank")
 
-        first_level_user_features = cache_if_exists(
-            self.first_level_user_features_transformer.transform(user_features)
+        manager = CacheManager()
+        first_level_user_features = manager.persist(
+            self.first_level_user_features_transformer.transform(
+                user_features
+            ),
+            self._candidates_scope,
+            "TwoStagesScenario.first_level_user_features",
         )
-        first_level_item_features = cache_if_exists(
-            self.first_level_item_features_transformer.transform(item_features)
+        first_level_item_features = manager.persist(
+            self.first_level_item_features_transformer.transform(
+                item_features
+            ),
+            self._candidates_scope,
+            "TwoStagesScenario.first_level_item_features",
         )
 
         candidates = self._get_first_level_candidates(
@@ -665,26 +1230,16 @@ class TwoStagesScenario(HybridRecommender):
             user_features=first_level_user_features,
             item_features=first_level_item_features,
             log_to_filter=log,
-        ).select("user_idx", "item_idx")
+            quotas=self.num_candidates_per_model,
+        ).select("user_idx", "item_idx", *self._source_columns)
 
-        candidates_cached = candidates.cache()
-        unpersist_if_exists(first_level_user_features)
-        unpersist_if_exists(first_level_item_features)
         self.logger.info("Adding features")
-        candidates_features = self._add_features_for_second_level(
-            log_to_add_features=candidates_cached,
+        return self._add_features_for_second_level(
+            log_to_add_features=candidates,
             log_for_first_level_models=log,
             user_features=user_features,
             item_features=item_features,
         )
-        candidates_features.cache()
-        candidates_cached.unpersist()
-        self.logger.info(
-            "Generated %s candidates for %s users",
-            candidates_features.count(),
-            candidates_features.select("user_idx").distinct().count(),
-        )
-        return self.second_stage_model.predict(data=candidates_features, k=k)
 
     def fit_predict(
         self,
@@ -789,8 +1344,13 @@ class TwoStagesScenario(HybridRecommender):
             item_features
         )
 
-        first_level_user_features = cache_if_exists(first_level_user_features)
-        first_level_item_features = cache_if_exists(first_level_item_features)
+        scope = f"{instance_scope(self)}.optimize"
+        first_level_user_features = CacheManager().persist(
+            first_level_user_features, scope
+        )
+        first_level_item_features = CacheManager().persist(
+            first_level_item_features, scope
+        )
 
         params_found = []
         for i, model in enumerate(self.first_level_models):
@@ -822,6 +1382,7 @@ class TwoStagesScenario(HybridRecommender):
         if self.fallback_model is None or (
             isinstance(param_borders[-1], dict) and not param_borders[-1]
         ):
+            CacheManager().release_scope(scope)
             return params_found, None
 
         self.logger.info("Optimizing fallback-model")
@@ -835,6 +1396,5 @@ class TwoStagesScenario(HybridRecommender):
             criterion=criterion,
             new_study=new_study,
         )
-        unpersist_if_exists(first_level_item_features)
-        unpersist_if_exists(first_level_user_features)
+        CacheManager().release_scope(scope)
         return params_found, fallback_params
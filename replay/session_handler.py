@@ -2,6 +2,7 @@
 Painless creation and retrieval of Spark sessions
 """
 
+import json
 import logging
 import os
 import sys
@@ -12,10 +13,154 @@ import psutil
 import torch
 from pyspark.sql import SparkSession
 
+# set when ``State().profiler`` is not ``None``
+_PROFILING = False
+
+PROFILE_ENV_VAR = "REPLAY_SPARK_PROFILE"
+CONFIG_ENV_VAR = "REPLAY_SPARK_CONFIG"
+
+_KRYO_SETTINGS = {
+    "spark.serializer": "org.apache.spark.serializer.KryoSerializer",
+    "spark.kryoserializer.buffer.max": "512m",
+}
+
+SPARK_PROFILES: Dict[str, Dict[str, str]] = {
+    "local-small": {
+        "spark.sql.adaptive.enabled": "true",
+        "spark.sql.adaptive.coalescePartitions.enabled": "true",
+        "spark.sql.adaptive.coalescePartitions.minPartitionNum": "1",
+        "spark.sql.adaptive.advisoryPartitionSizeInBytes": "16m",
+        "spark.sql.adaptive.skewJoin.enabled": "false",
+        "spark.sql.autoBroadcastJoinThreshold": "64m",
+        "spark.sql.execution.arrow.maxRecordsPerBatch": "10000",
+        **_KRYO_SETTINGS,
+    },
+    "local-large": {
+        "spark.sql.adaptive.enabled": "true",
+        "spark.sql.adaptive.coalescePartitions.enabled": "true",
+        "spark.sql.adaptive.advisoryPartitionSizeInBytes": "64m",
+        "spark.sql.adaptive.skewJoin.enabled": "true",
+        "spark.sql.autoBroadcastJoinThreshold": "32m",
+        "spark.sql.execution.arrow.maxRecordsPerBatch": "20000",
+        "spark.memory.offHeap.enabled": "true",
+        "spark.memory.offHeap.size": "2g",
+        **_KRYO_SETTINGS,
+    },
+    "cluster": {
+        "spark.sql.adaptive.enabled": "true",
+        "spark.sql.adaptive.coalescePartitions.enabled": "true",
+        "spark.sql.adaptive.advisoryPartitionSizeInBytes": "128m",
+        "spark.sql.adaptive.skewJoin.enabled": "true",
+        "spark.sql.autoBroadcastJoinThreshold": "100m",
+        "spark.sql.execution.arrow.maxRecordsPerBatch": "50000",
+        "spark.memory.offHeap.enabled": "true",
+        "spark.memory.offHeap.size": "4g",
+        **_KRYO_SETTINGS,
+    },
+}
+
+
+def _read_config_file(config_path: Optional[str]) -> Dict[str, Any]:
+    """
+    Read json file with session settings.
+    File may contain ``profile`` key with profile name
+    and ``config`` key with a dictionary of Spark options.
+
+    :param config_path: path to json file
+    :return: file content or an empty dict if no file is given
+    """
+    if config_path is None:
+        return {}
+    with open(config_path, "r", encoding="utf-8") as config_file:
+        return json.load(config_file)
+
+
+def get_spark_config(
+    spark_memory: Optional[int] = None,
+    shuffle_partitions: Optional[int] = None,
+    profile: Optional[str] = None,
+    config_path: Optional[str] = None,
+) -> Dict[str, str]:
+    """
+    Collect options for SparkSession builder.
+
+    Settings are applied in the following order, later ones take precedence:
+    default settings, tuning profile, config file, function arguments.
+    Profile name and config file path are read from ``REPLAY_SPARK_PROFILE``
+    and ``REPLAY_SPARK_CONFIG`` environment variables if not passed explicitly.
+
+    >>> conf = get_spark_config(1, 2, profile="local-small")
+    >>> conf["spark.driver.memory"], conf["spark.sql.shuffle.partitions"]
+    ('1g', '2')
+    >>> conf["spark.sql.adaptive.enabled"]
+    'true'
+
+    :param spark_memory: GB of memory allocated for Spark;
+        70% of RAM by default.
+    :param shuffle_partitions: number of partitions for Spark;
+        triple CPU count by default, CPU count for ``local-small`` profile
+    :param profile: name of a tuning profile from ``SPARK_PROFILES``:
+        ``local-small``, ``local-large`` or ``cluster``.
+        No tuning is applied by default.
+    :param config_path: path to json file with ``profile`` and ``config`` keys
+    :return: dictionary with Spark options, ``spark.master`` included
+    """
+    file_settings = _read_config_file(
+        config_path or os.environ.get(CONFIG_ENV_VAR)
+    )
+    profile = (
+        profile
+        or file_settings.get("profile")
+        or os.environ.get(PROFILE_ENV_VAR)
+    )
+    if profile is not None and profile not in SPARK_PROFILES:
+        raise ValueError(
+            f"Unknown Spark profile {profile}, "
+            f"valid profiles are {list(SPARK_PROFILES)}"
+        )
+
+    config = {
+        "spark.driver.extraJavaOptions": "-Dio.netty.tryReflectionSetAccessible=true",
+        "spark.driver.maxResultSize": "4g",
+        "spark.sql.execution.arrow.pyspark.enabled": "true",
+    }
+    if profile != "cluster":
+        default_memory = floor(
+            psutil.virtual_memory().total / 1024 ** 3 * 0.7
+        )
+        default_partitions = os.cpu_count() * (
+            1 if profile == "local-small" else 3
+        )
+        config.update(
+            {
+                "spark.master": "local[*]",
+                "spark.driver.memory": f"{default_memory}g",
+                "spark.sql.shuffle.partitions": str(default_partitions),
+                "spark.local.dir": os.path.join(os.environ["HOME"], "tmp"),
+                "spark.driver.bindAddress": "127.0.0.1",
+                "spark.driver.host": "localhost",
+            }
+        )
+    if profile is not None:
+        config.update(SPARK_PROFILES[profile])
+    config.update(
+        {
+            key: str(value)
+            for key, value in file_settings.get("config", {}).items()
+        }
+    )
+    if spark_memory is not None:
+        config["spark.driver.memory"] = f"{spark_memory}g"
+    if shuffle_partitions is not None:
+        config["spark.sql.shuffle.partitions"] = str(shuffle_partitions)
+    return config
+
 
 def get_spark_session(
     spark_memory: Optional[int] = None,
     shuffle_partitions: Optional[int] = None,
+    profile: Optional[str] = None,
+    config_path: Optional[str] = None,
 ) -> SparkSession:
     """
     Get default SparkSession
@@ -23,35 +168,56 @@ def get_spark_session(
     :param spark_memory: GB of memory allocated for Spark;
         70% of RAM by default.
     :param shuffle_partitions: number of partitions for Spark; triple CPU count by default
+    :param profile: tuning profile name: ``local-small``, ``local-large`` or ``cluster``.
+        Profile sets adaptive query execution, partition coalescing,
+        broadcast threshold, Arrow batch size and Kryo serializer.
+        Can also be set with ``REPLAY_SPARK_PROFILE`` environment variable.
+    :param config_path: path to json file with ``profile`` name
+        and ``config`` dictionary of Spark options overriding the profile.
+        Can also be set with ``REPLAY_SPARK_CONFIG`` environment variable.
+
+    If a session already exists, it is returned with runtime options updated,
+    static options, such as serializer or off-heap memory, are not applied
+    and a warning is logged.
     """
     os.environ["PYSPARK_PYTHON"] = sys.executable
     os.environ["PYSPARK_DRIVER_PYTHON"] = sys.executable
 
-    if spark_memory is None:
-        spark_memory = floor(psutil.virtual_memory().total / 1024 ** 3 * 0.7)
-    if shuffle_partitions is None:
-        shuffle_partitions = os.cpu_count() * 3
-    driver_memory = f"{spark_memory}g"
-    user_home = os.environ["HOME"]
-    spark = (
-        SparkSession.builder.config("spark.driver.memory", driver_memory)
-        .config(
-            "spark.driver.extraJavaOptions",
-            "-Dio.netty.tryReflectionSetAccessible=true",
-        )
-        .config("spark.sql.shuffle.partitions", str(shuffle_partitions))
-        .config("spark.local.dir", os.path.join(user_home, "tmp"))
-        .config("spark.driver.maxResultSize", "4g")
-        .config("spark.driver.bindAddress", "127.0.0.1")
-        .config("spark.driver.host", "localhost")
-        .config("spark.sql.execution.arrow.pyspark.enabled", "true")
-        .master("local[*]")
-        .enableHiveSupport()
-        .getOrCreate()
+    config = get_spark_config(
+        spark_memory, shuffle_partitions, profile, config_path
     )
+    builder = SparkSession.builder
+    master = config.pop("spark.master", None)
+    if master is not None:
+        builder = builder.master(master)
+    for key, value in config.items():
+        builder = builder.config(key, value)
+    spark = builder.enableHiveSupport().getOrCreate()
+    # existing session keeps static options, e.g. serializer or off-heap memory
+    spark_conf = spark.sparkContext.getConf()
+    ignored = [
+        key
+        for key, value in config.items()
+        if not spark.conf.isModifiable(key)
+        and spark_conf.get(key, None) != value
+    ]
+    if ignored:
+        logging.getLogger("replay").warning(
+            "Spark session already exists, options %s are not applied. "
+            "Stop the session to create a new one with these options.",
+            ignored,
+        )
     return spark
 
 
+def is_profiling() -> bool:
+    """
+    :return: ``True`` if a profiler is active,
+        checked without creating ``State``
+    """
+    return _PROFILING
+
+
 def logger_with_settings() -> logging.Logger:
     """Set up default logging"""
     spark_logger = logging.getLogger("py4j")
@@ -88,21 +254,38 @@ class State(Borg):
     All modules look for Spark session via this class. You can put your own session here.
 
     Other parameters are stored here too: ``default device`` for ``pytorch`` (CPU/CUDA)
+
+    Session with one of the tuning profiles can be created by passing its name:
+
+    ``State(profile="local-large")``
+
+    Static options of the profile are not applied to an already running
+    session, a warning lists them.
+
+    Active ``replay.profiler.Profiler`` is stored in ``profiler`` attribute,
+    profiling is disabled if it is ``None``.
     """
 
     def __init__(
         self,
         session: Optional[SparkSession] = None,
         device: Optional[torch.device] = None,
+        profile: Optional[str] = None,
     ):
+        """
+        :param session: Spark session to use
+        :param device: ``pytorch`` device
+        :param profile: name of a tuning profile to create a session with
+            if ``session`` is not passed, see ``get_spark_session``
+        """
         Borg.__init__(self)
         if not hasattr(self, "logger_set"):
             self.logger = logger_with_settings()
             self.logger_set = True
 
         if session is None:
-            if not hasattr(self, "session"):
-                self.session = get_spark_session()
+            if not hasattr(self, "session") or profile is not None:
+                self.session = get_spark_session(profile=profile)
         else:
             self.session = session
 
@@ -116,3 +299,20 @@ class State(Borg):
                     self.device = torch.device("cpu")
         else:
             self.device = device
+
+        if not hasattr(self, "_profiler"):
+            self.profiler = None
+
+    @property
+    def profiler(self) -> Optional[Any]:
+        """
+        Active ``replay.profiler.Profiler``
+        """
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler: Optional[Any]):
+        # pylint: disable=global-statement
+        global _PROFILING
+        self._profiler = profiler
+        _PROFILING = profiler is not None
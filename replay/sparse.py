@@ -0,0 +1,288 @@
+"""
+Scipy sparse matrices built from interaction logs.
+
+Sorted interactions are streamed to the driver partition by partition
+as packed Arrow batches and written into preallocated arrays,
+which can be memory-mapped files. ``to_csr_shards`` builds matrices
+of user ranges on executors instead.
+"""
+import os
+from typing import Any, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyspark.sql.types as st
+from pyspark.sql import DataFrame, functions as sf
+from scipy.sparse import csc_matrix, csr_matrix
+
+PACKED_SCHEMA = st.StructType(
+    [
+        st.StructField(name, st.BinaryType())
+        for name in ["major_idx", "counts", "minor_idx", "relevance"]
+    ]
+)
+
+CSR_SHARD_SCHEMA = st.StructType(
+    [
+        st.StructField("first_row", st.LongType()),
+        st.StructField("num_rows", st.LongType()),
+        st.StructField("num_cols", st.LongType()),
+        st.StructField("indptr", st.BinaryType()),
+        st.StructField("indices", st.BinaryType()),
+        st.StructField("data", st.BinaryType()),
+    ]
+)
+
+
+def _pack_batches(major: str, minor: str, dtype: Any):
+    """
+    Pack Arrow batches sorted by ``major`` column into bytes
+    to send them to the driver without creating a Python object per row.
+    Relevance is packed as ``dtype`` values.
+    """
+
+    def pack(batches: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        for batch in batches:
+            if batch.empty:
+                continue
+            major_idx, counts = np.unique(
+                batch[major].to_numpy(np.int32), return_counts=True
+            )
+            yield pd.DataFrame(
+                {
+                    "major_idx": [major_idx.tobytes()],
+                    "counts": [counts.astype(np.int32).tobytes()],
+                    "minor_idx": [batch[minor].to_numpy(np.int32).tobytes()],
+                    "relevance": [
+                        batch["relevance"].to_numpy(dtype).tobytes()
+                    ],
+                }
+            )
+
+    return pack
+
+
+def _allocate(
+    path: Optional[str], name: str, size: int, dtype: Any
+) -> np.ndarray:
+    """
+    Zero array in memory or memory-mapped ``path/name.npy`` file
+    """
+    if path is None:
+        return np.zeros(size, dtype=dtype)
+    os.makedirs(path, exist_ok=True)
+    array = np.lib.format.open_memmap(
+        os.path.join(path, f"{name}.npy"),
+        mode="w+",
+        dtype=dtype,
+        shape=(size,),
+    )
+    array[:] = 0
+    return array
+
+
+# pylint: disable=too-many-locals, too-many-arguments
+def _compressed_arrays(
+    log: DataFrame,
+    major: str,
+    minor: str,
+    major_count: Optional[int],
+    minor_count: Optional[int],
+    path: Optional[str],
+    dtype: Any,
+) -> Tuple[Tuple[np.ndarray, np.ndarray, np.ndarray], Tuple[int, int]]:
+    """
+    Build ``data``, ``indices`` and ``indptr`` of a matrix
+    compressed along ``major`` column.
+
+    Interactions sorted by ``major`` and ``minor`` are streamed
+    partition by partition and written into preallocated arrays,
+    so the driver never holds the whole log.
+    """
+    log = log.select(major, minor, "relevance")
+    stats = log.agg(sf.count(sf.lit(1)), sf.max(major), sf.max(minor)).first()
+    nnz = stats[0]
+    if major_count is None:
+        major_count = stats[1] + 1 if stats[1] is not None else 0
+    if minor_count is None:
+        minor_count = stats[2] + 1 if stats[2] is not None else 0
+    index_dtype = np.int32 if nnz < 2 ** 31 else np.int64
+
+    indptr = _allocate(path, "indptr", major_count + 1, index_dtype)
+    indices = _allocate(path, "indices", nnz, index_dtype)
+    data = _allocate(path, "data", nnz, dtype)
+    position = 0
+    packed = log.orderBy(major, minor).mapInPandas(
+        _pack_batches(major, minor, dtype), PACKED_SCHEMA
+    )
+    for batch in packed.toLocalIterator(prefetchPartitions=True):
+        major_idx = np.frombuffer(batch["major_idx"], dtype=np.int32)
+        indptr[major_idx + 1] += np.frombuffer(batch["counts"], np.int32)
+        minor_idx = np.frombuffer(batch["minor_idx"], dtype=np.int32)
+        indices[position : position + len(minor_idx)] = minor_idx
+        data[position : position + len(minor_idx)] = np.frombuffer(
+            batch["relevance"], dtype=dtype
+        )
+        position += len(minor_idx)
+    np.cumsum(indptr, out=indptr)
+    return (data, indices, indptr), (int(major_count), int(minor_count))
+
+
+def to_csr(
+    log: DataFrame,
+    user_count: Optional[int] = None,
+    item_count: Optional[int] = None,
+    path: Optional[str] = None,
+    dtype: Any = np.float32,
+) -> csr_matrix:
+    """
+    Convert DataFrame to csr matrix with float32 values by default.
+    Interactions are streamed to the driver sorted by user,
+    duplicate interactions are summed up.
+
+    >>> import pandas as pd
+    >>> from replay.utils import convert2spark
+    >>> data_frame = pd.DataFrame({"user_idx": [0, 1], "item_idx": [0, 2], "relevance": [1, 2]})
+    >>> data_frame = convert2spark(data_frame)
+    >>> m = to_csr(data_frame)
+    >>> m.toarray()
+    array([[1., 0., 0.],
+           [0., 0., 2.]], dtype=float32)
+
+    :param log: interaction log with ``user_idx``, ``item_idx`` and
+    ``relevance`` columns
+    :param user_count: number of rows in resulting matrix
+    :param item_count: number of columns in resulting matrix
+    :param path: directory to store memory-mapped ``indptr``, ``indices``
+        and ``data`` arrays to, arrays are kept in memory if None
+    :param dtype: type of matrix values
+    """
+    arrays, shape = _compressed_arrays(
+        log, "user_idx", "item_idx", user_count, item_count, path, dtype
+    )
+    matrix = csr_matrix(arrays, shape=shape, copy=False)
+    matrix.sum_duplicates()
+    return matrix
+
+
+def to_csc(
+    log: DataFrame,
+    user_count: Optional[int] = None,
+    item_count: Optional[int] = None,
+    path: Optional[str] = None,
+    dtype: Any = np.float32,
+) -> csc_matrix:
+    """
+    Convert DataFrame to csc matrix with float32 values by default,
+    see ``to_csr``.
+
+    >>> import pandas as pd
+    >>> from replay.utils import convert2spark
+    >>> data_frame = pd.DataFrame({"user_idx": [0, 1], "item_idx": [0, 2], "relevance": [1, 2]})
+    >>> to_csc(convert2spark(data_frame)).indptr
+    array([0, 1, 1, 2], dtype=int32)
+
+    :param log: interaction log with ``user_idx``, ``item_idx`` and
+    ``relevance`` columns
+    :param user_count: number of rows in resulting matrix
+    :param item_count: number of columns in resulting matrix
+    :param path: directory to store memory-mapped ``indptr``, ``indices``
+        and ``data`` arrays to, arrays are kept in memory if None
+    :param dtype: type of matrix values
+    """
+    arrays, (item_count, user_count) = _compressed_arrays(
+        log, "item_idx", "user_idx", item_count, user_count, path, dtype
+    )
+    matrix = csc_matrix(arrays, shape=(user_count, item_count), copy=False)
+    matrix.sum_duplicates()
+    return matrix
+
+
+def to_csr_shards(
+    log: DataFrame, num_shards: int, item_count: Optional[int] = None
+) -> DataFrame:
+    """
+    Split interactions into ``num_shards`` csr matrices
+    with consecutive ranges of users, one shard per partition.
+    Shards are built on executors and can be processed there,
+    e.g. with ``mapInPandas``, after ``shard_to_csr`` conversion.
+
+    >>> import pandas as pd
+    >>> from replay.utils import convert2spark
+    >>> data_frame = pd.DataFrame({"user_idx": [0, 1, 3], "item_idx": [0, 2, 1], "relevance": [1, 2, 3]})
+    >>> shards = to_csr_shards(convert2spark(data_frame), 1).toPandas()
+    >>> shards[["first_row", "num_rows", "num_cols"]]
+       first_row  num_rows  num_cols
+    0          0         4         3
+    >>> shard_to_csr(shards.iloc[0]).toarray()
+    array([[1., 0., 0.],
+           [0., 0., 2.],
+           [0., 0., 0.],
+           [0., 3., 0.]], dtype=float32)
+
+    :param log: interaction log with ``user_idx``, ``item_idx`` and
+    ``relevance`` columns
+    :param num_shards: number of shards
+    :param item_count: number of columns in shards
+    :return: DataFrame
+        ``[first_row, num_rows, num_cols, indptr, indices, data]``
+    """
+    if item_count is None:
+        max_item = log.agg(sf.max("item_idx")).first()[0]
+        item_count = max_item + 1 if max_item is not None else 0
+
+    def build_shard(
+        batches: Iterator[pd.DataFrame],
+    ) -> Iterator[pd.DataFrame]:
+        batches = [batch for batch in batches if not batch.empty]
+        if not batches:
+            return
+        shard = pd.concat(batches, ignore_index=True)
+        rows = shard["user_idx"].to_numpy(np.int64)
+        first_row = rows[0]
+        num_rows = rows[-1] - first_row + 1
+        indptr = np.zeros(num_rows + 1, dtype=np.int32)
+        np.cumsum(
+            np.bincount(rows - first_row, minlength=num_rows),
+            out=indptr[1:],
+        )
+        yield pd.DataFrame(
+            {
+                "first_row": [first_row],
+                "num_rows": [num_rows],
+                "num_cols": [item_count],
+                "indptr": [indptr.tobytes()],
+                "indices": [shard["item_idx"].to_numpy(np.int32).tobytes()],
+                "data": [shard["relevance"].to_numpy(np.float32).tobytes()],
+            }
+        )
+
+    return (
+        log.select("user_idx", "item_idx", "relevance")
+        .repartitionByRange(num_shards, "user_idx")
+        .sortWithinPartitions("user_idx", "item_idx")
+        .mapInPandas(build_shard, CSR_SHARD_SCHEMA)
+    )
+
+
+def shard_to_csr(shard: Any) -> csr_matrix:
+    """
+    Convert a row of ``to_csr_shards`` result to csr matrix
+    without copying the arrays. Duplicate interactions are summed up.
+
+    :param shard: pandas Series or Spark Row
+    :return: csr matrix with ``num_rows`` rows starting from ``first_row`` user
+    """
+    matrix = csr_matrix(
+        (
+            np.frombuffer(shard["data"], dtype=np.float32),
+            np.frombuffer(shard["indices"], dtype=np.int32),
+            np.frombuffer(shard["indptr"], dtype=np.int32),
+        ),
+        shape=(shard["num_rows"], shard["num_cols"]),
+        copy=False,
+    )
+    if not matrix.has_canonical_format:
+        matrix = matrix.copy()
+        matrix.sum_duplicates()
+    return matrix
@@ -11,5 +11,7 @@ from replay.splitters.log_splitter import (
     ColdUserRandomSplitter,
     DateSplitter,
     RandomSplitter,
+    TimeWindow,
+    TimeWindowSplitter,
 )
 from replay.splitters.user_log_splitter import UserSplitter, k_folds
@@ -1,9 +1,11 @@
+import uuid
 from abc import ABC, abstractmethod
 from typing import Tuple
 
 from pyspark.sql import DataFrame
 from pyspark.sql import functions as sf
 
+from replay.cache import CacheManager
 from replay.constants import AnyDataFrame
 from replay.utils import convert2spark
 
@@ -23,6 +25,8 @@ class Splitter(ABC):
         """
         self.drop_cold_users = drop_cold_users
         self.drop_cold_items = drop_cold_items
+        # results may outlive the splitter, so the scope is not bound to it
+        self._cache_scope = f"{type(self).__name__}.split@{uuid.uuid4().hex}"
 
     @staticmethod
     def _filter_zero_relevance(dataframe: DataFrame) -> DataFrame:
@@ -76,6 +80,18 @@ class Splitter(ABC):
         :returns: `train` and `test DataFrames
         """
 
+    @property
+    def cache_scope(self) -> str:
+        """
+        Scope of ``split`` results in ``replay.cache.CacheManager``,
+        unique for each splitter instance.
+        Results are kept cached until the caller releases them
+        with ``CacheManager().release(dataframe, splitter.cache_scope)``
+        or ``CacheManager().release_scope(splitter.cache_scope)``,
+        or they are evicted by cache budget.
+        """
+        return self._cache_scope
+
     def split(self, log: AnyDataFrame) -> SplitterReturnType:
         """
         Splits input DataFrame into train and test
@@ -87,4 +103,12 @@ class Splitter(ABC):
         test = self._drop_cold_items_and_users(
             train, test, self.drop_cold_items, self.drop_cold_users
         )
-        return train.cache(), self._filter_zero_relevance(test).cache()
+        manager = CacheManager()
+        scope = self.cache_scope
+        name = f"{type(self).__name__}.split"
+        return (
+            manager.persist(train, scope, f"{name}.train"),
+            manager.persist(
+                self._filter_zero_relevance(test), scope, f"{name}.test"
+            ),
+        )  # type: ignore
@@ -2,27 +2,47 @@
 These kind of splitters process log as a whole:
 
 - by time
+- by rolling time windows
 - at random by test size
 - select cold users for test
 
 """
 
-from datetime import datetime
-from typing import Optional, Union
+from datetime import datetime, timedelta
+from typing import Iterator, NamedTuple, Optional, Tuple, Union
 
 import pyspark.sql.functions as sf
 from pyspark.sql import DataFrame, Window
 
+from replay.cache import CacheManager, instance_scope
+from replay.constants import AnyDataFrame
 from replay.splitters.base_splitter import (
     Splitter,
     SplitterReturnType,
 )
+from replay.utils import convert2spark
 
 
 # pylint: disable=too-few-public-methods
 class DateSplitter(Splitter):
     """
     Split into train and test by date.
+
+    If ``test_start`` is a fraction, split date is estimated with
+    ``approxQuantile`` without sorting the whole log.
+    Rank of the split date differs from the exact one by at most
+    ``relative_error * log size``, so test size may differ
+    from ``test_start * log size`` by this number of rows plus one
+    and interactions with the same timestamp as split date.
+
+    >>> import pandas as pd
+    >>> data_frame = pd.DataFrame({"user_idx": [1, 1, 2, 2, 3],
+    ...    "item_idx": [1, 2, 3, 1, 2],
+    ...    "relevance": [1, 1, 1, 1, 1],
+    ...    "timestamp": [10, 20, 30, 40, 50]})
+    >>> train, test = DateSplitter(test_start=0.5).split(data_frame)
+    >>> test.toPandas().timestamp.tolist()
+    [30, 40, 50]
     """
 
     def __init__(
@@ -30,34 +50,40 @@ class DateSplitter(Splitter):
         test_start: Union[datetime, float, str, int],
         drop_cold_items: bool = False,
         drop_cold_users: bool = False,
+        relative_error: float = 0.001,
     ):
         """
         :param test_start: string``yyyy-mm-dd``, int unix timestamp, datetime or a
             fraction for test size to determine data automatically
         :param drop_cold_items: flag to drop cold items from test
         :param drop_cold_users: flag to drop cold users from test
+        :param relative_error: relative error of split date rank
+            if ``test_start`` is a fraction, 0 to 1.
+            0 gives exact split but is expensive on large logs.
         """
         super().__init__(
             drop_cold_items=drop_cold_items, drop_cold_users=drop_cold_users
         )
         self.test_start = test_start
+        if relative_error < 0 or relative_error > 1:
+            raise ValueError("relative_error must be 0 to 1")
+        self.relative_error = relative_error
 
     def _core_split(self, log: DataFrame) -> SplitterReturnType:
         if isinstance(self.test_start, float):
-            dates = log.select("timestamp").withColumn(
-                "idx", sf.row_number().over(Window.orderBy("timestamp"))
-            )
-            test_start = int(dates.count() * (1 - self.test_start)) + 1
-            test_start = (
-                dates.filter(sf.col("idx") == test_start)
-                .select("timestamp")
-                .collect()[0][0]
+            # timestamps are compared as doubles the quantile is computed on
+            timestamp = sf.col("timestamp").cast("double")
+            test_start = sf.lit(
+                log.select(timestamp.alias("timestamp")).approxQuantile(
+                    "timestamp", [1 - self.test_start], self.relative_error
+                )[0]
             )
         else:
+            timestamp = sf.col("timestamp")
             dtype = dict(log.dtypes)["timestamp"]
             test_start = sf.lit(self.test_start).cast("timestamp").cast(dtype)
-        train = log.filter(sf.col("timestamp") < test_start)
-        test = log.filter(sf.col("timestamp") >= test_start)
+        train = log.filter(timestamp < test_start)
+        test = log.filter(timestamp >= test_start)
         return train, test
 
 
@@ -220,3 +246,155 @@ class ColdUserRandomSplitter(Splitter):
         train = log.join(train_users, on="user_idx", how="inner")
         test = log.join(test_users, on="user_idx", how="inner")
         return train, test
+
+
+class TimeWindow(NamedTuple):
+    """
+    Train and test of a time window.
+    ``added`` and ``removed`` are interactions which were added to train
+    and removed from it compared to the previous window,
+    they allow to update models instead of fitting them again.
+    """
+
+    test_start: datetime
+    train: DataFrame
+    test: DataFrame
+    added: DataFrame
+    removed: DataFrame
+
+
+# pylint: disable=too-many-instance-attributes
+class TimeWindowSplitter:
+    """
+    Rolling time windows for backtesting: train on ``train_duration`` before
+    test start, test on ``test_duration`` after it, test start moves by ``step``.
+
+    Log is filtered to the period of all windows and cached sorted by timestamp once,
+    windows are filters over the cached log which skip cached batches
+    outside of the window. Cache is released when all windows are consumed.
+
+    >>> import pandas as pd
+    >>> data_frame = pd.DataFrame({"user_idx": [1, 1, 2, 2, 3],
+    ...    "item_idx": [1, 2, 3, 1, 2],
+    ...    "relevance": [1, 1, 1, 1, 1],
+    ...    "timestamp": pd.to_datetime(["2020-01-01", "2020-01-02", "2020-01-03", "2020-01-04", "2020-01-05"])})
+    >>> splitter = TimeWindowSplitter("2020-01-03", n_windows=2, train_duration=timedelta(days=2))
+    >>> for window in splitter.split(data_frame):
+    ...     print(window.test_start.date(), window.train.count(), window.test.count(), window.added.count(), window.removed.count())
+    2020-01-03 2 1 2 0
+    2020-01-04 2 1 1 1
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        test_start: Union[datetime, str],
+        n_windows: int,
+        train_duration: timedelta,
+        test_duration: timedelta = timedelta(days=1),
+        step: Optional[timedelta] = None,
+        drop_cold_items: bool = False,
+        drop_cold_users: bool = False,
+    ):
+        """
+        :param test_start: test start of the first window,
+            datetime or string ``yyyy-mm-dd``
+        :param n_windows: number of windows
+        :param train_duration: length of train period
+        :param test_duration: length of test period
+        :param step: shift of the next window, ``test_duration`` by default
+        :param drop_cold_items: flag to drop cold items from test
+        :param drop_cold_users: flag to drop cold users from test
+        """
+        if isinstance(test_start, str):
+            test_start = datetime.fromisoformat(test_start)
+        if n_windows < 1:
+            raise ValueError("n_windows must be positive")
+        self.test_start = test_start
+        self.n_windows = n_windows
+        self.train_duration = train_duration
+        self.test_duration = test_duration
+        self.step = step or test_duration
+        self.drop_cold_items = drop_cold_items
+        self.drop_cold_users = drop_cold_users
+
+    @staticmethod
+    def _between(
+        dataframe: DataFrame, start: datetime, end: datetime
+    ) -> DataFrame:
+        """
+        :return: interactions with timestamp in ``[start, end)``
+        """
+        dtype = dict(dataframe.dtypes)["timestamp"]
+        start, end = [
+            sf.lit(date).cast("timestamp").cast(dtype) for date in [start, end]
+        ]
+        return dataframe.filter(
+            (sf.col("timestamp") >= start) & (sf.col("timestamp") < end)
+        )
+
+    def _train_changes(
+        self, log: DataFrame, test_start: datetime
+    ) -> Tuple[DataFrame, DataFrame]:
+        """
+        :param log: cached log
+        :param test_start: test start of a window after the first one
+        :return: interactions added to train and removed from it
+            compared to the previous window
+        """
+        train_start = test_start - self.train_duration
+        previous_end = test_start - self.step
+        previous_start = previous_end - self.train_duration
+        added = self._between(log, max(previous_end, train_start), test_start)
+        removed = self._between(
+            log, previous_start, min(train_start, previous_end)
+        )
+        return added, removed
+
+    def split(self, log: AnyDataFrame) -> Iterator[TimeWindow]:
+        """
+        Yields windows from the first to the last one
+
+        :param log: input DataFrame ``[timestamp, user_id, item_id, relevance]``
+        :return: ``TimeWindow`` generator
+        """
+        # pylint: disable=protected-access
+        last_test_start = self.test_start + self.step * (self.n_windows - 1)
+        manager = CacheManager()
+        scope = instance_scope(self)
+        log = manager.persist(
+            self._between(
+                convert2spark(log),
+                self.test_start - self.train_duration,
+                last_test_start + self.test_duration,
+            ).sortWithinPartitions("timestamp"),
+            scope,
+            "TimeWindowSplitter.log",
+        )
+        try:
+            for i in range(self.n_windows):
+                test_start = self.test_start + self.step * i
+                train = self._between(
+                    log, test_start - self.train_duration, test_start
+                )
+                test = Splitter._drop_cold_items_and_users(
+                    train,
+                    self._between(
+                        log, test_start, test_start + self.test_duration
+                    ),
+                    self.drop_cold_items,
+                    self.drop_cold_users,
+                )
+                if i == 0:
+                    added, removed = train, train.limit(0)
+                else:
+                    added, removed = self._train_changes(log, test_start)
+                yield TimeWindow(
+                    test_start=test_start,
+                    train=train,
+                    test=Splitter._filter_zero_relevance(test),
+                    added=added,
+                    removed=removed,
+                )
+        finally:
+            manager.release_scope(scope)
@@ -1,11 +1,14 @@
 """
 This splitter split data for each user separately
 """
+import random
+import uuid
 from typing import Optional, Union
 
 import pyspark.sql.functions as sf
-from pyspark.sql import DataFrame, Window
+from pyspark.sql import Column, DataFrame, Window
 
+from replay.cache import CacheManager
 from replay.constants import AnyDataFrame
 from replay.splitters.base_splitter import Splitter, SplitterReturnType
 from replay.utils import convert2spark
@@ -82,6 +85,15 @@ class UserSplitter(Splitter):
     >>> UserSplitter(user_test_size=0.5, item_test_size=2, seed=42).split(data_frame)[-1].toPandas().user_idx.nunique()
     1
 
+    With ``hash_split`` random choice of users and items (``shuffle``) depends only
+    on hashes of ``user_idx``, ``item_idx`` and ``seed``, not on partitioning of the log,
+    and needs no global sort or window by users. Fractions of users and items
+    are then taken approximately, e.g. each user gets into test with probability ``user_test_size``.
+    Repeated interactions with the same item get into the same part.
+    Split is random if ``seed`` is not set.
+
+    >>> UserSplitter(item_test_size=2, shuffle=True, seed=42, hash_split=True).split(data_frame)[-1].count()
+    4
     """
 
     # pylint: disable=too-many-arguments
@@ -93,6 +105,7 @@ class UserSplitter(Splitter):
         drop_cold_items: bool = False,
         drop_cold_users: bool = False,
         seed: Optional[int] = None,
+        hash_split: bool = False,
     ):
         """
         :param item_test_size: fraction or a number of items per user
@@ -103,6 +116,9 @@ class UserSplitter(Splitter):
         :param drop_cold_items: flag to drop cold items from test
         :param drop_cold_users: flag to drop cold users from test
         :param seed: random seed
+        :param hash_split: choose random users and items by hashes
+            of ids and seed, reproducible on any cluster.
+            Fractions of users and items are approximate.
         """
         super().__init__(
             drop_cold_items=drop_cold_items, drop_cold_users=drop_cold_users
@@ -111,6 +127,21 @@ class UserSplitter(Splitter):
         self.user_test_size = user_test_size
         self.shuffle = shuffle
         self.seed = seed
+        self.hash_split = hash_split
+
+    def _hash_rand(self, *columns: str) -> Column:
+        """
+        :param columns: columns to hash
+        :return: pseudo random value from [0, 1) which depends
+            only on values of the columns and seed,
+            seed is drawn randomly if it is not set
+        """
+        seed = self.seed
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+        hashed = sf.xxhash64(*columns, sf.lit(seed))
+        # 53 lower bits fit into double mantissa
+        return hashed.bitwiseAND(2 ** 53 - 1) / float(2 ** 53)
 
     def _get_test_users(self, log: DataFrame,) -> DataFrame:
         """
@@ -118,36 +149,40 @@ class UserSplitter(Splitter):
         :return: Spark DataFrame with single column `user_id`
         """
         all_users = log.select("user_idx").distinct()
-        user_count = all_users.count()
-        if self.user_test_size is not None:
-            value_error = False
-            if isinstance(self.user_test_size, int):
-                if 1 <= self.user_test_size < user_count:
-                    test_user_count = self.user_test_size
-                else:
-                    value_error = True
-            else:
-                if 1 > self.user_test_size > 0:
-                    test_user_count = user_count * self.user_test_size
-                else:
-                    value_error = True
-            if value_error:
-                raise ValueError(
-                    f"""
-                Invalid value for user_test_size: {self.user_test_size}
-                """
-                )
-            test_users = (
-                all_users.withColumn("rand", sf.rand(self.seed))
-                .withColumn(
-                    "row_num", sf.row_number().over(Window.orderBy("rand"))
-                )
-                .filter(f"row_num <= {test_user_count}")
-                .drop("rand", "row_num")
+        if self.user_test_size is None:
+            return all_users
+
+        if isinstance(self.user_test_size, int):
+            user_count = all_users.count()
+            value_error = not 1 <= self.user_test_size < user_count
+        else:
+            value_error = not 1 > self.user_test_size > 0
+        if value_error:
+            raise ValueError(
+                f"""
+            Invalid value for user_test_size: {self.user_test_size}
+            """
             )
+
+        if self.hash_split:
+            user_rand = self._hash_rand("user_idx")
+            if isinstance(self.user_test_size, int):
+                # top-k of partitions are merged without global sort
+                return all_users.orderBy(user_rand).limit(self.user_test_size)
+            return all_users.filter(user_rand < self.user_test_size)
+
+        if isinstance(self.user_test_size, int):
+            test_user_count = self.user_test_size
         else:
-            test_users = all_users
-        return test_users
+            test_user_count = all_users.count() * self.user_test_size
+        return (
+            all_users.withColumn("rand", sf.rand(self.seed))
+            .withColumn(
+                "row_num", sf.row_number().over(Window.orderBy("rand"))
+            )
+            .filter(f"row_num <= {test_user_count}")
+            .drop("rand", "row_num")
+        )
 
     def _split_proportion(self, log: DataFrame) -> SplitterReturnType:
         """
@@ -219,19 +254,57 @@ class UserSplitter(Splitter):
         ).drop("rand", "row_num", "test_user")
         return train, test
 
+    def _split_hash(self, log: DataFrame) -> SplitterReturnType:
+        """
+        Split by hashes of ids, ``item_test_size`` fraction of items
+        is taken approximately. A number of items is taken exactly
+        if user has no repeated items: interactions with the same item
+        share a hash and get into the same part.
+
+        :param log: input DataFrame `[timestamp, user_id, item_id, relevance]`
+        :return: train and test DataFrames
+        """
+        test_users = self._get_test_users(log).withColumn(
+            "test_user", sf.lit(1)
+        )
+        res = log.join(test_users, how="left", on="user_idx").withColumn(
+            "rand", self._hash_rand("user_idx", "item_idx")
+        )
+        if self.item_test_size < 1:
+            is_test = sf.col("rand") < self.item_test_size
+        else:
+            # hash of the item_test_size-th item of user,
+            # null if user has less items
+            thresholds = res.groupBy("user_idx").agg(
+                sf.expr(
+                    "element_at(array_sort(collect_list(rand)), "
+                    f"{self.item_test_size})"
+                ).alias("threshold")
+            )
+            res = res.join(thresholds, on="user_idx", how="left")
+            is_test = sf.col("threshold").isNull() | (
+                sf.col("rand") <= sf.col("threshold")
+            )
+        is_test = is_test & sf.col("test_user").isNotNull()
+        train = res.filter(~is_test).drop("rand", "threshold", "test_user")
+        test = res.filter(is_test).drop("rand", "threshold", "test_user")
+        return train, test
+
     def _core_split(self, log: DataFrame) -> SplitterReturnType:
         if 0 <= self.item_test_size < 1.0:
-            train, test = self._split_proportion(log)
+            split = self._split_proportion
         elif self.item_test_size >= 1 and isinstance(self.item_test_size, int):
-            train, test = self._split_quantity(log)
+            split = self._split_quantity
         else:
             raise ValueError(
                 "`test_size` value must be [0, 1) or "
                 "a positive integer; "
                 f"test_size={self.item_test_size}"
             )
+        if self.hash_split and self.shuffle:
+            split = self._split_hash
 
-        return train, test
+        return split(log)
 
     def _add_random_partition(self, dataframe: DataFrame) -> DataFrame:
         """
@@ -275,7 +348,15 @@ def k_folds(
     splitter: Optional[str] = "user",
 ) -> SplitterReturnType:
     """
-    Splits log inside each user into folds at random
+    Splits log inside each user into folds at random.
+
+    Folds are assigned by hashes of rows and seed, so they do not change
+    if the log is recomputed. Log with fold ids is cached partitioned
+    by users and sorted by fold inside partitions, so that all folds
+    share the storage and reading a test fold skips cached batches of other folds.
+    Every train split reads all but one fold, so the storage is not released
+    fold by fold: all folds share one cache which is released
+    after the last fold is consumed or when the generator is closed.
 
     :param log: input DataFrame
     :param n_folds: number of folds
@@ -286,15 +367,33 @@ def k_folds(
     if splitter not in {"user"}:
         raise ValueError(f"Wrong splitter parameter: {splitter}")
     if splitter == "user":
-        dataframe = convert2spark(log).withColumn("rand", sf.rand(seed))
-        dataframe = dataframe.withColumn(
-            "fold",
-            sf.row_number().over(
-                Window.partitionBy("user_idx").orderBy("rand")
+        manager = CacheManager()
+        scope = f"k_folds@{uuid.uuid4().hex}"
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+        dataframe = convert2spark(log)
+        columns = [sf.col(column) for column in dataframe.columns]
+        # hash of the whole row does not depend on the order of rows,
+        # so fold ids are the same whenever the cached log is recomputed,
+        # equal rows are interchangeable
+        rand = sf.xxhash64(*columns, sf.lit(seed))
+        # window by users reuses partitioning of the log
+        dataframe = (
+            dataframe.repartition("user_idx")
+            .withColumn(
+                "fold",
+                sf.row_number().over(
+                    Window.partitionBy("user_idx").orderBy(rand, *columns)
+                )
+                % n_folds,
             )
-            % n_folds,
-        ).drop("rand")
-        for i in range(n_folds):
-            train = dataframe.filter(f"fold != {i}").drop("fold")
-            test = dataframe.filter(f"fold == {i}").drop("fold")
-            yield train, test
+            .sortWithinPartitions("fold")
+        )
+        dataframe = manager.persist(dataframe, scope, "k_folds.log")
+        try:
+            for i in range(n_folds):
+                train = dataframe.filter(sf.col("fold") != i).drop("fold")
+                test = dataframe.filter(sf.col("fold") == i).drop("fold")
+                yield train, test
+        finally:
+            manager.release_scope(scope)
@@ -1,23 +1,159 @@
+# pylint: disable=too-many-lines
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from math import ceil
 from typing import Any, List, Optional, Set, Union
 
 import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pyspark.sql.types as st
 
+from pyspark.ml.functions import vector_to_array
 from pyspark.ml.linalg import DenseVector, Vectors, VectorUDT
 from pyspark.sql import Column, DataFrame, Window, functions as sf
-from scipy.sparse import csr_matrix
 
 from replay.constants import NumType, AnyDataFrame
+from replay.profiler import profile_stage
 from replay.session_handler import State
 
 # pylint: disable=invalid-name
 
+PARTITION_SIZE_CONF = "spark.replay.targetPartitionBytes"
+DEFAULT_PARTITION_SIZE = "64m"
+SPILL_DIR_CONF = "spark.replay.spillDir"
+SPILL_SIZE_CONF = "spark.replay.spillBytes"
+DEFAULT_SPILL_SIZE = "256m"
+COMPACT_PRECISION_CONF = "spark.replay.compactPrecision"
 
-def convert2spark(data_frame: Optional[AnyDataFrame]) -> Optional[DataFrame]:
+
+def _get_spill_dir() -> Optional[str]:
+    """
+    Directory for temporary parquet files, ``spark.replay.spillDir`` option.
+    If it is not set, system temporary directory is used in local mode.
     """
-    Converts Pandas DataFrame to Spark DataFrame
+    spark = State().session
+    spill_dir = spark.conf.get(SPILL_DIR_CONF, None)
+    if spill_dir is None and spark.sparkContext.master.startswith("local"):
+        spill_dir = tempfile.gettempdir()
+    return spill_dir
+
+
+def _spill_to_parquet(
+    data_frame: pd.DataFrame,
+    spill_dir: str,
+    schema: Optional[st.StructType] = None,
+) -> DataFrame:
+    """
+    Write pandas DataFrame to a temporary parquet file and read it
+    with Spark, row groups of the file are read in parallel.
+    The result is checkpointed locally, so the file is removed right away
+    and Spark releases the data when it is no longer referenced.
+    """
+    spark = State().session
+    path = tempfile.mkdtemp(prefix="replay-", dir=spill_dir)
+    try:
+        # naive timestamps are in session time zone as in createDataFrame
+        timezone = spark.conf.get("spark.sql.session.timeZone")
+        data_frame = data_frame.assign(
+            **{
+                column: data_frame[column].dt.tz_localize(
+                    timezone, ambiguous=False
+                )
+                for column in data_frame.columns
+                if pd.api.types.is_datetime64_dtype(data_frame[column])
+            }
+        )
+        table = pa.Table.from_pandas(data_frame, preserve_index=False)
+        row_group_size = max(
+            1,
+            len(data_frame)
+            * get_target_partition_size()
+            // max(table.nbytes, 1),
+        )
+        pq.write_table(
+            table,
+            os.path.join(path, "part-00000.parquet"),
+            row_group_size=row_group_size,
+            coerce_timestamps="us",
+            allow_truncated_timestamps=True,
+        )
+        result = spark.read.parquet(path)
+        if schema is not None:
+            result = result.select(
+                *[
+                    sf.col(field.name).cast(field.dataType)
+                    for field in schema.fields
+                ]
+            )
+        return result.localCheckpoint(eager=True)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+_NUMPY_TYPES = {
+    st.ByteType: np.int8,
+    st.ShortType: np.int16,
+    st.IntegerType: np.int32,
+    st.LongType: np.int64,
+    st.FloatType: np.float32,
+    st.DoubleType: np.float64,
+}
+
+
+def _cast_to_schema(
+    data_frame: pd.DataFrame, schema: st.StructType
+) -> pd.DataFrame:
+    """
+    Cast numeric columns of pandas DataFrame to the types of the schema,
+    so that ``createDataFrame`` accepts them with and without Arrow,
+    e.g. integer relevance for ``DoubleType``.
+    Integer types are not applied to float columns, which may have nulls.
+    """
+    dtypes = {}
+    for field in schema.fields:
+        numpy_type = _NUMPY_TYPES.get(type(field.dataType))
+        if numpy_type is None or field.name not in data_frame.columns:
+            continue
+        column = data_frame[field.name]
+        castable = pd.api.types.is_integer_dtype(column) or (
+            pd.api.types.is_float_dtype(column)
+            and np.issubdtype(numpy_type, np.floating)
+        )
+        if castable and column.dtype != numpy_type:
+            dtypes[field.name] = numpy_type
+    return data_frame.astype(dtypes) if dtypes else data_frame
+
+
+def convert2spark(
+    data_frame: Optional[AnyDataFrame], schema: Optional[st.StructType] = None
+) -> Optional[DataFrame]:
+    """
+    Converts Pandas DataFrame to Spark DataFrame.
+    Data is sent to Spark as Arrow record batches,
+    numeric columns are cast to the types of ``schema`` beforehand.
+    DataFrames larger than ``spark.replay.spillBytes`` option, ``256m``
+    by default, are written to a temporary parquet file in
+    ``spark.replay.spillDir`` directory and read from it in parallel.
+    The result is checkpointed locally and the file is removed.
+
+    >>> import pandas as pd
+    >>> from replay.constants import REC_SCHEMA
+    >>> recs = pd.DataFrame({"user_idx": [1], "item_idx": [2], "relevance": [1]})
+    >>> convert2spark(recs, REC_SCHEMA).dtypes
+    [('user_idx', 'int'), ('item_idx', 'int'), ('relevance', 'double')]
+    >>> from replay.session_handler import State
+    >>> State().session.conf.set("spark.replay.spillBytes", "1b")
+    >>> convert2spark(recs, REC_SCHEMA).dtypes
+    [('user_idx', 'int'), ('item_idx', 'int'), ('relevance', 'double')]
+    >>> State().session.conf.unset("spark.replay.spillBytes")
 
     :param data_frame: pandas DataFrame
+    :param schema: schema of the result, inferred from pandas types if None
     :return: converted data
     """
     if data_frame is None:
@@ -25,7 +161,19 @@ def convert2spark(data_frame: Optional[AnyDataFrame]) -> Optional[DataFrame]:
     if isinstance(data_frame, DataFrame):
         return data_frame
     spark = State().session
-    return spark.createDataFrame(data_frame)  # type: ignore
+    spill_size = byte_string_as_bytes(
+        spark.conf.get(SPILL_SIZE_CONF, DEFAULT_SPILL_SIZE)
+    )
+    spill_dir = _get_spill_dir()
+    # object columns are not counted to keep the estimate cheap
+    if (
+        spill_dir is not None
+        and data_frame.memory_usage(index=False).sum() > spill_size
+    ):
+        return _spill_to_parquet(data_frame, spill_dir, schema)
+    if schema is not None:
+        data_frame = _cast_to_schema(data_frame, schema)
+    return spark.createDataFrame(data_frame, schema)  # type: ignore
 
 
 def get_distinct_values_in_column(
@@ -107,6 +255,7 @@ def get_top_k(
     )
 
 
+@profile_stage()
 def get_top_k_recs(recs: DataFrame, k: int, id_type: str = "idx") -> DataFrame:
     """
     Get top k recommendations by `relevance`.
@@ -244,6 +393,347 @@ def array_mult(first: st.ArrayType, second: st.ArrayType):
     return [first[i] * second[i] for i in range(len(first))]
 
 
+def multiply_arrays(first: str, second: str) -> Column:
+    """
+    Elementwise multiplication of array columns
+    computed with Spark SQL higher-order functions, without Python UDF.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> input_data = (
+    ...     spark.createDataFrame([([1.0, 2.0], [3.0, 4.0])])
+    ...     .toDF("one", "two")
+    ... )
+    >>> input_data.select(multiply_arrays("one", "two").alias("mult")).show()
+    +----------+
+    |      mult|
+    +----------+
+    |[3.0, 8.0]|
+    +----------+
+    <BLANKLINE>
+
+    :param first: name of the first array column
+    :param second: name of the second array column
+    :returns: array column
+    """
+    return sf.expr(f"zip_with(`{first}`, `{second}`, (x, y) -> x * y)")
+
+
+def arrays_dot(first: str, second: str) -> Column:
+    """
+    Dot product of array columns
+    computed with Spark SQL higher-order functions, without Python UDF.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> input_data = (
+    ...     spark.createDataFrame([([1.0, 2.0], [3.0, 4.0])])
+    ...     .toDF("one", "two")
+    ... )
+    >>> input_data.select(arrays_dot("one", "two").alias("dot")).show()
+    +----+
+    | dot|
+    +----+
+    |11.0|
+    +----+
+    <BLANKLINE>
+
+    :param first: name of the first array column
+    :param second: name of the second array column
+    :returns: double column
+    """
+    return sf.expr(
+        f"aggregate(zip_with(`{first}`, `{second}`, (x, y) -> x * y), "
+        "CAST(0 AS DOUBLE), (acc, x) -> acc + x)"
+    )
+
+
+def scale_array(scalar: str, array: str) -> Column:
+    """
+    Multiply array column by numeric column
+    with Spark SQL higher-order functions, without Python UDF.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> input_data = spark.createDataFrame([(2.0, [3.0, 4.0])]).toDF("one", "two")
+    >>> input_data.select(scale_array("one", "two").alias("mult")).show()
+    +----------+
+    |      mult|
+    +----------+
+    |[6.0, 8.0]|
+    +----------+
+    <BLANKLINE>
+
+    :param scalar: name of numeric column
+    :param array: name of array column
+    :returns: array column
+    """
+    return sf.expr(f"transform(`{array}`, x -> x * `{scalar}`)")
+
+
+def average_arrays(column: str, size: int) -> Column:
+    """
+    Aggregate function, elementwise mean of array column
+    computed in one pass by ``size`` averages of array elements.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> input_data = spark.createDataFrame([(1, [1.0, 2.0]), (1, [3.0, 6.0])]).toDF("id", "array")
+    >>> input_data.groupBy("id").agg(average_arrays("array", 2).alias("mean")).show()
+    +---+----------+
+    | id|      mean|
+    +---+----------+
+    |  1|[2.0, 4.0]|
+    +---+----------+
+    <BLANKLINE>
+
+    :param column: name of array column
+    :param size: size of arrays
+    :returns: array column
+    """
+    return sf.array(*[sf.avg(sf.col(column)[i]) for i in range(size)])
+
+
+def arrays_squared_distance(first: str, second: str) -> Column:
+    """
+    Squared euclidean distance between array columns
+    computed with Spark SQL higher-order functions, without Python UDF.
+
+    :param first: name of the first array column
+    :param second: name of the second array column
+    :returns: double column
+    """
+    return sf.expr(
+        f"aggregate(zip_with(`{first}`, `{second}`, "
+        "(x, y) -> (x - y) * (x - y)), CAST(0 AS DOUBLE), (acc, x) -> acc + x)"
+    )
+
+
+def arrays_euclidean_distance_similarity(first: str, second: str) -> Column:
+    """
+    ``1 / (1 + euclidean distance)`` between array columns,
+    see ``arrays_squared_distance``.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> input_data = (
+    ...     spark.createDataFrame([([1.0, 2.0], [4.0, 6.0])])
+    ...     .toDF("one", "two")
+    ... )
+    >>> input_data.select(sf.round(arrays_euclidean_distance_similarity("one", "two"), 4).alias("sim")).show()
+    +------+
+    |   sim|
+    +------+
+    |0.1667|
+    +------+
+    <BLANKLINE>
+
+    :param first: name of the first array column
+    :param second: name of the second array column
+    :returns: double column
+    """
+    return 1 / (1 + sf.sqrt(arrays_squared_distance(first, second)))
+
+
+def arrays_cosine_similarity(first: str, second: str) -> Column:
+    """
+    Cosine similarity of array columns
+    computed with Spark SQL higher-order functions, without Python UDF.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> input_data = (
+    ...     spark.createDataFrame([([1.0, 0.0], [3.0, 3.0])])
+    ...     .toDF("one", "two")
+    ... )
+    >>> input_data.select(sf.round(arrays_cosine_similarity("one", "two"), 4).alias("cos")).show()
+    +------+
+    |   cos|
+    +------+
+    |0.7071|
+    +------+
+    <BLANKLINE>
+
+    :param first: name of the first array column
+    :param second: name of the second array column
+    :returns: double column
+    """
+    return arrays_dot(first, second) / (
+        sf.sqrt(arrays_dot(first, first)) * sf.sqrt(arrays_dot(second, second))
+    )
+
+
+def vectors_to_arrays(dataframe: DataFrame, *columns: str) -> DataFrame:
+    """
+    Convert ``VectorUDT`` columns to arrays of doubles
+    to process them with Spark SQL functions or pandas UDFs.
+    Array columns are left as is.
+
+    :param dataframe: Spark DataFrame
+    :param columns: names of vector or array columns
+    :return: DataFrame with array columns
+    """
+    for column in columns:
+        if isinstance(dataframe.schema[column].dataType, VectorUDT):
+            dataframe = dataframe.withColumn(column, vector_to_array(column))
+    return dataframe
+
+
+def is_compact_precision() -> bool:
+    """
+    :return: ``True`` if ``spark.replay.compactPrecision`` option is set
+        to ``true``
+    """
+    spark = State().session
+    return spark.conf.get(COMPACT_PRECISION_CONF, "false").lower() == "true"
+
+
+def compact_precision(
+    dataframe: Optional[DataFrame], force: bool = False
+) -> Optional[DataFrame]:
+    """
+    Cast double and array of doubles columns to float precision
+    if ``spark.replay.compactPrecision`` option is ``true``.
+    Relevance, similarities and embeddings take half as much memory
+    in cache and in shuffles.
+    DataFrame is returned as is if there is nothing to cast.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> df = spark.createDataFrame([(1, 0.5, [1.0, 2.0])]).toDF("user_idx", "relevance", "vector")
+    >>> compact_precision(df) is df
+    True
+    >>> compact_precision(df, force=True).dtypes
+    [('user_idx', 'bigint'), ('relevance', 'float'), ('vector', 'array<float>')]
+
+    :param dataframe: Spark DataFrame or ``None``
+    :param force: cast regardless of the option
+    :return: DataFrame with float columns
+    """
+    if dataframe is None or not (force or is_compact_precision()):
+        return dataframe
+    columns = []
+    compacted = False
+    for field in dataframe.schema.fields:
+        column = sf.col(field.name)
+        if isinstance(field.dataType, st.DoubleType):
+            column = column.cast(st.FloatType()).alias(field.name)
+            compacted = True
+        elif isinstance(field.dataType, st.ArrayType) and isinstance(
+            field.dataType.elementType, st.DoubleType
+        ):
+            column = column.cast(st.ArrayType(st.FloatType())).alias(
+                field.name
+            )
+            compacted = True
+        columns.append(column)
+    if not compacted:
+        return dataframe
+    return dataframe.select(*columns)
+
+
+@sf.pandas_udf(st.DoubleType())  # type: ignore
+def arrays_dot_pandas(first: pd.Series, second: pd.Series) -> pd.Series:
+    """
+    Dot product of array columns of the same length,
+    computed with NumPy for Arrow batches of rows.
+    Vector columns can be converted with ``vectors_to_arrays``.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> input_data = (
+    ...     spark.createDataFrame([([1.0, 2.0], [3.0, 4.0])])
+    ...     .toDF("one", "two")
+    ... )
+    >>> input_data.select(arrays_dot_pandas("one", "two").alias("dot")).show()
+    +----+
+    | dot|
+    +----+
+    |11.0|
+    +----+
+    <BLANKLINE>
+
+    :param first: first array column
+    :param second: second array column
+    :returns: double column
+    """
+    return pd.Series(np.einsum("ij,ij->i", np.stack(first), np.stack(second)))
+
+
+@sf.pandas_udf(st.DoubleType())  # type: ignore
+def arrays_euclidean_distance_similarity_pandas(
+    first: pd.Series, second: pd.Series
+) -> pd.Series:
+    """
+    ``1 / (1 + euclidean distance)`` between array columns of the same length,
+    computed with NumPy for Arrow batches of rows.
+
+    :param first: first array column
+    :param second: second array column
+    :returns: double column
+    """
+    distance = np.linalg.norm(np.stack(first) - np.stack(second), axis=1)
+    return pd.Series(1 / (1 + distance))
+
+
+@sf.pandas_udf(st.DoubleType())  # type: ignore
+def arrays_cosine_similarity_pandas(
+    first: pd.Series, second: pd.Series
+) -> pd.Series:
+    """
+    Cosine similarity of array columns of the same length,
+    computed with NumPy for Arrow batches of rows.
+
+    :param first: first array column
+    :param second: second array column
+    :returns: double column
+    """
+    first, second = np.stack(first), np.stack(second)
+    return pd.Series(
+        np.einsum("ij,ij->i", first, second)
+        / (np.linalg.norm(first, axis=1) * np.linalg.norm(second, axis=1))
+    )
+
+
+def get_fingerprint(
+    *dataframes: Optional[DataFrame], params: Any = None
+) -> str:
+    """
+    Fingerprint of DataFrames content and parameters.
+    Content of each DataFrame is summarized by its schema, number of rows
+    and sum of row hashes with one Spark job, so row order does not matter.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> first = spark.createDataFrame([(1, 2.0), (2, 3.0)], ["id", "value"])
+    >>> second = spark.createDataFrame([(2, 3.0), (1, 2.0)], ["id", "value"])
+    >>> get_fingerprint(first) == get_fingerprint(second)
+    True
+    >>> get_fingerprint(first, params={"k": 1}) == get_fingerprint(first)
+    False
+    >>> get_fingerprint(first, None) == get_fingerprint(first)
+    False
+
+    :param dataframes: Spark DataFrames or ``None``
+    :param params: any object with deterministic ``repr``
+    :return: hex string
+    """
+    digest = hashlib.sha1(repr(params).encode())
+    for dataframe in dataframes:
+        if dataframe is None:
+            digest.update(b"None")
+            continue
+        stats = dataframe.select(
+            sf.count(sf.lit(1)),
+            sf.sum(
+                sf.xxhash64(*dataframe.columns).cast(st.DecimalType(38, 0))
+            ),
+        ).first()
+        digest.update(dataframe.schema.json().encode())
+        digest.update(repr(tuple(stats)).encode())
+    return digest.hexdigest()[:16]
+
+
 def get_log_info(log: DataFrame) -> str:
     """
     Basic log statistics
@@ -346,53 +836,12 @@ def check_numeric(feature_table: DataFrame) -> None:
             )
 
 
-def to_csr(
-    log: DataFrame,
-    user_count: Optional[int] = None,
-    item_count: Optional[int] = None,
-) -> csr_matrix:
-    """
-    Convert DataFrame to csr matrix
-
-    >>> import pandas as pd
-    >>> from replay.utils import convert2spark
-    >>> data_frame = pd.DataFrame({"user_idx": [0, 1], "item_idx": [0, 2], "relevance": [1, 2]})
-    >>> data_frame = convert2spark(data_frame)
-    >>> m = to_csr(data_frame)
-    >>> m.toarray()
-    array([[1, 0, 0],
-           [0, 0, 2]])
-
-    :param log: interaction log with ``user_idx``, ``item_idx`` and
-    ``relevance`` columns
-    :param user_count: number of rows in resulting matrix
-    :param item_count: number of columns in resulting matrix
-    """
-    pandas_df = log.select("user_idx", "item_idx", "relevance").toPandas()
-    row_count = int(
-        user_count
-        if user_count is not None
-        else pandas_df["user_idx"].max() + 1
-    )
-    col_count = int(
-        item_count
-        if item_count is not None
-        else pandas_df["item_idx"].max() + 1
-    )
-    return csr_matrix(
-        (
-            pandas_df["relevance"],
-            (pandas_df["user_idx"], pandas_df["item_idx"]),
-        ),
-        shape=(row_count, col_count),
-    )
-
-
 def horizontal_explode(
     data_frame: DataFrame,
     column_to_explode: str,
     prefix: str,
     other_columns: List[Column],
+    num_columns: Optional[int] = None,
 ) -> DataFrame:
     """
     Transform a column with an array of values into separate columns.
@@ -425,9 +874,12 @@ def horizontal_explode(
     :param column_to_explode: column with type ``array``
     :param prefix: prefix used for new columns, suffix is an integer
     :param other_columns: columns to select beside newly created
+    :param num_columns: length of arrays, if not set
+        it is taken from the first row which starts a Spark job
     :returns: DataFrame with elements from ``column_to_explode``
     """
-    num_columns = len(data_frame.select(column_to_explode).head()[0])
+    if num_columns is None:
+        num_columns = len(data_frame.select(column_to_explode).head()[0])
     return data_frame.select(
         *other_columns,
         *[
@@ -459,6 +911,26 @@ def fallback(
     Fill missing recommendations for users that have less than ``k`` recomended items.
     Score values for the fallback model may be decreased to preserve sorting.
 
+    Recommendations are merged by rank in one pass partitioned by user:
+    ``fill`` relevance of a user is shifted below the minimal ``base`` relevance
+    of the same user, so no global aggregations are computed.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> base = spark.createDataFrame([(1, 1, 1.0)], ["user_idx", "item_idx", "relevance"])
+    >>> fill = spark.createDataFrame(
+    ...     [(1, 1, 1.0), (1, 2, 2.0), (2, 1, 1.0)], ["user_idx", "item_idx", "relevance"]
+    ... )
+    >>> fallback(base, fill, 2).orderBy("user_idx", sf.desc("relevance")).show()
+    +--------+--------+---------+
+    |user_idx|item_idx|relevance|
+    +--------+--------+---------+
+    |       1|       1|      1.0|
+    |       1|       2|      0.9|
+    |       2|       1|      1.0|
+    +--------+--------+---------+
+    <BLANKLINE>
+
     :param base: base recommendations that need to be completed
     :param fill: extra recommendations
     :param k: desired recommendation list lengths for each user
@@ -467,25 +939,49 @@ def fallback(
     """
     if fill is None:
         return base
-    if base.count() == 0:
-        return get_top_k_recs(fill, k, id_type)
     margin = 0.1
-    min_in_base = base.agg({"relevance": "min"}).collect()[0][0]
-    max_in_fill = fill.agg({"relevance": "max"}).collect()[0][0]
+    user_col = "user_" + id_type
+    item_col = "item_" + id_type
+    columns = [user_col, item_col, "relevance"]
+    recs = (
+        base.select(*columns)
+        .withColumn("priority", sf.lit(0))
+        .unionByName(fill.select(*columns).withColumn("priority", sf.lit(1)))
+        .repartition(user_col)
+    )
+    # keep base recommendation if an item is recommended by both models
+    recs = recs.withColumn(
+        "item_rank",
+        sf.row_number().over(
+            Window.partitionBy(user_col, item_col).orderBy("priority")
+        ),
+    ).filter(sf.col("item_rank") == 1)
+
+    by_user = Window.partitionBy(user_col)
+    min_in_base = sf.min(
+        sf.when(sf.col("priority") == 0, sf.col("relevance"))
+    ).over(by_user)
+    max_in_fill = sf.max(
+        sf.when(sf.col("priority") == 1, sf.col("relevance"))
+    ).over(by_user)
     diff = max_in_fill - min_in_base
-    fill = fill.withColumnRenamed("relevance", "relevance_fallback")
-    if diff >= 0:
-        fill = fill.withColumn(
-            "relevance_fallback", sf.col("relevance_fallback") - diff - margin
+    recs = recs.withColumn(
+        "relevance",
+        sf.when(
+            (sf.col("priority") == 1) & (diff >= 0),
+            sf.col("relevance") - diff - margin,
+        ).otherwise(sf.col("relevance")),
+    )
+    return (
+        recs.withColumn(
+            "rank",
+            sf.row_number().over(
+                by_user.orderBy("priority", sf.col("relevance").desc())
+            ),
         )
-    recs = base.join(
-        fill, on=["user_" + id_type, "item_" + id_type], how="full_outer"
+        .filter(sf.col("rank") <= k)
+        .select(*columns)
     )
-    recs = recs.withColumn(
-        "relevance", sf.coalesce("relevance", "relevance_fallback")
-    ).select("user_" + id_type, "item_" + id_type, "relevance")
-    recs = get_top_k_recs(recs, k, id_type)
-    return recs
 
 
 def cache_if_exists(dataframe: Optional[DataFrame]) -> Optional[DataFrame]:
@@ -676,3 +1172,197 @@ def cosine_similarity(first: DenseVector, second: DenseVector) -> float:
     num = first.dot(second)
     denom = first.dot(first) ** 0.5 * second.dot(second) ** 0.5
     return float(num / denom)
+
+
+def get_size_in_bytes(dataframe: DataFrame) -> Optional[int]:
+    """
+    Estimate DataFrame size with optimizer statistics.
+    No Spark jobs are triggered.
+
+    :param dataframe: Spark DataFrame
+    :return: estimated size in bytes or ``None`` if Spark
+        has no estimation for the data source
+    """
+    spark = State().session
+    # pylint: disable=protected-access
+    size = int(
+        dataframe._jdf.queryExecution()
+        .optimizedPlan()
+        .stats()
+        .sizeInBytes()
+        .toString()
+    )
+    # statistics are unknown and Spark falls back to default value
+    if size >= int(spark.conf.get("spark.sql.defaultSizeInBytes")):
+        return None
+    return size
+
+
+def get_target_partition_size() -> int:
+    """
+    Target partition size is taken from ``spark.replay.targetPartitionBytes``
+    option of Spark session. If it is not set,
+    ``spark.sql.adaptive.advisoryPartitionSizeInBytes`` is used.
+
+    >>> from replay.session_handler import State
+    >>> spark = State().session
+    >>> spark.conf.set("spark.replay.targetPartitionBytes", "1m")
+    >>> get_target_partition_size()
+    1048576
+    >>> spark.conf.unset("spark.replay.targetPartitionBytes")
+
+    :return: target partition size in bytes
+    """
+    spark = State().session
+    size = spark.conf.get(
+        PARTITION_SIZE_CONF,
+        spark.conf.get(
+            "spark.sql.adaptive.advisoryPartitionSizeInBytes",
+            DEFAULT_PARTITION_SIZE,
+        ),
+    )
+    return byte_string_as_bytes(size)
+
+
+def byte_string_as_bytes(size: str) -> int:
+    """
+    Convert size string with Spark units to bytes
+
+    >>> byte_string_as_bytes("2k")
+    2048
+
+    :param size: size with unit, e.g. ``64m`` or ``1g``
+    :return: size in bytes
+    """
+    spark = State().session
+    # pylint: disable=protected-access
+    return (
+        spark._jvm.org.apache.spark.network.util.JavaUtils.byteStringAsBytes(
+            size
+        )
+    )
+
+
+def get_num_partitions(dataframe: DataFrame) -> int:
+    """
+    Number of partitions of DataFrame taken from its physical plan.
+    Unlike ``dataframe.rdd.getNumPartitions()`` it does not start
+    sampling jobs for range partitioned DataFrames.
+
+    :param dataframe: Spark DataFrame
+    :return: number of partitions
+    """
+    # pylint: disable=protected-access
+    num_partitions = (
+        dataframe._jdf.queryExecution()
+        .executedPlan()
+        .outputPartitioning()
+        .numPartitions()
+    )
+    if num_partitions > 0:
+        return num_partitions
+    # partitioning of scans is unknown to the plan, no jobs are needed
+    return dataframe.rdd.getNumPartitions()
+
+
+def get_self_join_size(dataframe: DataFrame, key: str) -> int:
+    """
+    Estimate size of inner join of DataFrame with itself on ``key`` column,
+    e.g. item pairs of users, which grows quadratically
+    with the number of rows per key.
+    One aggregation job is started.
+
+    :param dataframe: Spark DataFrame
+    :param key: join column
+    :return: estimated size of join result in bytes
+    """
+    rows = (
+        dataframe.groupBy(key)
+        .count()
+        .select(sf.sum(sf.col("count").cast("double") ** 2))
+        .first()[0]
+    )
+    # pylint: disable=protected-access
+    row_size = 2 * max(dataframe._jdf.schema().defaultSize(), 1)
+    return int((rows or 0) * row_size)
+
+
+def repartition_by_size(
+    dataframe: DataFrame,
+    operation: str,
+    *cols: Union[str, Column],
+    size_in_bytes: Optional[int] = None,
+) -> DataFrame:
+    """
+    Repartition or coalesce DataFrame so that each partition
+    holds about ``spark.replay.targetPartitionBytes`` of data.
+    Coalesce is used if the number of partitions decreases
+    and no partitioning columns are passed, so no shuffle occurs.
+    DataFrame is returned unchanged if its size can not be estimated.
+    Current number of partitions is taken from the physical plan.
+
+    :param dataframe: Spark DataFrame
+    :param operation: operation name to log the decision
+    :param cols: columns to hash partition by
+    :param size_in_bytes: size of data processed by the operation,
+        estimated with ``get_size_in_bytes`` by default
+    :return: repartitioned DataFrame
+    """
+    logger = logging.getLogger("replay")
+    if size_in_bytes is None:
+        size_in_bytes = get_size_in_bytes(dataframe)
+    if size_in_bytes is None:
+        logger.debug(
+            "%s: data size is unknown, partitioning is unchanged", operation
+        )
+        return dataframe
+
+    target_size = get_target_partition_size()
+    num_partitions = max(1, ceil(size_in_bytes / target_size))
+    current_partitions = get_num_partitions(dataframe)
+    logger.debug(
+        "%s: estimated size %s bytes, target partition size %s bytes, "
+        "%s partitions -> %s partitions",
+        operation,
+        size_in_bytes,
+        target_size,
+        current_partitions,
+        num_partitions,
+    )
+    if cols:
+        return dataframe.repartition(num_partitions, *cols)
+    if num_partitions < current_partitions:
+        return dataframe.coalesce(num_partitions)
+    if num_partitions > current_partitions:
+        return dataframe.repartition(num_partitions)
+    return dataframe
+
+
+def cross_join_by_size(
+    left: DataFrame, right: DataFrame, operation: str
+) -> DataFrame:
+    """
+    Cross join with the number of partitions
+    of the ``left`` side chosen by the estimated size of the result.
+    ``right`` side is expected to be small enough to be broadcasted.
+
+    :param left: Spark DataFrame, e.g. users
+    :param right: Spark DataFrame, e.g. items
+    :param operation: operation name to log the decision
+    :return: cross join result
+    """
+    sizes = [get_size_in_bytes(df) for df in (left, right)]
+    if None in sizes:
+        return left.crossJoin(right)
+    # pylint: disable=protected-access
+    row_sizes = [
+        max(df._jdf.schema().defaultSize(), 1) for df in (left, right)
+    ]
+    result_size = (
+        (sizes[0] // row_sizes[0])
+        * (sizes[1] // row_sizes[1])
+        * sum(row_sizes)
+    )
+    return repartition_by_size(
+        left, operation, size_in_bytes=result_size
+    ).crossJoin(right)
@@ -7,6 +7,7 @@ import numpy as np
 from pyspark.sql import functions as sf
 
 from replay.constants import LOG_SCHEMA
+from replay.metrics import NDCG
 from replay.models import (
     ALSWrap,
     ADMMSLIM,
@@ -321,3 +322,32 @@ def test_predict_cold_and_new_filter_out(model, long_log_with_features):
         assert pred.count() == 0
     else:
         assert 1 <= pred.count() <= 2
+
+
+@pytest.mark.parametrize(
+    "model",
+    [KNN(), PopRec(), SLIM(seed=SEED), Word2VecRec(seed=SEED, min_count=0)],
+    ids=["knn", "poprec", "slim", "word2vec"],
+)
+def test_compact_precision(spark, log, model):
+    recs = model.fit_predict(log, k=3, filter_seen_items=False)
+    ndcg = NDCG()(recs, log, 3)
+    assert ndcg > 0
+
+    spark.conf.set("spark.replay.compactPrecision", "true")
+    try:
+        compact_recs = model.fit_predict(log, k=3, filter_seen_items=False)
+        compact_ndcg = NDCG()(compact_recs, log, 3)
+        pairs_pred = model.predict_pairs(
+            log.select("user_idx", "item_idx"), log
+        )
+    finally:
+        spark.conf.unset("spark.replay.compactPrecision")
+
+    assert dict(compact_recs.dtypes)["relevance"] == "float"
+    assert dict(pairs_pred.dtypes)["relevance"] == "float"
+    for dataframe in model._dataframes.values():
+        if dataframe is not None:
+            assert "double" not in dict(dataframe.dtypes).values()
+    assert compact_recs.count() == recs.count()
+    assert np.isclose(compact_ndcg, ndcg, atol=1e-6)
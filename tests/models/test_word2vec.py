@@ -3,11 +3,10 @@ from datetime import datetime
 
 import pytest
 import numpy as np
-from pyspark.sql import functions as sf
 
 from replay.constants import LOG_SCHEMA
 from replay.models import Word2VecRec
-from replay.utils import vector_dot
+from replay.utils import arrays_dot
 from tests.utils import spark
 
 
@@ -40,7 +39,7 @@ def test_fit(log, model):
     vectors = (
         model.vectors.select(
             "item",
-            vector_dot(sf.col("vector"), sf.col("vector")).alias("norm"),
+            arrays_dot("vector", "vector").alias("norm"),
         )
         .toPandas()
         .to_numpy()
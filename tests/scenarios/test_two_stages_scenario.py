@@ -1,13 +1,24 @@
 # pylint: disable=redefined-outer-name, missing-function-docstring, unused-import
+from types import SimpleNamespace
 
 import pytest
 from pyspark.sql import functions as sf
 
+from replay.cache import CacheManager, instance_scope
 from replay.models import ALSWrap, KNN, PopRec, LightFMWrap
 from replay.scenarios import TwoStagesScenario
+from replay.scenarios.two_stages import two_stages_scenario
+from replay.scenarios.two_stages.two_stages_scenario import (
+    get_first_level_model_features,
+)
 from replay.history_based_fp import HistoryBasedFeaturesProcessor
 from replay.data_preparator import ToNumericFeatureTransformer
-from replay.scenarios.two_stages.reranker import LamaWrap
+from replay.scenarios.two_stages.reranker import (
+    LamaWrap,
+    LightGBMRanker,
+    LogisticReRanker,
+    stratified_sample,
+)
 from replay.splitters import DateSplitter
 
 from tests.utils import (
@@ -64,6 +75,13 @@ def test_init(two_stages_kwargs):
         TwoStagesScenario(**two_stages_kwargs)
 
     two_stages_kwargs["use_first_level_models_feat"] = True
+    two_stages_kwargs["num_candidates_per_model"] = [2, 2]
+    with pytest.raises(
+        ValueError, match="For each model from first_level_models specify.*"
+    ):
+        TwoStagesScenario(**two_stages_kwargs)
+
+    two_stages_kwargs["num_candidates_per_model"] = None
     two_stages_kwargs["negatives_type"] = "abs"
     with pytest.raises(ValueError, match="Invalid negatives_type value.*"):
         TwoStagesScenario(**two_stages_kwargs)
@@ -102,6 +120,50 @@ def test_fit(
     two_stages.first_level_item_features_transformer.transform(item_features)
 
 
+def test_fit_concurrently(
+    long_log_with_features,
+    user_features,
+    item_features,
+    two_stages_kwargs,
+    monkeypatch,
+):
+    two_stages_kwargs["num_fit_threads"] = 3
+    two_stages_kwargs["fit_memory_per_model"] = "1g"
+    two_stages = TwoStagesScenario(**two_stages_kwargs)
+    monkeypatch.setattr(
+        two_stages_scenario, "_is_pinned_thread_mode", lambda: False
+    )
+    assert two_stages._get_num_fit_threads(5) == 1
+
+    monkeypatch.setattr(
+        two_stages_scenario, "_is_pinned_thread_mode", lambda: True
+    )
+    monkeypatch.setattr(
+        two_stages_scenario.psutil,
+        "virtual_memory",
+        lambda: SimpleNamespace(available=2 * 1024 ** 3),
+    )
+    assert two_stages._get_num_fit_threads(5) == 2
+    monkeypatch.setattr(
+        two_stages_scenario.psutil,
+        "virtual_memory",
+        lambda: SimpleNamespace(available=8 * 1024 ** 3),
+    )
+    assert two_stages._get_num_fit_threads(5) == 3
+    assert two_stages._get_num_fit_threads(2) == 2
+
+    two_stages.fit(
+        long_log_with_features,
+        user_features,
+        item_features.filter(sf.col("iq") > 4),
+    )
+    for model in two_stages.first_level_models + [
+        two_stages.random_model,
+        two_stages.fallback_model,
+    ]:
+        assert model.fit_users.count() == 3
+
+
 def test_predict(
     long_log_with_features, user_features, item_features, two_stages_kwargs,
 ):
@@ -124,6 +186,236 @@ def test_predict(
         1,
         2,
     ]
+    # only predictions stay cached after predict
+    scope = instance_scope(two_stages)
+    scopes = sum(CacheManager().pinned()["scopes"].tolist(), [])
+    assert scope in scopes
+    assert not [name for name in scopes if name.startswith(f"{scope}.")]
+
+
+@pytest.mark.parametrize(
+    "second_stage_model",
+    [LightGBMRanker(params={"n_estimators": 5}, seed=42), LogisticReRanker()],
+)
+def test_rerankers(
+    long_log_with_features,
+    user_features,
+    item_features,
+    two_stages_kwargs,
+    second_stage_model,
+):
+    two_stages_kwargs["second_stage_model"] = second_stage_model
+    two_stages = TwoStagesScenario(**two_stages_kwargs)
+    assert two_stages.second_stage_model is second_stage_model
+
+    two_stages.fit(
+        long_log_with_features,
+        user_features,
+        item_features.filter(sf.col("iq") > 4),
+    )
+    assert "rel_0_ALSWrap" in second_stage_model.feature_columns
+    pred = two_stages.predict(
+        log=long_log_with_features,
+        k=2,
+        user_features=user_features,
+        item_features=item_features,
+    )
+    assert pred.count() == 6
+    assert pred.filter(sf.col("relevance").isNull()).count() == 0
+
+
+def test_keep_factors_arrays(
+    long_log_with_features,
+    short_log_with_features,
+    user_features,
+    item_features,
+    two_stages_kwargs,
+):
+    model = ALSWrap(rank=4)
+    model.fit(long_log_with_features)
+    pairs = short_log_with_features.select("user_idx", "item_idx")
+    exploded = get_first_level_model_features(model, pairs, prefix="m_0")
+    arrays = get_first_level_model_features(
+        model, pairs, prefix="m_0", keep_arrays=True
+    )
+    assert "m_0_fm_3" in exploded.columns
+    assert set(arrays.columns) == {
+        "user_idx",
+        "item_idx",
+        "m_0_uf",
+        "m_0_if",
+        "m_0_fm",
+        "m_0_dot",
+    }
+    exploded = exploded.toPandas().sort_values(["user_idx", "item_idx"])
+    arrays = arrays.toPandas().sort_values(["user_idx", "item_idx"])
+    assert arrays["m_0_fm"].apply(len).eq(4).all()
+    assert (
+        exploded[[f"m_0_fm_{i}" for i in range(4)]].sum(axis=1).values
+        == pytest.approx(arrays["m_0_dot"].values, abs=1e-5)
+    )
+
+    two_stages_kwargs["keep_factors_arrays"] = True
+    two_stages_kwargs["second_stage_model"] = LogisticReRanker()
+    two_stages = TwoStagesScenario(**two_stages_kwargs)
+    two_stages.fit(
+        long_log_with_features,
+        user_features,
+        item_features.filter(sf.col("iq") > 4),
+    )
+    pred = two_stages.predict(
+        log=long_log_with_features,
+        k=2,
+        user_features=user_features,
+        item_features=item_features,
+    )
+    assert pred.count() == 6
+    assert two_stages.second_stage_model.array_sizes["m_0_uf"] == 4
+
+
+def test_first_level_candidates(long_log_with_features, two_stages_kwargs):
+    two_stages_kwargs["use_first_level_models_feat"] = False
+    two_stages_kwargs["use_generated_features"] = False
+    two_stages = TwoStagesScenario(**two_stages_kwargs)
+    two_stages.first_level_item_len = 9
+    two_stages.first_level_user_len = 3
+    model = PopRec()
+    model.fit(long_log_with_features.filter(sf.col("item_idx") == 1))
+    two_stages.fallback_model.fit(long_log_with_features)
+
+    candidates = two_stages._get_first_level_candidates(
+        model=model,
+        log=long_log_with_features,
+        k=4,
+        users=long_log_with_features.select("user_idx").distinct(),
+        items=long_log_with_features.select("item_idx").distinct(),
+        user_features=None,
+        item_features=None,
+        log_to_filter=long_log_with_features,
+    ).toPandas()
+    # seen items are removed once for the base and the fallback model
+    seen = long_log_with_features.select("user_idx", "item_idx").toPandas()
+    assert candidates.merge(seen, on=["user_idx", "item_idx"]).empty
+    assert not candidates.duplicated(["user_idx", "item_idx"]).any()
+    assert (candidates.groupby("user_idx").size() == 4).all()
+    # base model candidates go first
+    user_1 = candidates[candidates["user_idx"] == 1]
+    assert 1 in user_1["item_idx"].tolist()
+
+
+def test_candidates_union(long_log_with_features, two_stages_kwargs):
+    two_stages_kwargs["use_first_level_models_feat"] = False
+    two_stages_kwargs["use_generated_features"] = False
+    two_stages_kwargs["num_candidates_per_model"] = [1, 2, 1]
+    two_stages = TwoStagesScenario(**two_stages_kwargs)
+    assert two_stages._source_columns == [
+        "source_0_ALSWrap",
+        "source_1_KNN",
+        "source_2_LightFMWrap",
+    ]
+    two_stages.first_level_item_len = 9
+    two_stages.first_level_user_len = 3
+    for model in two_stages.first_level_models + [two_stages.fallback_model]:
+        model.fit(long_log_with_features)
+
+    candidates = two_stages._get_first_level_candidates(
+        model=two_stages.first_level_models[0],
+        log=long_log_with_features,
+        k=two_stages.num_negatives,
+        users=long_log_with_features.select("user_idx").distinct(),
+        items=long_log_with_features.select("item_idx").distinct(),
+        user_features=None,
+        item_features=None,
+        log_to_filter=long_log_with_features,
+        quotas=two_stages.num_candidates_per_model,
+    ).toPandas()
+    assert not candidates.duplicated(["user_idx", "item_idx"]).any()
+    assert (candidates.groupby("user_idx").size() == 4).all()
+    # each model proposes at most its quota of candidates per user
+    per_user = candidates.groupby("user_idx")[two_stages._source_columns]
+    assert (per_user.sum() <= [1, 2, 1]).all().all()
+    assert per_user.sum().sum().sum() > 0
+
+
+def test_merge_by_pairs(spark):
+    scores = spark.createDataFrame(
+        [(1, 1, 0.5), (1, 2, 0.3)], ["user_idx", "item_idx", "rel_0"]
+    )
+    features = spark.createDataFrame(
+        [(1, 1, 7), (2, 3, 8)], ["user_idx", "item_idx", "feature"]
+    )
+    merged = (
+        two_stages_scenario._merge_by_pairs([scores, features])
+        .toPandas()
+        .sort_values(["user_idx", "item_idx"])
+    )
+    assert merged.columns.tolist() == [
+        "user_idx",
+        "item_idx",
+        "rel_0",
+        "feature",
+    ]
+    assert merged["rel_0"].tolist()[:2] == [0.5, 0.3]
+    assert merged["feature"].tolist()[0] == 7
+    assert merged["rel_0"].isna().tolist() == [False, False, True]
+    assert merged["feature"].isna().tolist() == [False, True, False]
+
+
+def test_checkpoints(
+    long_log_with_features,
+    user_features,
+    item_features,
+    two_stages_kwargs,
+    tmp_path,
+):
+    two_stages_kwargs["checkpoint_dir"] = str(tmp_path)
+    two_stages_kwargs["second_stage_model"] = LogisticReRanker()
+    two_stages = TwoStagesScenario(**two_stages_kwargs)
+    two_stages.fit(long_log_with_features, user_features, item_features)
+    stages = [
+        "split",
+        "first_level_fit",
+        "candidates",
+        "features",
+        "second_level_fit",
+    ]
+    for stage in stages:
+        assert two_stages._is_completed(stage)
+    pred = two_stages.predict(
+        long_log_with_features,
+        k=2,
+        user_features=user_features,
+        item_features=item_features,
+    )
+    assert len(list(tmp_path.glob("*/predict_*/_COMPLETED"))) == 1
+
+    # all stages are loaded from the checkpoint
+    two_stages_kwargs["second_stage_model"] = LogisticReRanker()
+    resumed = TwoStagesScenario(**two_stages_kwargs)
+    resumed._fit_models = None
+    resumed.second_stage_model.fit = None
+    resumed.fit(long_log_with_features, user_features, item_features)
+    assert resumed._checkpoint_path == two_stages._checkpoint_path
+    resumed_pred = resumed.predict(
+        long_log_with_features,
+        k=2,
+        user_features=user_features,
+        item_features=item_features,
+    )
+    sparkDataFrameEqual(pred, resumed_pred)
+
+
+def test_stratified_sample(spark):
+    data = spark.range(1000).select(
+        sf.col("id").alias("user_idx"),
+        (sf.col("id") % 10 == 0).cast("double").alias("target"),
+    )
+    assert stratified_sample(data, None) is data
+    assert stratified_sample(data, 1000) is data
+
+    sample = stratified_sample(data, 200, seed=42).toPandas()
+    assert 100 < sample.shape[0] < 300
+    assert set(sample["target"]) == {0.0, 1.0}
 
 
 def test_optimize(
@@ -3,6 +3,7 @@ from datetime import datetime
 
 import pytest
 import numpy as np
+from pyspark.sql import functions as sf
 
 from replay.constants import LOG_SCHEMA
 from replay.splitters import DateSplitter
@@ -103,3 +104,25 @@ def test_drop_cold_users(log, split_date):
     test_users = test.toPandas().user_idx
 
     assert np.isin(test_users, train_users).all()
+
+
+@pytest.mark.parametrize("relative_error", [0.0, 0.01])
+def test_proportion_error_bound(spark, relative_error):
+    size = 10000
+    log = spark.range(size).select(
+        sf.col("id").alias("user_idx"),
+        sf.col("id").alias("item_idx"),
+        sf.col("id").cast("timestamp").alias("timestamp"),
+        sf.lit(1.0).alias("relevance"),
+    )
+    test_size = 0.3
+    splitter = DateSplitter(test_size, relative_error=relative_error)
+    train, test = splitter.split(log)
+
+    assert train.count() + test.count() == size
+    assert abs(test.count() - test_size * size) <= relative_error * size + 1
+
+
+def test_bad_relative_error():
+    with pytest.raises(ValueError):
+        DateSplitter(0.3, relative_error=2.0)
@@ -2,6 +2,7 @@
 import pytest
 import pandas as pd
 
+from replay.cache import CacheManager
 from replay.splitters.user_log_splitter import k_folds
 
 
@@ -21,6 +22,25 @@ def test_sum(df):
     assert all(res == df)
 
 
+def test_folds_disjoint(df):
+    rows = set(df.itertuples(index=False))
+    for train, test in list(k_folds(df, n_folds=2, seed=1337)):
+        train_rows = set(train.toPandas().itertuples(index=False))
+        test_rows = set(test.toPandas().itertuples(index=False))
+        assert not train_rows & test_rows
+        assert train_rows | test_rows == rows
+
+
 def test_wrong_type(df):
     with pytest.raises(ValueError):
         next(k_folds(df, splitter="totally not user"))
+
+
+def test_storage_released(df):
+    manager = CacheManager()
+    folds = k_folds(df, n_folds=2, seed=1337)
+    next(folds)
+    assert "k_folds.log" in manager.pinned()["name"].tolist()
+    for _ in folds:
+        pass
+    assert "k_folds.log" not in manager.pinned()["name"].tolist()
@@ -0,0 +1,72 @@
+# pylint: disable-all
+from datetime import datetime, timedelta
+
+import pytest
+
+from replay.cache import CacheManager
+from replay.constants import LOG_SCHEMA
+from replay.splitters import TimeWindowSplitter
+from tests.utils import spark
+
+
+@pytest.fixture
+def log(spark):
+    return spark.createDataFrame(
+        data=[
+            [day % 3, day % 4, datetime(2019, 9, 1 + day), 1.0]
+            for day in range(10)
+        ],
+        schema=LOG_SCHEMA,
+    )
+
+
+@pytest.mark.parametrize("step", [None, timedelta(days=2)])
+def test_windows(log, step):
+    splitter = TimeWindowSplitter(
+        datetime(2019, 9, 4),
+        n_windows=3,
+        train_duration=timedelta(days=3),
+        step=step,
+    )
+    step = step or timedelta(days=1)
+    previous_train = None
+    for i, window in enumerate(splitter.split(log)):
+        test_start = datetime(2019, 9, 4) + step * i
+        assert window.test_start == test_start
+        train = window.train.toPandas()
+        assert train.timestamp.min() == test_start - timedelta(days=3)
+        assert train.timestamp.max() == test_start - timedelta(days=1)
+        assert window.test.toPandas().timestamp.tolist() == [test_start]
+        if previous_train is not None:
+            assert (
+                previous_train.count()
+                + window.added.count()
+                - window.removed.count()
+                == window.train.count()
+            )
+            assert window.train.subtract(previous_train).count() == (
+                window.added.count()
+            )
+        previous_train = window.train
+
+
+def test_cache_released(log):
+    splitter = TimeWindowSplitter(
+        "2019-09-04", n_windows=2, train_duration=timedelta(days=3)
+    )
+    windows = splitter.split(log)
+    next(windows)
+    assert "TimeWindowSplitter.log" in CacheManager().pinned()["name"].tolist()
+    for _ in windows:
+        pass
+    assert (
+        "TimeWindowSplitter.log"
+        not in CacheManager().pinned()["name"].tolist()
+    )
+
+
+def test_bad_n_windows():
+    with pytest.raises(ValueError):
+        TimeWindowSplitter(
+            "2019-09-04", n_windows=0, train_duration=timedelta(days=3)
+        )
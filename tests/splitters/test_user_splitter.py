@@ -156,3 +156,27 @@ def test_split_proportion(log2):
     num_items = test.toPandas().user_idx.value_counts()
     assert num_items[1] == 2
     assert num_items[0] == 1 and num_items[2] == 1
+
+
+@pytest.mark.parametrize("item_test_size", [0.4, 2])
+@pytest.mark.parametrize("user_test_size", [None, 2, 0.5])
+def test_hash_split(log2, item_test_size, user_test_size):
+    splitter = UserSplitter(
+        item_test_size=item_test_size,
+        user_test_size=user_test_size,
+        shuffle=True,
+        seed=1234,
+        hash_split=True,
+    )
+    train, test = splitter.split(log2)
+    assert train.count() + test.count() == log2.count()
+    assert test.intersect(train).count() == 0
+    if isinstance(item_test_size, int):
+        num_items = test.toPandas().user_idx.value_counts()
+        assert (num_items == item_test_size).all()
+    if user_test_size == 2:
+        assert test.select("user_idx").distinct().count() == 2
+
+    # split does not depend on partitioning of the log
+    _, repartitioned_test = splitter.split(log2.repartition(5))
+    assert sorted(test.collect()) == sorted(repartitioned_test.collect())
@@ -0,0 +1,74 @@
+# pylint: disable-all
+import gc
+
+import pytest
+
+from replay.cache import CacheManager
+from replay.models import PopRec
+from replay.splitters import RandomSplitter
+from tests.utils import log, spark
+
+
+@pytest.fixture
+def manager():
+    manager = CacheManager()
+    manager.clear()
+    yield manager
+    manager.clear()
+
+
+def test_reference_counting(spark, manager):
+    df = spark.range(10)
+    manager.persist(df, "first", storage_level="DISK_ONLY")
+    manager.persist(df, "second")
+    assert df.storageLevel.useDisk and not df.storageLevel.useMemory
+    manager.release(df, "first")
+    assert df.is_cached
+    manager.release_scope("second")
+    assert not df.is_cached
+    assert manager.pinned().empty
+
+    with pytest.raises(ValueError, match="Unknown storage level.*"):
+        manager.persist(df, "first", storage_level="MEMORY_TWICE")
+
+
+def test_budget_eviction(spark, manager):
+    spark.conf.set("spark.replay.cacheBudget", "1b")
+    first = manager.persist(spark.range(10), "test", name="first")
+    first.count()
+    second = manager.persist(spark.range(20), "test", name="second")
+    spark.conf.unset("spark.replay.cacheBudget")
+    assert not first.is_cached
+    assert second.is_cached
+    assert manager.pinned()["name"].tolist() == ["second"]
+
+
+def test_model_release(log, manager):
+    model = PopRec()
+    model.fit(log)
+    item_popularity = model.item_popularity
+    assert item_popularity.is_cached
+    assert "PopRec.item_popularity" in manager.pinned()["name"].tolist()
+
+    model.fit(log)
+    assert not item_popularity.is_cached
+    assert model.item_popularity.is_cached
+
+    fit_users = model.fit_users
+    del model
+    gc.collect()
+    assert not fit_users.is_cached
+    assert manager.pinned().empty
+
+
+def test_split_release(log, manager):
+    splitter = RandomSplitter(test_size=0.5, seed=1)
+    train, test = splitter.split(log)
+    assert train.is_cached and test.is_cached
+    other_train, _ = RandomSplitter(test_size=0.5, seed=1).split(log)
+    splitter.split(log)
+    assert train.is_cached and test.is_cached
+
+    manager.release_scope(splitter.cache_scope)
+    assert not train.is_cached and not test.is_cached
+    assert other_train.is_cached
@@ -0,0 +1,67 @@
+# pylint: disable-all
+from pyspark.sql import functions as sf
+
+from replay.filters import (
+    FilterPipeline,
+    KCoreFilter,
+    filter_by_user_duration,
+    filter_user_interactions,
+    min_entries,
+    min_rating,
+)
+from tests.utils import log, spark
+
+
+def _rows(df):
+    return sorted(
+        df.select("user_idx", "item_idx", "timestamp", "relevance").collect()
+    )
+
+
+def test_pipeline_same_as_filters(log):
+    log = log.repartition(4)
+    pipeline = (
+        FilterPipeline()
+        .min_rating(1)
+        .min_entries(2)
+        .user_interactions(2, first=False)
+        .user_duration(1, first=True)
+    )
+    expected = filter_by_user_duration(
+        filter_user_interactions(
+            min_entries(min_rating(log, 1), 2), 2, first=False
+        ),
+        1,
+        first=True,
+    )
+    result = pipeline.transform(log)
+    assert _rows(result) == _rows(expected)
+
+    plan = result._jdf.queryExecution().executedPlan().toString()
+    assert plan.count("Exchange hashpartitioning") == 1
+
+
+def test_k_core(log):
+    result = (
+        FilterPipeline()
+        .between_dates(end_date="2019-08-27")
+        .k_core(min_user_entries=2, min_item_entries=2)
+        .transform(log)
+    )
+    user_counts = result.groupBy("user_idx").count()
+    item_counts = result.groupBy("item_idx").count()
+    assert user_counts.filter(sf.col("count") < 2).count() == 0
+    assert item_counts.filter(sf.col("count") < 2).count() == 0
+    assert result.count() == 8
+
+
+def test_k_core_filter_report(log):
+    k_core_filter = KCoreFilter(min_user_entries=3, min_item_entries=3)
+    result = k_core_filter.transform(log)
+    assert result.columns == log.columns
+    assert sum(k_core_filter.removed_rows) == log.count() - result.count()
+    assert k_core_filter.iterations == len(k_core_filter.removed_rows)
+    assert all(rows > 0 for rows in k_core_filter.removed_rows)
+
+    k_core_filter.transform(result)
+    assert k_core_filter.iterations == 0
@@ -203,6 +203,108 @@ def test_log_proc_relevance_ts(spark, log_proc, log_for_feature_gen):
     )
 
 
+def test_log_proc_update(log_for_feature_gen, tmp_path):
+    full_log_proc = LogStatFeaturesProcessor()
+    full_log_proc.fit(log_for_feature_gen)
+
+    log_proc = LogStatFeaturesProcessor()
+    log_proc.fit(log_for_feature_gen.filter(sf.col("user_idx") != "u3"))
+    log_proc.save(str(tmp_path))
+    loaded_log_proc = LogStatFeaturesProcessor()
+    loaded_log_proc.load(str(tmp_path))
+    loaded_log_proc.update(
+        log_for_feature_gen.filter(sf.col("user_idx") == "u3")
+    )
+
+    # averaged features of counterparts are accumulated as of the update
+    for prefix, entity in [("u", "user_idx"), ("i", "item_idx")]:
+        exact_columns = [entity, f"{prefix}_log_num_interact"] + [
+            f"{prefix}_{col}" for col in time_columns + relevance_columns
+        ]
+        sparkDataFrameEqual(
+            getattr(full_log_proc, f"{entity[0]}_log_features").select(
+                *exact_columns
+            ),
+            getattr(loaded_log_proc, f"{entity[0]}_log_features").select(
+                *exact_columns
+            ),
+        )
+
+
+def test_log_proc_relevance_bins(log_for_feature_gen):
+    exact_log_proc = LogStatFeaturesProcessor()
+    exact_log_proc.fit(log_for_feature_gen)
+    log_proc = LogStatFeaturesProcessor()
+    log_proc.max_relevance_values = 2
+    log_proc.fit(log_for_feature_gen)
+    assert log_proc.relevance_range == [1.0, 4.0]
+
+    hist = log_proc.user_relevance_hist.toPandas()
+    assert sorted(hist["relevance"].unique()) == [1.75, 3.25]
+    assert hist["num_interact"].sum() == log_for_feature_gen.count()
+    assert log_proc.user_days.count() == 6
+
+    # moments are exact, quantiles are bin centers
+    exact_columns = ["item_idx", "i_mean", "i_std", "i_log_num_interact"]
+    sparkDataFrameEqual(
+        exact_log_proc.item_log_features.select(*exact_columns),
+        log_proc.item_log_features.select(*exact_columns),
+    )
+    quantiles = log_proc.item_log_features.filter(
+        sf.col("item_idx") == "i3"
+    ).first()
+    assert quantiles["i_quantile_05"] == 3.25
+    assert quantiles["i_quantile_95"] == 3.25
+
+
+def test_log_proc_update_reduces_to_bins(log_for_feature_gen):
+    full_log_proc = LogStatFeaturesProcessor()
+    full_log_proc.max_relevance_values = 3
+    full_log_proc.fit(log_for_feature_gen)
+    assert full_log_proc.relevance_range == [1.0, 4.0]
+
+    log_proc = LogStatFeaturesProcessor()
+    log_proc.max_relevance_values = 3
+    log_proc.fit(log_for_feature_gen.filter(sf.col("user_idx") != "u3"))
+    assert log_proc.relevance_values == [1.0, 3.0, 4.0]
+    log_proc.update(log_for_feature_gen.filter(sf.col("user_idx") == "u3"))
+    assert log_proc.relevance_values is None
+    assert log_proc.relevance_range == [1.0, 4.0]
+
+    # exact histograms are re-binned with the same bins as in fit
+    for name in ["user_relevance_hist", "item_relevance_hist"]:
+        sparkDataFrameEqual(
+            getattr(full_log_proc, name), getattr(log_proc, name)
+        )
+
+
+def test_log_proc_update_clamps_to_edge_bins(spark, log_for_feature_gen):
+    log_proc = LogStatFeaturesProcessor()
+    log_proc.max_relevance_values = 2
+    log_proc.fit(log_for_feature_gen)
+    log_proc.update(
+        spark.createDataFrame(
+            [["u1", "i2", datetime(2019, 1, 1), 10.0]],
+            schema=log_for_feature_gen.schema,
+        )
+    )
+    assert log_proc.relevance_range == [1.0, 4.0]
+    hist = (
+        log_proc.user_relevance_hist.filter(sf.col("user_idx") == "u1")
+        .toPandas()
+        .sort_values("relevance")
+    )
+    assert hist["relevance"].tolist() == [1.75, 3.25]
+    assert hist["num_interact"].tolist() == [1, 2]
+
+    # moments are exact, quantiles are bin centers
+    features = log_proc.user_log_features.filter(
+        sf.col("user_idx") == "u1"
+    ).first()
+    assert features["u_mean"] == pytest.approx(14 / 3)
+    assert features["u_quantile_95"] == 3.25
+
+
 def test_conditional_features(spark, log_for_feature_gen, user_features):
 
     cond_pop_proc = ConditionalPopularityProcessor(
@@ -222,6 +324,36 @@ def test_conditional_features(spark, log_for_feature_gen, user_features):
     )
 
 
+def test_conditional_features_several_columns(
+    spark, log_for_feature_gen, user_features
+):
+    cond_pop_proc = ConditionalPopularityProcessor(
+        cat_features_list=["gender", "user_feature_1"]
+    )
+    cond_pop_proc.fit(log=log_for_feature_gen, features=user_features)
+
+    gt_gender = spark.createDataFrame(
+        data=[["i1", "M", 0.5], ["i1", "F", 0.5], ["i2", None, 1.0]],
+        schema=["item_idx", "gender", "i_pop_by_gender"],
+    )
+    sparkDataFrameEqual(
+        gt_gender,
+        cond_pop_proc.conditional_pop_dict["gender"].filter(
+            sf.col("item_idx").isin(["i1", "i2"])
+        ),
+    )
+    gt_feature = spark.createDataFrame(
+        data=[["i3", 1.0, 0.5], ["i3", None, 0.5]],
+        schema=["item_idx", "user_feature_1", "i_pop_by_user_feature_1"],
+    )
+    sparkDataFrameEqual(
+        gt_feature,
+        cond_pop_proc.conditional_pop_dict["user_feature_1"].filter(
+            sf.col("item_idx") == "i3"
+        ),
+    )
+
+
 def test_history_based_fp_fit_transform(
     log_for_feature_gen,
     user_features,
@@ -270,3 +402,32 @@ def test_history_based_fp_one_features_df(log_for_feature_gen, user_features):
         log_for_feature_gen.join(user_features, on="user_idx")
     )
     assert "i_pop_by_gender" in res.columns
+
+
+def test_history_based_fp_update(log_for_feature_gen, user_features, tmp_path):
+    history_based_fp = HistoryBasedFeaturesProcessor(
+        user_cat_features_list=["gender"]
+    )
+    history_based_fp.fit(
+        log=log_for_feature_gen.filter(sf.col("user_idx") != "u3"),
+        user_features=user_features,
+    )
+    path = str(tmp_path / "processor")
+    history_based_fp.save(path)
+    loaded_fp = HistoryBasedFeaturesProcessor.load(path)
+    loaded_fp.update(
+        log=log_for_feature_gen.filter(sf.col("user_idx") == "u3"),
+        user_features=user_features,
+    )
+
+    full_fp = HistoryBasedFeaturesProcessor(user_cat_features_list=["gender"])
+    full_fp.fit(log=log_for_feature_gen, user_features=user_features)
+    sparkDataFrameEqual(
+        full_fp.user_cond_pop_proc.conditional_pop_dict["gender"],
+        loaded_fp.user_cond_pop_proc.conditional_pop_dict["gender"],
+    )
+    res = loaded_fp.transform(
+        log_for_feature_gen.join(user_features, on="user_idx")
+    )
+    assert "i_pop_by_gender" in res.columns
+    assert "u_log_num_interact" in res.columns
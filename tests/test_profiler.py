@@ -0,0 +1,68 @@
+# pylint: disable-all
+import json
+
+from replay.metrics import NDCG
+from replay.models import KNN
+from replay.profiler import Profiler
+from replay.session_handler import State, is_profiling
+from tests.utils import log, spark
+
+
+def test_profiler_disabled(log):
+    profiler = Profiler()
+    KNN().fit_predict(log, k=1)
+    assert State().profiler is None
+    assert not is_profiling()
+    assert profiler.records == []
+
+
+def test_profiler_keeps_job_group(log, spark):
+    spark.sparkContext.setJobGroup("caller", "caller job")
+    with Profiler(count_rows=True) as profiler:
+        assert is_profiling()
+        KNN().fit(log)
+    assert not is_profiling()
+    assert len(profiler.records) > 0
+    assert spark.sparkContext.getLocalProperty("spark.jobGroup.id") == "caller"
+    assert (
+        spark.sparkContext.getLocalProperty("spark.job.description")
+        == "caller job"
+    )
+    spark.sparkContext.setLocalProperty("spark.jobGroup.id", None)
+    spark.sparkContext.setLocalProperty("spark.job.description", None)
+
+
+def test_profiler(log, tmp_path):
+    with Profiler(count_rows=True) as profiler:
+        model = KNN()
+        model.fit(log)
+        recs = model.predict(log, k=1)
+        NDCG()(recs, log, 1)
+    assert State().profiler is None
+
+    report = profiler.report
+    assert {
+        "KNN._fit_wrap",
+        "KNN._fit",
+        "KNN._predict_wrap",
+        "KNN._predict",
+        "_filter_seen",
+        "get_top_k_recs",
+        "NDCG.__call__",
+        "get_enriched_recommendations",
+    }.issubset(report["name"])
+
+    fit = report[report["name"] == "KNN._fit_wrap"].iloc[0]
+    children = report[report["parent"] == "KNN._fit_wrap"]
+    assert fit["jobs"] > 0
+    assert fit["jobs"] >= children["jobs"].sum()
+    assert fit["rows_in"] == log.count()
+
+    top_k = report[report["name"] == "get_top_k_recs"].iloc[0]
+    assert top_k["rows_out"] == recs.count()
+    assert top_k["depth"] == 1
+
+    path = tmp_path / "report.json"
+    profiler.to_json(str(path))
+    assert len(json.loads(path.read_text())) == len(report)
+    assert profiler.summary().index.is_unique
@@ -2,16 +2,19 @@
 from datetime import datetime
 from datetime import timezone
 from functools import partial
+import logging
 
 import numpy as np
 import pandas as pd
 import pyspark.sql.functions as sf
+from pyspark.ml.linalg import Vectors
 from pyspark.sql import SparkSession
 from pyspark.sql.types import TimestampType
 import pytest
 
 import replay.session_handler
-from replay import utils
+from replay import sparse, utils
+from replay.constants import LOG_SCHEMA
 from tests.utils import spark, sparkDataFrameEqual
 
 datetime = partial(datetime, tzinfo=timezone.utc)
@@ -90,6 +93,76 @@ def test_get_spark_session():
     assert replay.session_handler.State().session is spark
 
 
+def test_get_spark_session_existing(spark, caplog, monkeypatch):
+    monkeypatch.setattr(
+        replay.session_handler,
+        "get_spark_config",
+        lambda *args: {"spark.memory.offHeap.enabled": "true"},
+    )
+    with caplog.at_level(logging.WARNING, logger="replay"):
+        session = replay.session_handler.get_spark_session(1, 1)
+    assert session is spark
+    assert "spark.memory.offHeap.enabled" in caplog.text
+
+
+def test_get_spark_config(tmp_path, monkeypatch):
+    conf = replay.session_handler.get_spark_config(1, 2, profile="cluster")
+    assert "spark.master" not in conf
+    assert conf["spark.sql.adaptive.skewJoin.enabled"] == "true"
+    assert conf["spark.sql.shuffle.partitions"] == "2"
+
+    config_path = tmp_path / "spark.json"
+    config_path.write_text(
+        '{"profile": "local-small", '
+        '"config": {"spark.sql.autoBroadcastJoinThreshold": "1m"}}'
+    )
+    monkeypatch.setenv("REPLAY_SPARK_CONFIG", str(config_path))
+    conf = replay.session_handler.get_spark_config(1)
+    assert conf["spark.master"] == "local[*]"
+    assert conf["spark.sql.adaptive.enabled"] == "true"
+    assert conf["spark.sql.autoBroadcastJoinThreshold"] == "1m"
+
+    monkeypatch.delenv("REPLAY_SPARK_CONFIG")
+    monkeypatch.setenv("REPLAY_SPARK_PROFILE", "local-large")
+    conf = replay.session_handler.get_spark_config(1)
+    assert conf["spark.memory.offHeap.enabled"] == "true"
+
+    with pytest.raises(ValueError, match="Unknown Spark profile.*"):
+        replay.session_handler.get_spark_config(1, profile="huge")
+
+
+def test_repartition_by_size(spark):
+    dataframe = spark.createDataFrame(
+        pd.DataFrame({"user_idx": range(100), "item_idx": range(100)})
+    ).repartition(4)
+    assert utils.get_size_in_bytes(dataframe) > 0
+    assert utils.get_num_partitions(dataframe) == 4
+    assert utils.get_num_partitions(dataframe.orderBy("item_idx")) > 0
+
+    spark.conf.set("spark.replay.targetPartitionBytes", "1b")
+    res = utils.repartition_by_size(dataframe, "test", "user_idx")
+    assert res.rdd.getNumPartitions() > 4
+    sparkDataFrameEqual(res, dataframe)
+
+    spark.conf.set("spark.replay.targetPartitionBytes", "1g")
+    res = utils.repartition_by_size(dataframe, "test")
+    assert res.rdd.getNumPartitions() == 1
+    res = utils.cross_join_by_size(dataframe, dataframe, "test")
+    assert res.count() == 100 * 100
+    spark.conf.unset("spark.replay.targetPartitionBytes")
+
+
+def test_self_join_size(spark):
+    dataframe = spark.createDataFrame(
+        pd.DataFrame({"user_idx": [1] * 10, "item_idx": range(10)})
+    )
+    row_pairs_size = utils.get_self_join_size(dataframe.limit(1), "user_idx")
+    assert row_pairs_size > 0
+    assert utils.get_self_join_size(dataframe, "user_idx") == (
+        100 * row_pairs_size
+    )
+
+
 def test_convert():
     dataframe = pd.DataFrame(
         [[1, "a", 3.0], [3, "b", 5.0]], columns=["a", "b", "c"]
@@ -97,3 +170,112 @@ def test_convert():
     spark_df = utils.convert2spark(dataframe)
     pd.testing.assert_frame_equal(dataframe, spark_df.toPandas())
     assert utils.convert2spark(spark_df) is spark_df
+
+
+def test_convert_spill(spark, tmp_path):
+    dataframe = pd.DataFrame(
+        {
+            "user_idx": [1, 2, 3],
+            "item_idx": [3, 2, 1],
+            "timestamp": pd.to_datetime(
+                ["2020-01-01", "2020-03-01 02:30:00", "2021-06-01 12:00:00"]
+            ),
+            "relevance": [1, 2, 3],
+        }
+    )
+    expected = utils.convert2spark(dataframe, LOG_SCHEMA)
+    assert expected.schema == LOG_SCHEMA
+
+    spark.conf.set("spark.replay.spillBytes", "1b")
+    spark.conf.set("spark.replay.spillDir", str(tmp_path))
+    result = utils.convert2spark(dataframe, LOG_SCHEMA)
+    spark.conf.unset("spark.replay.spillBytes")
+    spark.conf.unset("spark.replay.spillDir")
+    assert list(tmp_path.iterdir()) == []
+    assert result.schema == LOG_SCHEMA
+    sparkDataFrameEqual(result, expected)
+
+    spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "false")
+    result = utils.convert2spark(dataframe, LOG_SCHEMA)
+    spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+    assert result.schema == LOG_SCHEMA
+    sparkDataFrameEqual(result, expected)
+
+
+def test_to_csr(spark, tmp_path):
+    pandas_log = pd.DataFrame(
+        {
+            "user_idx": [0, 2, 2, 0, 3, 0],
+            "item_idx": [1, 0, 3, 1, 2, 4],
+            "relevance": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+        }
+    )
+    log = spark.createDataFrame(pandas_log).repartition(3)
+    expected = np.zeros((5, 6), dtype=np.float32)
+    np.add.at(
+        expected,
+        (pandas_log["user_idx"], pandas_log["item_idx"]),
+        pandas_log["relevance"],
+    )
+
+    matrix = sparse.to_csr(log, 5, 6, path=str(tmp_path))
+    assert matrix.dtype == np.float32 and matrix.has_canonical_format
+    assert np.array_equal(matrix.toarray(), expected)
+    assert (tmp_path / "indices.npy").exists()
+    assert np.array_equal(sparse.to_csc(log, 5, 6).toarray(), expected)
+    assert sparse.to_csr(log).shape == (4, 5)
+    assert sparse.to_csc(log, dtype=np.float64).dtype == np.float64
+
+    shards = sparse.to_csr_shards(log, 2, item_count=6).collect()
+    rows = np.zeros_like(expected)
+    for shard in shards:
+        first_row = shard["first_row"]
+        rows[first_row : first_row + shard["num_rows"]] = sparse.shard_to_csr(
+            shard
+        ).toarray()
+    assert np.array_equal(rows, expected)
+    assert sparse.to_csr_shards(log.limit(0), 2).count() == 0
+
+
+def test_native_vector_functions(spark):
+    rng = np.random.default_rng(0)
+    vectors = spark.createDataFrame(
+        [
+            (Vectors.dense(one), Vectors.dense(two))
+            for one, two in rng.random((10, 2, 3)).tolist()
+        ]
+    ).toDF("one", "two")
+    arrays = utils.vectors_to_arrays(vectors, "one", "two")
+    result = (
+        vectors.select(
+            utils.vector_dot("one", "two").alias("dot"),
+            utils.cosine_similarity("one", "two").alias("cos"),
+            utils.vector_euclidean_distance_similarity("one", "two").alias(
+                "euclid"
+            ),
+        )
+        .toPandas()
+        .to_numpy()
+    )
+    for functions in [
+        (
+            utils.arrays_dot,
+            utils.arrays_cosine_similarity,
+            utils.arrays_euclidean_distance_similarity,
+        ),
+        (
+            utils.arrays_dot_pandas,
+            utils.arrays_cosine_similarity_pandas,
+            utils.arrays_euclidean_distance_similarity_pandas,
+        ),
+    ]:
+        native = (
+            arrays.select(*[function("one", "two") for function in functions])
+            .toPandas()
+            .to_numpy()
+        )
+        assert np.allclose(native, result, rtol=1e-6)
+
+    mean = arrays.agg(utils.average_arrays("one", 3).alias("mean")).first()
+    expected = np.mean(arrays.select("one").toPandas()["one"].tolist(), axis=0)
+    assert np.allclose(mean["mean"], expected)